@@ -41,7 +41,6 @@ setup(
         'beautifulsoup4',
         'unittest2',
         'pyquery',
-        'autopy',  #'https://github.com/Riamse/autopy.git',
         'setuptools',
     ],
     scripts=[],
@@ -56,7 +55,9 @@ setup(
     ),
     include_package_data=True,
     extras_require = {
-        'test': ['ipython', 'plone.testing']
+        'test': ['ipython', 'plone.testing'],
+        # real mouse clicks, see Browser.synthetic_input
+        'native': ['autopy'],  #'https://github.com/Riamse/autopy.git',
     },
     data_files = [
         ('share/doc/spynner/examples',
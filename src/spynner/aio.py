@@ -0,0 +1,264 @@
+#!/usr/bin/python
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+asyncio integration for spynner (python 3 only).
+
+The Qt events are pumped from the asyncio loop while an operation is
+pending, and the operations are awaited instead of blocking the thread
+in a nested Qt events loop, so other coroutines keep running::
+
+    >>> import asyncio
+    >>> from spynner.aio import AsyncBrowser
+    >>> async def main():
+    ...     br = AsyncBrowser()
+    ...     await br.load('http://www.google.fr')
+    ...     await br.click('#link', wait_load=True)
+    ...     return br.html
+    >>> html = asyncio.get_event_loop().run_until_complete(main())
+
+Like L{spynner.Browser}, an AsyncBrowser must be used from the thread
+owning the QApplication.
+"""
+import asyncio
+import time
+
+from spynner.browser import (
+    Browser,
+    SpynnerTimeout,
+    QNetworkAccessManager,
+)
+
+
+class AsyncBrowser(object):
+    """
+    Awaitable facade over a L{spynner.Browser}.
+
+    Attributes which are not overridden here (html, url, soup, fill, ...)
+    are read from the wrapped browser.
+    """
+
+    def __init__(self, browser=None, interval=0.005, **kwargs):
+        """
+        @param browser: L{spynner.Browser} to wrap, if None a new one is
+                        created with the remaining keyword arguments.
+        @param interval: seconds between two Qt events processing while
+                         an operation is pending.
+        """
+        if browser is None:
+            browser = Browser(**kwargs)
+        self.browser = browser
+        self.interval = interval
+        self._waiters = []
+        self._pending = 0
+        self._pump_handle = None
+        browser._listeners.append(self._wake)
+
+    def __getattr__(self, name):
+        return getattr(self.browser, name)
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _pump(self):
+        self._pump_handle = None
+        self.browser.application.processEvents()
+        if self._pending:
+            self._schedule_pump()
+
+    def _schedule_pump(self):
+        if self._pump_handle is None:
+            loop = asyncio.get_event_loop()
+            self._pump_handle = loop.call_later(self.interval, self._pump)
+
+    async def _until(self, condition, timeout=None, interval=None):
+        """
+        Await until C{condition()} is true, the asyncio counterpart of
+        L{spynner.Browser._wait_for}.
+
+        @return: the last value of C{condition()} (false on timeout).
+        """
+        br = self.browser
+        loop = asyncio.get_event_loop()
+        br.application.processEvents()
+        result = condition()
+        if result:
+            return result
+        br._check_deadlines()
+        timeout, deadline = br._deadline_timeout(timeout)
+        end = None
+        if timeout is not None:
+            end = loop.time() + timeout
+        self._pending += 1
+        self._schedule_pump()
+        try:
+            while not result:
+                if br._expired_deadline() is not None:
+                    break
+                step = interval
+                if end is not None:
+                    remaining = end - loop.time()
+                    if remaining <= 0:
+                        break
+                    step = remaining if step is None else min(step, remaining)
+                waiter = loop.create_future()
+                self._waiters.append(waiter)
+                try:
+                    await asyncio.wait([waiter], timeout=step)
+                finally:
+                    self._waiters.remove(waiter)
+                result = condition()
+        finally:
+            self._pending -= 1
+        if not result:
+            br._check_deadlines(deadline)
+        return result
+
+    async def wait_load(self, timeout=None):
+        """Await the end of the page load, see L{spynner.Browser.wait_load}."""
+        br = self.browser
+        if not await self._until(lambda: br._load_status is not None,
+                                 timeout=timeout or None):
+            raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
+        return br._load_finished()
+
+    async def load(self, url, load_timeout=10,
+                   operation=QNetworkAccessManager.GetOperation,
+                   body=None, headers=None,
+                   wait_until=None, idle_requests=0, idle_time=0.5):
+        """Load a web page and return its status, see L{spynner.Browser.load}."""
+        br = self.browser
+        br._check_wait_until(wait_until)
+        br._start_load(url, operation=operation, body=body, headers=headers)
+        ret = await self.wait_load(load_timeout)
+        if wait_until == 'networkidle':
+            await self.wait_network_idle(idle_requests, idle_time, timeout=load_timeout)
+        return ret
+
+    async def settle(self, timeout=None, quiet=None):
+        """Await the effects of an action, see L{spynner.Browser.settle}."""
+        br = self.browser
+        if timeout is None:
+            timeout = br.settle_timeout
+        if quiet is None:
+            quiet = br.settle_quiet
+        itime = time.time()
+        await self._until(br._settled_condition(quiet),
+                          timeout=timeout, interval=quiet / 2.)
+        return br._settled(itime)
+
+    async def wait_requests(self, wait_requests=None, url=None, url_regex=None,
+                            since=None, timeout=None):
+        """Await some replies, see L{spynner.Browser.wait_requests}."""
+        br = self.browser
+        if not (wait_requests or url or url_regex):
+            return []
+        if since is None:
+            since = br._replies_mark if wait_requests else br.replies.seq
+        watch = br.replies.watch(
+            wait_requests or 1, url=url, url_regex=url_regex, since=since)
+        try:
+            if not await self._until(lambda: watch.done, timeout=timeout):
+                raise SpynnerTimeout("Timeout reached: %s seconds" % timeout)
+        finally:
+            br.replies.unwatch(watch)
+        return watch.records
+
+    async def wait_network_idle(self, idle_requests=0, idle_time=0.5, timeout=None):
+        """Await an idle network, see L{spynner.Browser.wait_network_idle}."""
+        br = self.browser
+        watch = br.replies.idle_watch(idle_requests, idle_time)
+        try:
+            if not await self._until(lambda: watch.done, timeout=timeout or None,
+                                     interval=max(0.005, idle_time / 10.)):
+                raise SpynnerTimeout(
+                    "Timeout reached: %d seconds (%d requests in flight)" % (
+                        timeout, br.replies.inflight))
+        finally:
+            br.replies.unwatch(watch)
+
+    async def click(self, selector, wait_load=False, wait_requests=None,
+                    timeout=None, wait_until=None, idle_requests=0, idle_time=0.5):
+        """Click an element, see L{spynner.Browser.click}."""
+        br = self.browser
+        br._check_wait_until(wait_until)
+        since = br._mark_replies()
+        if br.embed_jquery_simulate:
+            jscode = "%s('%s').simulate('click');" % (br.jslib, selector)
+            br._runjs_on_jquery("click", jscode)
+        else:
+            br._wk_dispatch_click(br.webframe.findFirstElement(selector))
+            await self.settle()
+        await self.wait_requests(wait_requests, since=since, timeout=timeout)
+        ret = None
+        if wait_load:
+            ret = await self.wait_load(timeout)
+        if wait_until == 'networkidle':
+            await self.wait_network_idle(idle_requests, idle_time, timeout=timeout)
+        return ret
+
+    async def wait_for_content(self, callback, timeout=None, interval=None):
+        """
+        Await until C{callback(browser)} returns true. It is called each
+        time the DOM changes or a page loads, and every C{interval} seconds
+        if given.
+        """
+        br = self.browser
+        def _matched():
+            br._watch_dom()
+            return callback(br)
+        if not await self._until(_matched, timeout=timeout, interval=interval):
+            raise SpynnerTimeout(
+                "Timeout reached: %ss watching the DOM." % timeout)
+        load_status = br._load_status
+        br._load_status = None
+        return load_status
+
+    async def wait_for_selector(self, selector, state='attached', timeout=None):
+        """Await an element state, see L{spynner.Browser.wait_for_selector}."""
+        br = self.browser
+        element = {}
+        def _matched(browser):
+            element['element'] = browser.webframe.findFirstElement(selector)
+            return br._selector_in_state(element['element'], state)
+        interval = 0.25 if state in ('visible', 'hidden') else None
+        br._check_selector_state(state)
+        await self.wait_for_content(_matched, timeout=timeout, interval=interval)
+        return element['element']
+
+    async def runjs(self, jscode, debug=True):
+        """Run Javascript code, see L{spynner.Browser.runjs}."""
+        await asyncio.sleep(0)
+        return self.browser.runjs(jscode, debug=debug)
+
+    async def download(self, url, outfd=None, timeout=None, proxy_url=None,
+                       resume=False, progress=None, size=None, checksum=None):
+        """Download an url with the current cookies, see L{spynner.Browser.download}."""
+        br = self.browser
+        reply, outfd, outfd_set = br._begin_download(
+            url, outfd, proxy_url, resume=resume, progress=progress)
+        if not await self._until(lambda: reply.download_finished,
+                                 timeout=timeout or None):
+            reply.abort()
+            br._download_result(reply, outfd, outfd_set)
+            raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
+        return br._download_result(reply, outfd, outfd_set, size, checksum)
+
+    def close(self):
+        """Close the wrapped browser."""
+        if self._wake in self.browser._listeners:
+            self.browser._listeners.remove(self._wake)
+        self.browser.close()
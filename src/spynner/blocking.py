@@ -0,0 +1,471 @@
+#!/usr/bin/python
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Request blocking rules, used by the browser network manager.
+
+The domain rules are stored in a suffix trie and the url patterns compiled
+into a few combined regular expressions. The adblock filters are also
+indexed by one of their words, so only the filters sharing a word with the
+url are tried and matching a request does not depend much on the number of
+rules. Each rule counts its hits::
+
+    >>> rules = browser.blocking
+    >>> rules.add_domain('doubleclick.net')
+    >>> rules.add_regex(r'\\.gif$', resource_types=['image'], third_party=True)
+    >>> rules.load_adblock(open('easylist.txt'))
+    >>> browser.load(url)
+    >>> for rule in rules.stats()[:10]:
+    ...     print rule.hits, rule
+
+The blocked requests get an immediate empty reply failing with
+C{QNetworkReply.ContentAccessDenied}.
+"""
+import collections
+import re
+
+import six
+from six.moves.urllib import parse as urlparse
+
+RESOURCE_TYPES = (
+    'document', 'subdocument', 'stylesheet', 'script', 'image', 'font',
+    'media', 'object', 'xmlhttprequest', 'other',
+)
+EXTENSIONS = {
+    'stylesheet': ('css',),
+    'script': ('js',),
+    'image': ('png', 'jpg', 'jpeg', 'gif', 'webp', 'svg', 'ico', 'bmp'),
+    'font': ('woff', 'woff2', 'ttf', 'otf', 'eot'),
+    'media': ('mp4', 'webm', 'ogg', 'mp3', 'wav', 'flv', 'm4a'),
+    'object': ('swf',),
+}
+_EXTENSION_TYPES = dict(
+    (ext, rtype) for rtype, exts in EXTENSIONS.items() for ext in exts)
+# second level domains under which the registrable domains have 3 labels
+_SHORT_SLDS = ('co', 'com', 'net', 'org', 'gov', 'edu', 'ac', 'ne', 'or')
+# python 2 'sre' does not support more than 100 groups per expression
+_MAX_GROUPS = 90
+# inline global flags and back references (by number or name)
+_UNCOMBINABLE_RE = re.compile(r'\(\?[aiLmsux]+\)|\\[1-9]|\(\?P=')
+# words of the urls and filters, indexing the filters
+_TOKEN_RE = re.compile(r'[a-z0-9%]+')
+
+
+def guess_resource_type(url, accept=None, subdocument=False):
+    """
+    Guess the type of the resource requested (see L{RESOURCE_TYPES}) from
+    the url extension and the request C{Accept} header.
+    """
+    path = urlparse.urlsplit(url).path
+    ext = path.rsplit('.', 1)[-1].lower() if '.' in path.rsplit('/', 1)[-1] else ''
+    rtype = _EXTENSION_TYPES.get(ext)
+    if rtype:
+        return rtype
+    if accept:
+        accept = accept.lower()
+        if accept.startswith('text/html') or 'application/xhtml' in accept:
+            return 'subdocument' if subdocument else 'document'
+        if accept.startswith('text/css'):
+            return 'stylesheet'
+        if accept.startswith('image/'):
+            return 'image'
+    return 'other'
+
+
+def base_domain(host):
+    """Approximate registrable domain of a host, eg: 'example.co.uk'."""
+    labels = host.lower().rstrip('.').split('.')
+    if len(labels) > 2 and labels[-2] in _SHORT_SLDS and len(labels[-1]) == 2:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+class Rule(object):
+    """
+    A blocking rule (or an exception to the blocking rules).
+
+    @param text: the rule source, for display.
+    @param resource_types: types the rule applies to (all if None).
+    @param exclude_types: types the rule does not apply to.
+    @param third_party: if not None, only apply to third party requests
+                        (True) or to first party ones (False).
+    @param domains: only apply to the pages of these domains.
+    @param exclude_domains: do not apply to the pages of these domains.
+    @param exception: the rule unblocks the requests it matches.
+    """
+
+    def __init__(self, text, resource_types=None, exclude_types=None,
+                 third_party=None, domains=None, exclude_domains=None,
+                 exception=False):
+        self.text = text
+        self.resource_types = resource_types and frozenset(resource_types)
+        self.exclude_types = exclude_types and frozenset(exclude_types)
+        self.third_party = third_party
+        self.domains = domains and tuple(d.lower() for d in domains)
+        self.exclude_domains = exclude_domains and tuple(
+            d.lower() for d in exclude_domains)
+        self.exception = exception
+        self.hits = 0
+
+    def applies(self, resource_type, third_party, page_host):
+        """Check the rule conditions for a request."""
+        if self.resource_types and resource_type not in self.resource_types:
+            return False
+        if self.exclude_types and resource_type in self.exclude_types:
+            return False
+        if self.third_party is not None and third_party != self.third_party:
+            return False
+        if self.domains and not _host_in(page_host, self.domains):
+            return False
+        if self.exclude_domains and _host_in(page_host, self.exclude_domains):
+            return False
+        return True
+
+    def __repr__(self):
+        return "<Rule %s (%d hits)>" % (self.text, self.hits)
+
+
+def _host_in(host, domains):
+    return any(host == d or host.endswith('.' + d) for d in domains)
+
+
+class DomainTrie(object):
+    """Rules by domain: a rule for 'example.com' matches its subdomains."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, domain, rule):
+        node = self._root
+        for label in reversed(domain.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(rule)
+
+    def match(self, host):
+        """Return the rules of the host and of its parent domains."""
+        rules = []
+        node = self._root
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            if None in node:
+                rules.extend(node[None])
+        return rules
+
+
+def _combinable(regex):
+    """
+    True if a compiled regex can be a group of an alternation: its inline
+    flags would apply to the whole alternation (or be an error), and its
+    back references would point to other groups.
+    """
+    if _UNCOMBINABLE_RE.search(regex.pattern):
+        return False
+    try:
+        re.compile('(?:)|(?P<r0>%s)' % regex.pattern, regex.flags)
+    except (re.error, OverflowError):
+        return False
+    return True
+
+
+class RegexSet(object):
+    """
+    Url patterns: the ones with a token (a word which is in all the
+    matching urls) are indexed by it, the others compiled in a few
+    alternations of named groups, unless they can not be part of one
+    (inline flags, back references): those are tried one by one.
+    """
+
+    def __init__(self):
+        self._rules = []
+        self._isolated = []
+        self._tokens = {}
+        self._compiled = None
+
+    def __len__(self):
+        return (len(self._rules) + len(self._isolated)
+                + sum(len(r) for r in self._tokens.values()))
+
+    def add(self, regex, rule, token=None, flags=0):
+        rule.regex = re.compile(regex, flags)
+        if token:
+            self._tokens.setdefault(token, []).append(rule)
+        elif not _combinable(rule.regex):
+            self._isolated.append(rule)
+        else:
+            self._rules.append(rule)
+            self._compiled = None
+
+    def _compile(self):
+        # the rules compiled with the same flags are combined together
+        by_flags = collections.OrderedDict()
+        for index, rule in enumerate(self._rules):
+            by_flags.setdefault(rule.regex.flags, []).append(index)
+        compiled = []
+        for flags, indexes in by_flags.items():
+            parts, groups = [], 0
+            for index in indexes:
+                regex = self._rules[index].regex
+                ngroups = regex.groups + 1
+                if parts and groups + ngroups > _MAX_GROUPS:
+                    compiled.append(re.compile('|'.join(parts), flags))
+                    parts, groups = [], 0
+                parts.append('(?P<r%d>%s)' % (index, regex.pattern))
+                groups += ngroups
+            if parts:
+                compiled.append(re.compile('|'.join(parts), flags))
+        self._compiled = compiled
+
+    def find(self, url, tokens, check):
+        """
+        Return the first rule matching the url for which C{check(rule)}
+        is true, None if there is none.
+        """
+        for token in tokens:
+            for rule in self._tokens.get(token, ()):
+                if rule.regex.search(url) and check(rule):
+                    return rule
+        for rule in self._isolated:
+            if rule.regex.search(url) and check(rule):
+                return rule
+        if not self._rules:
+            return None
+        if self._compiled is None:
+            self._compile()
+        for regex in self._compiled:
+            m = regex.search(url)
+            if m is not None:
+                rule = self._rules[int(m.lastgroup[1:])]
+                if check(rule):
+                    return rule
+                # another rule matching the url may apply (slow path)
+                for rule in self._rules:
+                    if rule.regex.search(url) and check(rule):
+                        return rule
+                return None
+
+
+class RuleSet(object):
+    """Blocking rules and exceptions, see the module documentation."""
+
+    def __init__(self):
+        self.rules = []
+        self._domains = DomainTrie()
+        self._exception_domains = DomainTrie()
+        self._regexes = RegexSet()
+        self._exception_regexes = RegexSet()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _add(self, rule):
+        self.rules.append(rule)
+        return rule
+
+    def add_domain(self, domain, **conditions):
+        """Block a domain and its subdomains, see L{Rule} for the conditions."""
+        rule = self._add(Rule(domain, **conditions))
+        if rule.exception:
+            self._exception_domains.add(domain, rule)
+        else:
+            self._domains.add(domain, rule)
+        return rule
+
+    def add_regex(self, regex, text=None, token=None, flags=0, **conditions):
+        """
+        Block the urls matching a regex, see L{Rule} for the conditions.
+
+        @param token: lowercase word (see L{_TOKEN_RE}) which is in all the
+                      urls matched by the regex, to index the rule.
+        @param flags: flags to compile the regex with, eg: C{re.IGNORECASE}.
+        """
+        rule = self._add(Rule(text or regex, **conditions))
+        if rule.exception:
+            self._exception_regexes.add(regex, rule, token, flags)
+        else:
+            self._regexes.add(regex, rule, token, flags)
+        return rule
+
+    def add_filter(self, line):
+        """
+        Add an adblock filter line, return its rule or None if it is not
+        supported (comments, element hiding, unknown options).
+        """
+        line = line.strip()
+        if (not line or line.startswith(('!', '['))
+            or '##' in line or '#@#' in line or '#?#' in line):
+            return None
+        text = line
+        conditions = {}
+        if line.startswith('@@'):
+            conditions['exception'] = True
+            line = line[2:]
+        if '$' in line and not line.endswith('/'):
+            line, options = line.rsplit('$', 1)
+            if not _parse_options(options, conditions):
+                return None
+        m = re.match(r'^\|\|([a-z0-9.\-]+)\^?$', line, re.I)
+        if m:
+            rule = self.add_domain(m.group(1), **conditions)
+            rule.text = text
+            return rule
+        token = None
+        if len(line) > 1 and line.startswith('/') and line.endswith('/'):
+            regex = line[1:-1]
+        else:
+            regex = _filter_to_regex(line)
+            token = _filter_token(line)
+        # the filters are case insensitive, unless they have match-case
+        flags = 0 if conditions.pop('match_case', False) else re.IGNORECASE
+        try:
+            return self.add_regex(regex, text=text, token=token, flags=flags,
+                                  **conditions)
+        except re.error:
+            return None
+
+    def load_adblock(self, lines):
+        """Add the filters of an adblock list (a file or lines), return how many were added."""
+        if isinstance(lines, six.string_types):
+            lines = lines.splitlines()
+        count = 0
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            if self.add_filter(line) is not None:
+                count += 1
+        return count
+
+    def _find(self, domains, regexes, url, host, tokens, check):
+        for rule in domains.match(host):
+            if check(rule):
+                return rule
+        return regexes.find(url, tokens, check)
+
+    def match(self, url, resource_type='other', first_party_url=None):
+        """
+        Return the rule blocking a request, None if it is not blocked.
+        The hits of the matching rule (or exception) are counted.
+
+        @param resource_type: see L{guess_resource_type}.
+        @param first_party_url: url of the page making the request.
+        """
+        if not self.rules:
+            return None
+        host = (urlparse.urlsplit(url).hostname or '').lower()
+        page_host = ''
+        third_party = False
+        if first_party_url:
+            page_host = (urlparse.urlsplit(first_party_url).hostname or '').lower()
+            third_party = bool(host and page_host) and (
+                base_domain(host) != base_domain(page_host))
+        def check(rule):
+            return rule.applies(resource_type, third_party, page_host)
+        tokens = set(_TOKEN_RE.findall(url.lower()))
+        rule = self._find(self._domains, self._regexes, url, host, tokens, check)
+        if rule is None:
+            return None
+        exception = self._find(self._exception_domains, self._exception_regexes,
+                               url, host, tokens, check)
+        if exception is not None:
+            exception.hits += 1
+            return None
+        rule.hits += 1
+        return rule
+
+    def stats(self):
+        """Return the rules which were hit, the most hit first."""
+        return sorted([rule for rule in self.rules if rule.hits],
+                      key=lambda rule: -rule.hits)
+
+    def reset_stats(self):
+        for rule in self.rules:
+            rule.hits = 0
+
+    def clear(self):
+        self.__init__()
+
+
+_OPTION_TYPES = {
+    'script': 'script', 'image': 'image', 'stylesheet': 'stylesheet',
+    'object': 'object', 'xmlhttprequest': 'xmlhttprequest',
+    'subdocument': 'subdocument', 'document': 'document', 'font': 'font',
+    'media': 'media', 'other': 'other', 'object-subrequest': 'object',
+}
+
+
+def _parse_options(options, conditions):
+    """Parse adblock filter options into L{Rule} conditions, False if unsupported."""
+    types, exclude_types = [], []
+    for option in options.split(','):
+        option = option.strip().lower()
+        negated = option.startswith('~')
+        name = option.lstrip('~')
+        if name in _OPTION_TYPES:
+            (exclude_types if negated else types).append(_OPTION_TYPES[name])
+        elif name == 'third-party':
+            conditions['third_party'] = not negated
+        elif name.startswith('domain='):
+            domains = name[len('domain='):].split('|')
+            conditions['domains'] = [d for d in domains if not d.startswith('~')]
+            conditions['exclude_domains'] = [
+                d[1:] for d in domains if d.startswith('~')]
+        elif name == 'match-case':
+            conditions['match_case'] = not negated
+        elif name == 'collapse':
+            continue
+        else:
+            return False
+    if types:
+        conditions['resource_types'] = types
+    if exclude_types:
+        conditions['exclude_types'] = exclude_types
+    return True
+
+
+def _filter_token(pattern):
+    """
+    Return the longest word of an adblock url pattern which is a whole word
+    of all the urls it matches (not next to a wildcard or a free end).
+    """
+    lower = pattern.lower()
+    best = None
+    for m in _TOKEN_RE.finditer(lower):
+        start, end = m.span()
+        if start == 0 or lower[start - 1] == '*':
+            continue
+        if lower[start - 1] == '|' and start > 2:
+            continue
+        if end == len(lower) or lower[end] == '*':
+            continue
+        if best is None or end - start > len(best):
+            best = m.group()
+    return best
+
+
+def _filter_to_regex(pattern):
+    """Translate an adblock url pattern into a regex."""
+    prefix, suffix = '', ''
+    if pattern.startswith('||'):
+        prefix = r'^[a-z][a-z0-9+.\-]*://(?:[^/?#]*\.)?'
+        pattern = pattern[2:]
+    elif pattern.startswith('|'):
+        prefix = '^'
+        pattern = pattern[1:]
+    if pattern.endswith('|'):
+        suffix = '$'
+        pattern = pattern[:-1]
+    regex = re.escape(pattern)
+    regex = regex.replace(r'\*', '.*').replace(r'\^', r'(?:[^\w\-.%]|$)')
+    return prefix + regex + suffix
@@ -18,55 +18,196 @@
 Spynner is a stateful programmatic web-browser module for Python with
 Javascript/AJAX support. It is build upon the PyQtWebKit framework.
 """
+import time
+_IMPORT_START = time.time()
 
-
+import collections
+import contextlib
+import functools
+import hashlib
 import itertools
+import json
+import mimetypes
 import six
 from six.moves import http_cookiejar as cookielib
 import tempfile
+import traceback
+import weakref
 from pprint import pprint
 from six.moves.urllib import parse as urlparse
 from six.moves import urllib as urllib2
-import time
+import importlib
 import sys
 import re
 import os
 from six import BytesIO as StringIO
 
-import pkg_resources
-import autopy
+from spynner.blocking import RuleSet, guess_resource_type
 
 try:
     from PySide import QtCore
     QtCore.QString = str
     from PySide.QtCore import SIGNAL, QUrl, QString, Qt, QEvent
-    from PySide.QtCore import QSize, QDateTime, QPoint
+    from PySide.QtCore import QSize, QDateTime, QPoint, QEventLoop, QTimer
+    from PySide.QtCore import QIODevice, QBuffer, QObject
+    from PySide.QtCore import Slot
     from PySide.QtGui import QApplication, QImage, QPainter
     from PySide.QtGui import QCursor, QMouseEvent, QKeyEvent
     from PySide.QtNetwork import QNetworkCookie, QNetworkAccessManager, QSslConfiguration, QSslCipher
     from PySide.QtNetwork import QNetworkCookieJar, QNetworkRequest, QNetworkProxy, QSsl, QSslSocket
-    from PySide.QtWebKit import QWebPage, QWebView
+    from PySide.QtNetwork import QNetworkReply
+    from PySide.QtNetwork import QAbstractNetworkCache, QNetworkCacheMetaData
     HAS_PYSIDE = True
+    QT_API = 'PySide'
 except Exception as e:
     HAS_PYSIDE = False
     from PyQt4 import QtCore
     from PyQt4.QtCore import SIGNAL, QUrl, QString, Qt, QEvent
-    from PyQt4.QtCore import QSize, QDateTime, QPoint
+    from PyQt4.QtCore import QSize, QDateTime, QPoint, QEventLoop, QTimer
+    from PyQt4.QtCore import QIODevice, QBuffer, QObject
+    from PyQt4.QtCore import pyqtSlot as Slot
     from PyQt4.QtGui import QApplication, QImage, QPainter
     from PyQt4.QtGui import QCursor, QMouseEvent, QKeyEvent
     from PyQt4.QtNetwork import QNetworkCookie, QNetworkAccessManager, QSslConfiguration, QSslCipher
     from PyQt4.QtNetwork import QNetworkCookieJar, QNetworkRequest, QNetworkProxy, QSsl, QSslSocket
-    from PyQt4.QtWebKit import QWebPage, QWebView
-    from PyQt4.QtWebKit import QWebInspector
+    from PyQt4.QtNetwork import QNetworkReply
+    from PyQt4.QtNetwork import QAbstractNetworkCache, QNetworkCacheMetaData
+    QT_API = 'PyQt4'
+
+
+class _LazyName(object):
+    """
+    Stand-in for a class of a module which is imported on first use:
+    attributes, calls, C{isinstance}, C{issubclass} and subclassing are
+    forwarded to the class.
+    """
+
+    def __new__(cls, *args):
+        if len(args) == 3:
+            # class statement with a lazy base on python < 3.7, which
+            # calls the metaclass of the first base, ie: this class
+            name, bases, namespace = args
+            bases = tuple(_resolve_base(base) for base in bases)
+            return type(bases[0])(name, bases, namespace)
+        return object.__new__(cls)
+
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+        self._object = None
+
+    def _resolve(self):
+        if self._object is None:
+            module = importlib.import_module(self._module)
+            self._object = getattr(module, self._name)
+        return self._object
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __instancecheck__(self, obj):
+        return isinstance(obj, self._resolve())
+
+    def __subclasscheck__(self, cls):
+        return issubclass(cls, self._resolve())
+
+    def __mro_entries__(self, bases):
+        return (self._resolve(),)
+
+    def __repr__(self):
+        return "<lazy %s.%s>" % (self._module, self._name)
+
+
+def _resolve_base(base):
+    if isinstance(base, _LazyName):
+        return base._resolve()
+    return base
+
+
+# QtWebKit is the slowest Qt module to load, import it with the first browser
+QWebPage = _LazyName(QT_API + '.QtWebKit', 'QWebPage')
+QWebView = _LazyName(QT_API + '.QtWebKit', 'QWebView')
+QWebSettings = _LazyName(QT_API + '.QtWebKit', 'QWebSettings')
+QWebDatabase = _LazyName(QT_API + '.QtWebKit', 'QWebDatabase')
+QWebInspector = _LazyName(QT_API + '.QtWebKit', 'QWebInspector')
+
+
+def _get_autopy():
+    """Import autopy on first use, return None if it is not installed."""
+    global _autopy
+    if _autopy is _marker:
+        try:
+            import autopy as _autopy
+        except ImportError:
+            _autopy = None
+    return _autopy
 
 
 SpynnerQapplication = None
 
+# Process wide cache of the javascript files and of the bundles injected in
+# the frames (see Browser.load_js)
+_js_files = {}
+_js_bundles = {}
+
+# Browsers of the process, the memory caches are shared by all of them
+_browsers = weakref.WeakSet()
+
+# Cold start measures, seconds elapsed since the start of the spynner import
+# when it was done ('import'), when the first browser was built ('browser')
+# and when the first page load returned ('first_load').
+startup_times = {}
 
 # Debug levels
 ERROR, WARNING, INFO, DEBUG = range(4)
 argv = ['dummy']
 _marker = []
+_autopy = _marker
+
+# event (or console message without the bridge) sent by the injected DOM
+# watcher (see Browser._watch_dom)
+DOM_CHANGED_MESSAGE = u'spynner:dom-changed'
+DOM_WATCH_JS = """
+(function() {
+    if (window.spynner_dom_watch) { return; }
+    window.spynner_dom_watch = 1;
+    var pending = false;
+    function changed() {
+        if (pending) { return; }
+        pending = true;
+        setTimeout(function() {
+            pending = false;
+            if (window.spynner_bridge) {
+                spynner_bridge.post('%s', 'null');
+            } else {
+                console.log('%s');
+            }
+        }, 0);
+    }
+    var Observer = window.MutationObserver || window.WebKitMutationObserver;
+    if (Observer) {
+        new Observer(changed).observe(document, {
+            childList: true, subtree: true,
+            attributes: true, characterData: true});
+    } else {
+        document.addEventListener('DOMSubtreeModified', changed, true);
+    }
+})();
+""" % (DOM_CHANGED_MESSAGE, DOM_CHANGED_MESSAGE)
+# name of the Python bridge object in the pages (see Browser.on_js_event)
+JS_BRIDGE_NAME = 'spynner_bridge'
+JS_BRIDGE_JS = """
+window.spynner_emit = function(name, data) {
+    spynner_bridge.post(name, JSON.stringify(data === undefined ? null : data));
+};
+"""
+IS_VISIBLE_JS = (
+    "(this.offsetWidth || this.offsetHeight || this.getClientRects().length)"
+    " && window.getComputedStyle(this).visibility != 'hidden'"
+    " ? 'visible' : 'hidden'")
 
 
 class Browser(object):
@@ -76,7 +217,7 @@ class Browser(object):
     errorCode = None
     errorMessage = None
     _javascript_directories = [
-        pkg_resources.resource_filename('spynner', 'javascript'),
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'javascript'),
     ]
     _jquery = 'jquery-1.5.2.js'
     _jquery_simulate = 'jquery.simulate.js'
@@ -98,6 +239,11 @@ class Browser(object):
                  ssl_protocol=None,
                  ssl_ciphers = None,
                  inspector=False,
+                 settle_timeout=0.5,
+                 settle_quiet=0.05,
+                 headless=False,
+                 inject_early=False,
+                 js_bridge=False,
                 ):
         """
         Init a Browser instance.
@@ -107,7 +253,8 @@ class Browser(object):
         @param jslib:  IF True: Use jQuery.noConflict to "jslib", else just use '$'
         @param download_directory:  Directory where downloaded files will be stored.
         @param user_agent User agent for requests (see QWebPage::userAgentForUrl for details)
-        @param event_looptime Event loop dispatcher loop delay (seconds).
+        @param event_looptime Time (seconds) the events loop runs on each
+                              bare L{_events_loop} call.
         @apram ignore_ssl_errors  If True, ignore SSL certificate errors.
         @param debug_stream  File-like stream where debug output will be written.
         @param headers (list of tuple) http headers to send with every request
@@ -119,6 +266,25 @@ class Browser(object):
                 QSsl.AnyProtocol
                 QSsl.TlsV1SslV3
                 QSsl.SecureProtocols
+        @param settle_timeout Maximum time (seconds) to wait for the effects
+                              of a click to be done (see L{settle}).
+        @param settle_quiet Time (seconds) without any activity after which
+                            a click is considered done (see L{settle}).
+        @param headless If True, there is no webview and the mouse and
+                        keyboard input is synthetic (sent to the page, see
+                        L{synthetic_input}). The Qt offscreen platform is
+                        used by the builds supporting it, the X11 builds of
+                        Qt 4 still need a display, eg: Xvfb. As for the
+                        QApplication, only the first browser of a process
+                        decides it.
+        @param inject_early If True, inject the javascript (jQuery, ...) in
+                            each frame as soon as its new document is
+                            created, before the page scripts run, instead
+                            of when the page is loaded.
+        @param js_bridge If True, expose the Python bridge object to the
+                         page scripts (see L{on_js_event}), which is
+                         otherwise done on the first L{on_js_event} or
+                         L{wait_for_js_event} call.
 
         Important vars:
 
@@ -126,8 +292,14 @@ class Browser(object):
             - self.application : QApplication object
             - self.webframe: active QWebFrame object
             - self.manager: QNetworkAccessManager object
-            - self.files: represent a list of dicts tracking downloaded files where the download key
-              is the path, each entry is in the form {'reply': replyobj, 'req': reqobj}
+            - self.downloads: L{DownloadRegistry} of the downloads
+            - self.files: list of the (path, {'reply': replyobj, 'finished': bool})
+              downloaded files, built from L{downloads} (compatibility)
+            - self.replies: L{ReplyRegistry} of the finished replies
+            - self.blocking: L{spynner.blocking.RuleSet} of the requests
+              blocking rules
+            - self.cache: L{spynner.cache.NetworkCache} if a disk cache is
+              used (see L{set_cache})
         """
         self.download_directory = download_directory
         import spynner
@@ -144,8 +316,10 @@ class Browser(object):
             ):
                 ciphers.append(cip)
         self.sslconf.setCiphers(ciphers)
+        self.headless = headless
+        self._synthetic_input = None
         if not spynner.SpynnerQapplication:
-            spynner.SpynnerQapplication = QApplication(spynner.argv)
+            spynner.SpynnerQapplication = _new_application(spynner.argv, headless)
         self.application = spynner.SpynnerQapplication
         self.want_compat = want_compat
         self.embed_jquery = embed_jquery
@@ -166,7 +340,16 @@ class Browser(object):
         self.additional_js_files = additional_js_files
         self.additional_js = ""
         self.event_looptime = event_looptime
+        self.settle_timeout = settle_timeout
+        self.settle_quiet = settle_quiet
+        self.settle_time = None
         self.ignore_ssl_errors = ignore_ssl_errors
+        self.scheduler = HostScheduler()
+        self.blocking = RuleSet()
+        self.cache = None
+        self._cache_control = None
+        self.recorder = None
+        self.archive = None
         """PyQt4.QtWebKit.QWebPage object."""
         wp = self.webpage = QWebPage()
         # Network Access Manager and cookies
@@ -189,26 +372,38 @@ class Browser(object):
         self.webview = None
         """PyQt4.QtWebKit.QWebView object."""
         self._url_filter = None
+        # [(pattern, compiled regex, handler)], see route
+        self._routes = []
         self._webframe = None
         self._html_parser = None
-        self.files = []
+        self.downloads = DownloadRegistry()
+        self.tabs = []
         # Javascript
         directory = _first(self._javascript_directories, os.path.isdir)
         if not directory:
             raise SpynnerError("Cannot find javascript directory: %s" %
                 self._javascript_directories)
-        self.jquery = open(os.path.join(directory, self._jquery)).read()
-        self.jquery_simulate = open(os.path.join(directory, self._jquery_simulate)).read()
+        self._javascript_directory = directory
         for fn in self.additional_js_files:
             if not os.path.exists(fn):
                 fn = os.path.join(directory, fn)
-            self.additional_js += "\n%s" % open(fn).read()
+            self.additional_js += "\n%s" % _read_js(fn)
+        # frame -> guard of the bundle injected in its current document
+        self._js_frames = {}
+        self.inject_early = inject_early
+        self.bridge = JavascriptBridge(self)
+        self.js_bridge = js_bridge
+        self._js_events = collections.deque(maxlen=1000)
+        self._js_events_seq = 0
+        self._js_callbacks = {}
         wp.javaScriptAlert = self._javascript_alert
         wp.javaScriptConsoleMessage = self._javascript_console_message
         wp.javaScriptConfirm = self._javascript_confirm
         wp.javaScriptPrompt = self._javascript_prompt
         self._javascript_confirm_callback = None
         self._javascript_confirm_prompt = None
+        self._javascript_prompt_callback = None
+        self._http_authentication_callback = None
         """PyQt4.QtNetwork.QNetworkCookieJar object."""
         self.cookies = []
         mngr.sslErrors.connect(self._on_manager_ssl_errors)
@@ -225,16 +420,35 @@ class Browser(object):
                 del self._operation_names[i]
         # Webpage slots
         self._load_status = None
-        self._replies = 0
+        self.replies = ReplyRegistry()
+        self._replies_mark = 0
+        self._reply_url = None
+        self._reply_status = None
+        self._event_loops = []
+        self._listeners = []
+        self._deadlines = []
+        self._active_downloads = set()
+        # proxy url -> network manager, the least recently used first
+        self._download_managers = collections.OrderedDict()
+        self.max_download_managers = 4
+        # origins of the documents loaded by the browser and its tabs
+        self._origins = set()
+        self._wakeups = 0
+        self._dom_changes = 0
+        self._loads_started = 0
         wp.setForwardUnsupportedContent(True)
         wp.unsupportedContent.connect(
             self._on_unsupported_content)
         wp.loadFinished.connect(self._on_load_finished)
         wp.loadStarted.connect(self._on_load_started)
+        wp.frameCreated.connect(self._hook_frame)
+        self._hook_frame(wp.mainFrame())
         if inspector:
             self.inspector = QWebInspector()
             self.inspector.setPage(self.webpage)
             self.inspector.setVisible(True)
+        _browsers.add(self)
+        startup_times.setdefault('browser', time.time() - _IMPORT_START)
 
     @property
     def webframe(self):
@@ -246,12 +460,164 @@ class Browser(object):
     def _events_loop(self, wait=None):
         if wait is None:
             wait = self.event_looptime
+        if wait:
+            self._wait_for(lambda: False, timeout=wait)
+        else:
+            self.application.processEvents()
+
+    def _wait_for(self, condition, timeout=None, interval=None):
+        """
+        Run the Qt events loop until C{condition()} is true.
+
+        Instead of polling, this sleeps in a nested QEventLoop which is woken
+        up by L{_notify} (page load, request sent, finished reply, finished
+        download) or by a QTimer when C{timeout} (seconds) is reached.
+
+        @param condition: callable without arguments.
+        @param timeout: seconds to wait, None to wait forever.
+        @param interval: also check the condition every C{interval} seconds,
+                         for conditions depending on the elapsed time.
+        @return: the last value of C{condition()} (false on timeout).
+        """
         self.application.processEvents()
-        time.sleep(wait)
+        wakeups = self._wakeups
+        result = condition()
+        if result:
+            return result
+        self._check_deadlines()
+        timeout, deadline = self._deadline_timeout(timeout)
+        loop = QEventLoop()
+        timer = None
+        if timeout is not None:
+            timer = QTimer()
+            timer.setSingleShot(True)
+            timer.timeout.connect(loop.quit)
+            timer.start(max(0, int(timeout * 1000)))
+        ticker = None
+        if interval:
+            ticker = QTimer()
+            ticker.timeout.connect(loop.quit)
+            ticker.start(max(1, int(interval * 1000)))
+        self._event_loops.append(loop)
+        try:
+            while not result:
+                if timer is not None and not timer.isActive():
+                    break
+                if self._expired_deadline() is not None:
+                    break
+                # a wake up may have been sent while evaluating the
+                # condition, in that case check it again before sleeping.
+                if wakeups == self._wakeups:
+                    loop.exec_()
+                wakeups = self._wakeups
+                result = condition()
+        finally:
+            self._event_loops.remove(loop)
+            if timer is not None:
+                timer.stop()
+            if ticker is not None:
+                ticker.stop()
+        if not result:
+            self._check_deadlines(deadline)
+        return result
+
+    @contextlib.contextmanager
+    def deadline(self, timeout=None, deadline=None):
+        """
+        Give a wall-clock budget to all the browser operations run in the
+        C{with} block.
+
+        When the deadline expires (or is cancelled), the requests in flight
+        are aborted, the page load is stopped and the pending wait raises
+        L{SpynnerDeadlineExceeded}. Nested deadlines are all enforced.
+
+        @param timeout: seconds of the budget.
+        @param deadline: an existing L{Deadline} to share between browsers
+                         or jobs (C{timeout} is then ignored).
+
+        >>> with br.deadline(30) as deadline:
+        ...     br.load(url)
+        ...     br.click('#next', wait_load=True)
+        """
+        if deadline is None:
+            deadline = Deadline(timeout)
+        deadline._browsers.append(self)
+        self._deadlines.append(deadline)
+        try:
+            yield deadline
+        finally:
+            self._deadlines.remove(deadline)
+            deadline._browsers.remove(self)
+
+    def _expired_deadline(self):
+        for deadline in self._deadlines:
+            if deadline.expired:
+                return deadline
+
+    def _deadline_timeout(self, timeout=None):
+        """
+        Return C{timeout} shortened to fit in the active deadlines, and the
+        deadline which shortened it if any.
+        """
+        bound = None
+        for deadline in self._deadlines:
+            remaining = deadline.remaining()
+            if remaining is not None and (timeout is None or remaining < timeout):
+                timeout, bound = remaining, deadline
+        return timeout, bound
+
+    def _check_deadlines(self, deadline=None):
+        """
+        Abort everything and raise if a deadline expired.
+
+        @param deadline: deadline to consider as expired (the wait it bounded
+                         timed out).
+        """
+        if deadline is None:
+            deadline = self._expired_deadline()
+        if deadline is None:
+            return
+        self.abort()
+        if deadline.cancelled:
+            raise SpynnerDeadlineExceeded("Operation cancelled")
+        raise SpynnerDeadlineExceeded(
+            "Deadline reached: %s seconds" % deadline.timeout)
+
+    def abort(self):
+        """Stop the page load and abort the requests and downloads in flight."""
+        self._debug(WARNING, "Aborting page load and requests in flight")
+        self.webpage.triggerAction(QWebPage.Stop)
+        for reply in list(self.replies._started) + list(self._active_downloads):
+            if not reply.isFinished():
+                reply.abort()
+
+    def _notify(self, *args):
+        """Wake up the events loops waiting in L{_wait_for} and the
+        listeners (see L{spynner.aio.AsyncBrowser})."""
+        self._wakeups += 1
+        for loop in self._event_loops:
+            loop.quit()
+        for listener in self._listeners:
+            listener()
+
+    def _record_cache(self, reply):
+        if isinstance(reply, StaticReply):
+            # served from memory (blocked, routed, replayed), not a request
+            # the disk cache could have answered
+            return
+        from_cache = reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute)
+        if hasattr(from_cache, 'toBool'):
+            from_cache = from_cache.toBool()
+        length = reply.header(QNetworkRequest.ContentLengthHeader)
+        if hasattr(length, 'toLongLong'):
+            length = length.toLongLong()[0]
+        self.cache.store.record(bool(from_cache), length or 0)
 
     def _on_load_started(self):
         self._load_status = None
+        self._loads_started += 1
         self._debug(INFO, "Page load started")
+        self._notify()
 
     def _on_manager_ssl_errors(self, reply, errors):
         url = six.u(toString(reply.url()))
@@ -279,7 +645,6 @@ class Browser(object):
             self._debug(WARNING, "HTTP auth callback returned no credentials")
 
     def _on_reply(self, reply):
-        self._replies += 1
         self._reply_url = six.u(toString(reply.url()))
         self._reply_status = not bool(reply.error())
         self.cookies = merge_cookies(
@@ -292,7 +657,13 @@ class Browser(object):
                 reply.attribute(QNetworkRequest.HttpReasonPhraseAttribute))
         except:
             http_status_m, http_status = "", ""
-
+        self.replies.finish(
+            reply, self._reply_url, self._reply_status,
+            http_status=http_status,
+            error=reply.error(),
+            operation=self._operation_names.get(reply.operation()))
+        if self.cache is not None:
+            self._record_cache(reply)
 
         if reply.error():
             self._debug(WARNING, "Reply error: %s/%s %s - %d (%s)" %
@@ -305,6 +676,7 @@ class Browser(object):
                 http_status, http_status_m, self._reply_url))
         for header in reply.rawHeaderList():
             self._debug(DEBUG, "  %s: %s" % (header, reply.rawHeader(header)))
+        self._notify()
 
     def _on_unsupported_content(self, reply, outfd=None):
         if not reply.error():
@@ -318,6 +690,10 @@ class Browser(object):
             QWebPage.javaScriptAlert(self.webpage, webframe, message)
 
     def _javascript_console_message(self, message, line, sourceid):
+        if u"%s" % message == DOM_CHANGED_MESSAGE:
+            self._dom_changes += 1
+            self._notify()
+            return
         if line:
             self._debug(INFO, "Javascript console (%s:%d): %s" %
                 (sourceid, line, message))
@@ -325,34 +701,43 @@ class Browser(object):
             self._debug(INFO, "Javascript console: %s" % message)
 
     def _javascript_confirm(self, webframe, message):
+        return self._confirm(self.webpage, self._javascript_confirm_callback,
+                             webframe, message)
+
+    def _confirm(self, webpage, callback, webframe, message):
         smessage = six.u(message)
         url = webframe.url()
         self._debug(INFO, "Javascript confirm (webframe url = %s): %s" %
             (url, smessage))
-        if self._javascript_confirm_callback:
-            value = self._javascript_confirm_callback(url, smessage)
+        if callback:
+            value = callback(url, smessage)
             self._debug(INFO, "Javascript confirm callback returned %s" % value)
             return value
-        return QWebPage.javaScriptConfirm(self.webpage, webframe, message)
+        return QWebPage.javaScriptConfirm(webpage, webframe, message)
 
     def _javascript_prompt(self, webframe, message, defaultvalue, result):
+        return self._prompt(self.webpage, self._javascript_prompt_callback,
+                            webframe, message, defaultvalue, result)
+
+    def _prompt(self, webpage, callback, webframe, message, defaultvalue, result):
         url = webframe.url()
         smessage = six.u(message)
         self._debug(INFO, "Javascript prompt (webframe url = %s): %s" %
             (url, smessage))
-        if self._javascript_prompt_callback:
-            value = self._javascript_prompt_callback(url, smessage, defaultvalue)
+        if callback:
+            value = callback(url, smessage, defaultvalue)
             self._debug(INFO, "Javascript prompt callback returned: %s" % value)
             if value in (False, None):
                 return False
             result.clear()
             result.append(value)
             return True
-        return QWebPage.javaScriptPrompt(self.webpage, webframe, message,
+        return QWebPage.javaScriptPrompt(webpage, webframe, message,
             defaultvalue, result)
 
     def _on_webview_destroyed(self, window):
         self.webview = None
+        self._notify()
 
     def _on_load_finished(self, successful):
         if hasattr(self, "webpage"):
@@ -361,6 +746,7 @@ class Browser(object):
         status = {True: "successful", False: "error"}[successful]
         self._debug(INFO, "Page load finished (%d bytes): %s (%s)" %
             (len(self.html), self.url, status))
+        self._notify()
 
     def _get_filepath_for_url(self, url, reply=None):
         urlinfo = urlparse.urlsplit(url)
@@ -383,46 +769,98 @@ class Browser(object):
             raise SpynnerError('Download mode is unknown, can\'t determine the final filename')
         return path
 
-    def _start_download(self, reply, outfd):
+    def _start_download(self, reply, outfd, progress=None, entry=None):
         url = six.u(toString(reply.url()))
         path = None
         if outfd is None:
             path = self._get_filepath_for_url(url, reply)
             outfd = open(path, "wb")
-        def _on_ready_read():
-            data = reply.readAll()
+        reply.download_finished = False
+        offset = getattr(reply, 'download_offset', 0)
+        started = time.time()
+        entry_path = path or getattr(reply, 'download_path', None)
+        if entry is None:
+            entry = self.downloads.add(url, path=entry_path, reply=reply)
+        else:
+            self.downloads.attach(entry, url, path=entry_path, reply=reply)
+        reply.download_entry = entry
+        def _on_meta_data_changed():
+            status = _http_status(reply)
+            total = None
+            content_range = _text_header(reply, 'Content-Range')
+            if content_range and '/' in content_range:
+                total = content_range.rsplit('/', 1)[1].strip()
+                total = int(total) if total.isdigit() else None
+            if reply.download_offset and status != 206:
+                reply.download_discard = status == 416
+                if not reply.download_discard:
+                    # the server did not resume, the whole content follows
+                    self._debug(INFO, "Download not resumed: %s" % url)
+                    reply.download_offset = 0
+                    outfd.seek(0)
+                    outfd.truncate()
+            if total is None and reply.hasRawHeader(b'Content-Length'):
+                total = reply.download_offset + int(
+                    _text_header(reply, 'Content-Length'))
+            reply.download_total = total
+            resume_path = getattr(reply, 'download_resume', None)
+            if resume_path and not reply.download_discard and 200 <= (status or 0) < 300:
+                _write_resume_state(resume_path, {
+                    'url': url,
+                    'etag': _text_header(reply, 'ETag'),
+                    'last_modified': _text_header(reply, 'Last-Modified'),
+                    'total': total,
+                })
+        def _report():
+            if progress is None:
+                return
+            nbytes = reply.download_offset + reply.downloaded_nbytes
+            total = reply.download_total
+            elapsed = time.time() - started
+            rate = reply.downloaded_nbytes / elapsed if elapsed > 0 else 0.
+            eta = None
+            if total is not None and rate:
+                eta = max(total - nbytes, 0) / rate
+            progress(nbytes, total, rate, eta)
+        def _write(data):
             if six.PY3:
                 data = data.data()
             if getattr(reply, 'downloaded_nbytes', None) is None:
-                reply.downloaded_nbytes= 0
-            reply.downloaded_nbytes += len(data)
-            outfd.write(data)
+                reply.downloaded_nbytes = 0
+            if len(data) and not reply.download_discard:
+                reply.downloaded_nbytes += len(data)
+                outfd.write(data)
+            self.downloads.progress(
+                entry, reply.download_offset + reply.downloaded_nbytes,
+                reply.download_total)
+            return data
+        def _on_ready_read():
+            data = _write(reply.readAll())
             self._debug(DEBUG, "Read from download stream (%d bytes): %s"
                 % (len(data), url))
+            _report()
         def _on_network_error():
             self._debug(ERROR, "Network error on download: %s" % url)
         def _on_finished():
-            data = reply.readAll()
-            if six.PY3:
-                data = data.data()
-            if len(data):
-                if getattr(reply, 'downloaded_nbytes at end', None) is None:
-                    reply.downloaded_nbytes= 0
-                reply.downloaded_nbytes += len(data)
-                outfd.write(data)
+            data = _write(reply.readAll())
             self._debug(DEBUG, "Read from download stream at end (%d bytes): %s"
                 % (len(data), url))
             suf = ''
             if path is not None:
                 outfd.flush()
-                dict(self.files)[path]['finished'] = True
                 suf = ' in {0}'.format(path)
-            self._debug(INFO, "Download finished: {0}{1}".format(url, path))
-
-        if path is not None:
-            self.files.append((path, {'reply':reply,
-                                      'readed': False,
-                                      'finished':False,}))
+            self._debug(INFO, "Download finished: {0}{1}".format(url, suf))
+            _report()
+            self.downloads.finish(
+                entry, None if _already_downloaded(reply) else reply.error())
+            reply.download_finished = True
+            self._active_downloads.discard(reply)
+            self._notify()
+
+        reply.download_offset = offset
+        reply.download_total = None
+        reply.download_discard = False
+        reply.metaDataChanged.connect(_on_meta_data_changed)
         reply.readyRead.connect(_on_ready_read)
         reply.error.connect(_on_network_error)
         reply.finished.connect(_on_finished)
@@ -434,11 +872,13 @@ class Browser(object):
             load_status = self._load_status
             self._load_status = None
             return load_status
-        itime = time.time()
-        while self._load_status is None:
-            if timeout and time.time() - itime > timeout:
-                raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
-            self._events_loop()
+        if not self._wait_for(lambda: self._load_status is not None,
+                              timeout=timeout or None):
+            raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
+        return self._load_finished()
+
+    def _load_finished(self):
+        """Prepare a freshly loaded page and return (and reset) its load status."""
         self._events_loop(0.0)
         if self._load_status:
             self.load_js()
@@ -496,6 +936,22 @@ class Browser(object):
     soup = property(_get_soup)
     """HTML soup (see L{set_html_parser})."""
 
+    def _get_files(self):
+        return [(entry.path, {'reply': entry.reply,
+                              'readed': False,
+                              'finished': entry.done})
+                for entry in self.downloads if entry.path is not None]
+
+    def _set_files(self, files):
+        if files:
+            raise ValueError("The downloaded files can only be cleared")
+        self.downloads.clear()
+
+    files = property(_get_files, _set_files)
+    """(path, {'reply': reply, 'finished': bool}) of the downloaded files
+    still in L{downloads}, built on each access. Setting it to an empty
+    list clears L{downloads}."""
+
     def load(self,
              url,
              load_timeout=10,
@@ -503,7 +959,10 @@ class Browser(object):
              tries=None,
              operation=QNetworkAccessManager.GetOperation,
              body=None,
-             headers=None
+             headers=None,
+             wait_until=None,
+             idle_requests=0,
+             idle_time=0.5,
             ):
         """Load a web page and return status (a boolean).
         @param url url to open
@@ -521,6 +980,11 @@ class Browser(object):
         @param load_timeout timeout to load the page, or if you use wait_callback, time between retries
         @param wait_callback a callback to test if content is ready
         @param tries set to True for unlimited retries, to int for limited to tries, tries.
+        @param wait_until "load" (default) or "networkidle" to also wait for
+                          the network to be idle (see L{wait_network_idle}).
+        @param idle_requests in "networkidle" mode, number of requests which
+                             may still be in flight.
+        @param idle_time in "networkidle" mode, seconds the network must stay idle.
 
         eg:
 
@@ -535,7 +999,26 @@ class Browser(object):
             ...     return 'google' in b.html.lower()
             >>> br.load('http://www.google.fr', wait_callback=wait_load, tries=3)
 
+            Wait for the AJAX requests of the page to be done
+
+            >>> br.load('http://www.google.fr', wait_until='networkidle')
+
         """
+        self._check_wait_until(wait_until)
+        self._start_load(url, operation=operation, body=body, headers=headers)
+        if wait_callback is None:
+            ret = self._wait_load(timeout = load_timeout)
+        else:
+            ret = self.wait_for_content(wait_callback, tries=tries, delay=load_timeout)
+        if wait_until == 'networkidle':
+            self.wait_network_idle(idle_requests, idle_time, timeout=load_timeout)
+        startup_times.setdefault('first_load', time.time() - _IMPORT_START)
+        return ret
+
+    def _start_load(self, url,
+                    operation=QNetworkAccessManager.GetOperation,
+                    body=None, headers=None):
+        """Send the request to load a page, without waiting for it."""
         if not headers:
             headers = []
         if not body:
@@ -543,21 +1026,28 @@ class Browser(object):
         self._headers = self.headers[:]
         self._headers.extend(headers)
         req = self.make_request(url)
+        self._mark_replies()
         self.webframe.load(req, operation, body)
-        if wait_callback is None:
-            return self._wait_load(timeout = load_timeout)
-        else:
-            return self.wait_for_content(wait_callback, tries=tries, delay=load_timeout)
+
+    def _check_wait_until(self, wait_until):
+        if wait_until not in (None, 'load', 'networkidle'):
+            raise SpynnerError("Unknown wait_until mode: %s" % wait_until)
 
 
-    def make_request(self, url, operation="GET"):
+    def make_request(self, url, operation="GET", headers=None):
+        """
+        @param headers: (name, value) headers to set, default to the ones of
+                        the current page load.
+        """
         if operation:
             operation = ("%s" % operation).lower()
         if isinstance(url, six.string_types):
             url = QUrl(url)
         if not isinstance(url, QNetworkRequest):
             url = QNetworkRequest(url)
-        for header, value in self._headers:
+        if headers is None:
+            headers = self._headers
+        for header, value in headers:
             url.setRawHeader(header, value)
         url = self.apply_ssl(url)
         return url
@@ -592,10 +1082,198 @@ class Browser(object):
                 jscode += "var spynner_jquery_loaded = 1 ;"
                 self.runjs(jscode, debug=False)
 
-    def load_js(self):
-        self.load_jquery()
-        self.load_jquery_simulate()
-        self.load_additional_js()
+    @property
+    def jquery(self):
+        """jQuery source code."""
+        return _read_js(os.path.join(self._javascript_directory, self._jquery))
+
+    @property
+    def jquery_simulate(self):
+        """jQuery simulate source code."""
+        return _read_js(
+            os.path.join(self._javascript_directory, self._jquery_simulate))
+
+    def _js_bundle(self):
+        """
+        Return the javascript to inject in the frames (jQuery, simulate and
+        the additional files as configured) and its guard variable name.
+        The bundles are built once per process and configuration.
+        """
+        key = (self.embed_jquery, self.embed_jquery_simulate,
+               self.want_compat, self.jslib, self.additional_js)
+        bundle = _js_bundles.get(key)
+        if bundle is None:
+            parts = []
+            if self.embed_jquery:
+                parts.append(self.jquery)
+                if self.want_compat or (self.jslib != '$'):
+                    parts.append("var %s = jQuery.noConflict();" % self.jslib)
+                parts.append("var spynner_jquery_loaded = 1;")
+            if self.embed_jquery_simulate:
+                parts.append(self.jquery_simulate)
+                parts.append("var spynner_jquery_simulate_loaded = 1;")
+            if self.additional_js.strip():
+                parts.append(self.additional_js)
+            parts.append("var spynner_additional_js_loaded = 1;")
+            code = "\n;".join(parts)
+            if isinstance(code, six.text_type):
+                digest = hashlib.md5(code.encode('utf-8'))
+            else:
+                digest = hashlib.md5(code)
+            guard = "spynner_bundle_%s" % digest.hexdigest()[:16]
+            # evaluated once per document even if several browsers or
+            # frames objects inject it; the global eval keeps the top level
+            # declarations global
+            bundle = _js_bundles[key] = (
+                "if (!window.%s) { window.%s = 1; (0, eval)(%s); }" % (
+                    guard, guard, json.dumps(code)),
+                guard)
+        return bundle
+
+    def load_js(self, frame=None):
+        """
+        Inject the javascript bundle (see L{_js_bundle}) in a frame (default:
+        the current one) in a single evaluation. The frames are tracked and
+        not injected again until they load a new document.
+        """
+        if frame is None:
+            frame = self.webframe
+        bundle, guard = self._js_bundle()
+        if self._js_frames.get(frame) == guard:
+            return
+        if frame not in self._js_frames:
+            self._hook_frame(frame)
+        frame.evaluateJavaScript(bundle)
+        self._js_frames[frame] = guard
+
+    def _hook_frame(self, frame):
+        """Track the documents of a frame (see L{load_js})."""
+        if frame in self._js_frames:
+            return
+        self._js_frames[frame] = None
+        frame.javaScriptWindowObjectCleared.connect(
+            functools.partial(self._on_js_window_cleared, frame))
+        frame.loadFinished.connect(
+            functools.partial(self._remember_origin, frame))
+        frame.destroyed.connect(
+            functools.partial(self._js_frames.pop, frame, None))
+
+    def _remember_origin(self, frame, successful=True):
+        origin = frame.securityOrigin()
+        if origin.host():
+            url = "%s://%s" % (origin.scheme(), origin.host())
+            if origin.port() > 0:
+                url += ":%d" % origin.port()
+            self._origins.add(url)
+
+    def _clear_origins(self):
+        """
+        Clear the local storage and the web databases of the origins loaded
+        by the browser: they are shared by all the pages of the process.
+        """
+        page = QWebPage()
+        frame = page.mainFrame()
+        for origin in sorted(self._origins):
+            frame.setHtml("<html></html>", QUrl(origin + "/"))
+            frame.evaluateJavaScript(
+                "try { localStorage.clear(); } catch (e) {}")
+            for database in frame.securityOrigin().databases():
+                QWebDatabase.removeDatabase(database)
+        self._origins.clear()
+        page.deleteLater()
+
+    def _on_js_window_cleared(self, frame):
+        # a new document: the injected javascript is gone, and this is the
+        # time to expose Python objects to the page scripts
+        self._js_frames[frame] = None
+        if self.js_bridge:
+            self._expose_bridge(frame)
+        if self.inject_early:
+            self.load_js(frame)
+
+    def _expose_bridge(self, frame):
+        frame.addToJavaScriptWindowObject(JS_BRIDGE_NAME, self.bridge)
+        frame.evaluateJavaScript(JS_BRIDGE_JS)
+
+    def _enable_js_bridge(self):
+        """Expose the bridge to the loaded frames and to the next ones."""
+        if self.js_bridge:
+            return
+        self.js_bridge = True
+        for frame in list(self._js_frames):
+            self._expose_bridge(frame)
+
+    def _on_js_event(self, name, data):
+        if name == DOM_CHANGED_MESSAGE:
+            self._dom_changes += 1
+            self._notify()
+            return
+        try:
+            data = json.loads(data)
+        except ValueError:
+            pass
+        self._js_events_seq += 1
+        self._js_events.append((self._js_events_seq, name, data))
+        self._debug(DEBUG, "Javascript event %s: %r" % (name, data))
+        for callback in self._js_callbacks.get(name, [])[:]:
+            callback(data)
+        self._notify()
+
+    def on_js_event(self, name, callback):
+        """
+        Call C{callback(data)} each time the page scripts send an event
+        C{name} to Python with C{spynner_emit(name, data)}, C{data} being
+        any JSON serializable value.
+
+        The bridge object is also exposed as C{spynner_bridge}, its
+        C{post(name, json_string)} slot can be called directly. The pages
+        only see them from the first call (or with C{Browser(js_bridge=True)}
+        to have them in the pages loaded before).
+
+        >>> br.on_js_event('price', lambda data: prices.append(data))
+        >>> br.runjs("spynner_emit('price', {'value': 42})")
+        """
+        self._enable_js_bridge()
+        self._js_callbacks.setdefault(name, []).append(callback)
+
+    def off_js_event(self, name, callback=None):
+        """Remove a callback (all of them if None) set by L{on_js_event}."""
+        callbacks = self._js_callbacks.get(name, [])
+        if callback is None:
+            del callbacks[:]
+        elif callback in callbacks:
+            callbacks.remove(callback)
+
+    def wait_for_js_event(self, name, timeout=None, since=None):
+        """
+        Wait for the page scripts to send an event (see L{on_js_event}).
+
+        @param name: name of the event.
+        @param timeout: seconds to wait before raising an exception.
+        @param since: only consider the events sent after this sequence
+                      number (see L{js_events_seq}), default to now.
+        @return: the event data.
+        @raise SpynnerTimeout: If timeout is reached.
+        """
+        self._enable_js_bridge()
+        if since is None:
+            since = self._js_events_seq
+        found = []
+        def _event():
+            for seq, ename, data in self._js_events:
+                if seq > since and ename == name:
+                    found.append(data)
+                    return True
+            return False
+        if not self._wait_for(_event, timeout=timeout):
+            raise SpynnerTimeout("Timeout reached: %s seconds waiting for"
+                                 " the javascript event %s" % (timeout, name))
+        return found[0]
+
+    @property
+    def js_events_seq(self):
+        """Sequence number of the last event sent by the page scripts."""
+        return self._js_events_seq
 
     def load_jquery_simulate(self, force=False):
         """Load jquery simulate in the current frame"""
@@ -614,26 +1292,113 @@ class Browser(object):
     def wait_a_little(br, timeout):
         try:
             br.wait_load(timeout)
+        except SpynnerDeadlineExceeded:
+            raise
         except SpynnerTimeout as e:
             pass
 
-    def wait_requests(self, wait_requests = None, url = None, url_regex = None):
-        if wait_requests:
-            while self._replies < wait_requests:
-                self._events_loop()
-            self._events_loop(0.0)
-        if url_regex or url:
-            last_replies = self._replies
-            while True:
-                if last_replies != self._replies:
-                    if url_regex:
-                        if re.search(url_regex, self._reply_url):
-                            break
-                    elif url:
-                        if url == self._reply_url:
-                            break
-                self._events_loop()
-            self._events_loop(0.0)
+    def _mark_replies(self):
+        """Remember where the last action started in L{replies}."""
+        self._replies_mark = self.replies.seq
+        return self._replies_mark
+
+    def wait_requests(self, wait_requests = None, url = None, url_regex = None, since = None,
+                      timeout = None):
+        """
+        Wait for some requests to finish.
+
+        @param wait_requests: number of replies to wait for.
+        @param url: only count the replies for this exact url.
+        @param url_regex: only count the replies whose url matches this regex.
+        @param since: sequence number (see L{ReplyRegistry.seq}) after which
+                      the replies are counted. Defaults to the start of the
+                      last action (click, ...) when C{wait_requests} is given,
+                      and to now when only an url is given.
+        @param timeout: seconds to wait before raising an exception.
+        @return: the list of matching L{ReplyRecord}
+        @raise SpynnerTimeout: If timeout is reached.
+        """
+        if not (wait_requests or url or url_regex):
+            return []
+        if since is None:
+            if wait_requests:
+                since = self._replies_mark
+            else:
+                since = self.replies.seq
+        watch = self.replies.watch(
+            wait_requests or 1, url=url, url_regex=url_regex, since=since)
+        try:
+            if not self._wait_for(lambda: watch.done, timeout=timeout):
+                raise SpynnerTimeout("Timeout reached: %s seconds" % timeout)
+        finally:
+            self.replies.unwatch(watch)
+        self._events_loop(0.0)
+        return watch.records
+
+    def settle(self, timeout=None, quiet=None):
+        """
+        Wait for the effects of an action (click, ...) to be done.
+
+        Return as soon as a page load starts, or when nothing happened
+        (no request sent or finished, no DOM change) for C{quiet} seconds
+        while no more requests are in flight than when we started.
+
+        @param timeout: maximum seconds to wait (default: L{settle_timeout}).
+        @param quiet: seconds without activity (default: L{settle_quiet}).
+        @return: seconds it took to settle, also stored in C{settle_time}.
+        """
+        if timeout is None:
+            timeout = self.settle_timeout
+        if quiet is None:
+            quiet = self.settle_quiet
+        itime = time.time()
+        self._wait_for(self._settled_condition(quiet),
+                       timeout=timeout, interval=quiet / 2.)
+        return self._settled(itime)
+
+    def _settled_condition(self, quiet):
+        """Return the condition used by L{settle}."""
+        state = {'wakeups': self._wakeups, 'last': time.time(),
+                 'loads': self._loads_started,
+                 'inflight': self.replies.inflight}
+        self._watch_dom()
+        def _settled():
+            if self._loads_started != state['loads']:
+                return True
+            now = time.time()
+            if self._wakeups != state['wakeups']:
+                state['wakeups'] = self._wakeups
+                state['last'] = now
+                return False
+            return (now - state['last'] >= quiet
+                    and self.replies.inflight <= state['inflight'])
+        return _settled
+
+    def _settled(self, itime):
+        self.settle_time = time.time() - itime
+        self._debug(DEBUG, "Settled in %.3f seconds" % self.settle_time)
+        return self.settle_time
+
+    def wait_network_idle(self, idle_requests=0, idle_time=0.5, timeout=None):
+        """
+        Wait until no more than C{idle_requests} requests have been in flight
+        for C{idle_time} seconds.
+
+        @param idle_requests: number of requests which may still be in flight
+                              (long polling, trackers, ...).
+        @param idle_time: seconds the network must stay idle.
+        @param timeout: seconds to wait before raising an exception.
+        @raise SpynnerTimeout: If timeout is reached.
+        """
+        watch = self.replies.idle_watch(idle_requests, idle_time)
+        try:
+            if not self._wait_for(lambda: watch.done, timeout=timeout or None,
+                                  interval=max(0.005, idle_time / 10.)):
+                raise SpynnerTimeout(
+                    "Timeout reached: %d seconds (%d requests in flight)" % (
+                        timeout, self.replies.inflight))
+        finally:
+            self.replies.unwatch(watch)
 
     def sendText(self, selector, text, keyboard_modifiers = Qt.NoModifier, wait_load=False, wait_requests=None, timeout=None):
         """
@@ -649,10 +1414,11 @@ class Browser(object):
         """
         element = self.webframe.findFirstElement(selector)
         element.setFocus()
+        self._mark_replies()
         eventp = QKeyEvent(QEvent.KeyPress, Qt.Key_A, keyboard_modifiers, QString(text))
-        self.application.sendEvent(self.webview, eventp)
-        self._events_loop(timeout)
-        self.wait_requests(wait_requests)
+        self.application.sendEvent(self._input_target, eventp)
+        self._events_loop()
+        self.wait_requests(wait_requests, timeout=timeout)
         if wait_load:
             return self._wait_load(timeout)
 
@@ -674,11 +1440,12 @@ class Browser(object):
         """
         element = self.webframe.findFirstElement(selector)
         element.setFocus()
+        self._mark_replies()
         for key in keys:
             eventp = QKeyEvent(QEvent.KeyPress, key, keyboard_modifiers)
-            self.application.sendEvent(self.webview, eventp)
-            self._events_loop(timeout)
-        self.wait_requests(wait_requests)
+            self.application.sendEvent(self._input_target, eventp)
+            self._events_loop()
+        self.wait_requests(wait_requests, timeout=timeout)
         if wait_load:
             return self._wait_load(timeout)
 
@@ -691,7 +1458,8 @@ class Browser(object):
         settings = self.webpage.settings()
         settings.setAttribute(attribute, value)
 
-    def click(self, selector, wait_load=False, wait_requests=None, timeout=None):
+    def click(self, selector, wait_load=False, wait_requests=None, timeout=None,
+              wait_until=None, idle_requests=0, idle_time=0.5):
         """
         Click any clickable element in page.
 
@@ -701,6 +1469,10 @@ class Browser(object):
                                        raising an exception.
         @param wait_requests: How many requests to wait before returning. Useful
                               for AJAX requests.
+        @param wait_until: "networkidle" to wait for the network to be idle
+                           after the click (see L{wait_network_idle}).
+        @param idle_requests: requests which may still be in flight in "networkidle" mode.
+        @param idle_time: seconds the network must stay idle in "networkidle" mode.
 
         By default this method will not wait for a page to load.
         If you are clicking a link or submit button, you must call this
@@ -714,17 +1486,23 @@ class Browser(object):
         I{http://server.org/dir1/dir2/file.ext} will be saved to
         L{download_directory}/I{server.org/dir1/dir2/file.ext}.
         """
+        self._check_wait_until(wait_until)
+        ret = None
         if not self.embed_jquery_simulate:
-            return self.wk_click(selector,
-                                 wait_load=wait_load,
-                                 wait_requests=wait_requests,
-                                 timeout=timeout)
-        jscode = "%s('%s').simulate('click');" % (self.jslib, selector)
-        self._replies = 0
-        self._runjs_on_jquery("click", jscode)
-        self.wait_requests(wait_requests)
-        if wait_load:
-            return self._wait_load(timeout)
+            ret = self.wk_click(selector,
+                                wait_load=wait_load,
+                                wait_requests=wait_requests,
+                                timeout=timeout)
+        else:
+            jscode = "%s('%s').simulate('click');" % (self.jslib, selector)
+            self._mark_replies()
+            self._runjs_on_jquery("click", jscode)
+            self.wait_requests(wait_requests, timeout=timeout)
+            if wait_load:
+                ret = self._wait_load(timeout)
+        if wait_until == 'networkidle':
+            self.wait_network_idle(idle_requests, idle_time, timeout=timeout)
+        return ret
 
     def click_link(self, selector, timeout=None):
         """Click a link and wait for the page to load."""
@@ -736,6 +1514,10 @@ class Browser(object):
 
     def move_mouse(self, selector, timeout=1, offsetx=0, offsety=0, real=True):
         """Move the move to the css selector"""
+        if self.synthetic_input:
+            element = self.webframe.findFirstElement(selector)
+            return self._send_mouse_move(
+                self._viewport_position(element, offsetx, offsety))
         self.moveMouse(
             self.getPosition(
                 selector,
@@ -748,7 +1530,12 @@ class Browser(object):
                   adapt_size=False, pdb=False):
         """Move the mouse to a relative to the window point."""
         if adapt_size:
-            time.sleep(1)
+            self.settle(timeout=1)
+        if self.synthetic_input:
+            if not real:
+                where = self._frame_to_viewport(self.webframe, where)
+            return self._send_mouse_move(
+                QPoint(int(where.x()) + offsetx, int(where.y()) + offsety))
         if not real:
             where = self.getRealPosition(where)
         where = QPoint(int(where.x())+offsetx,
@@ -777,7 +1564,20 @@ class Browser(object):
         @param where: where to click (QPoint)
         @param real: if not true coordinates are relative to the window instead of the screen
         @timeout seconds: seconds to wait after click
+
+        With L{synthetic_input}, C{where} is relative to the page viewport
+        if C{real} is true and the mouse events are sent to the page.
         """
+        if self.synthetic_input:
+            if not real:
+                where = self._frame_to_viewport(self.webframe, where)
+            self._send_click(where)
+            self.settle()
+            return
+        if _get_autopy() is None:
+            raise SpynnerError(
+                "Native clicks need autopy (spynner[native]), "
+                "or set synthetic_input")
         if not real:
             where = self.getRealPosition(where)
         self.moveMouse(where, timeout=timeout, real=True, pdb=pdb)
@@ -796,19 +1596,69 @@ class Browser(object):
             self._events_loop(0)
             self.application.processEvents()
             self.application.processEvents()"""
-        autopy.mouse.click()
-        try:
-            self._events_loop(0.05)
-            self._events_loop(0.05)
-        except:
-            pass
+        _get_autopy().mouse.click()
+        self.settle()
+
+    @property
+    def synthetic_input(self):
+        """
+        True if the mouse input is synthetic: sent as Qt events to the page
+        instead of moving the system cursor, which needs a webview shown
+        on a display and autopy. This is the case in headless mode, and
+        can be set for the other browsers.
+        """
+        if self._synthetic_input is None:
+            return self.headless
+        return self._synthetic_input
+
+    @synthetic_input.setter
+    def synthetic_input(self, value):
+        self._synthetic_input = value
+
+    @property
+    def _input_target(self):
+        if self.webview is not None:
+            return self.webview
+        return self.webpage
+
+    def _frame_to_viewport(self, frame, point):
+        """Map a point of a frame document to the page viewport."""
+        point = QPoint(point)
+        while frame is not None:
+            point -= frame.scrollPosition()
+            if frame.parentFrame() is not None:
+                point += frame.geometry().topLeft()
+            frame = frame.parentFrame()
+        return point
+
+    def _viewport_position(self, element, offsetx=0, offsety=0):
+        """Position of an element in the page viewport, scrolling to it if needed."""
+        element.evaluateJavaScript("this.scrollIntoView(false)")
+        topleft = element.geometry().topLeft()
+        point = QPoint(topleft.x() + offsetx, topleft.y() + offsety)
+        return self._frame_to_viewport(element.webFrame(), point)
+
+    def _send_mouse_move(self, where):
+        event = QMouseEvent(QEvent.MouseMove, where,
+                            Qt.NoButton, Qt.MouseButtons(Qt.NoButton),
+                            Qt.NoModifier)
+        self.application.sendEvent(self._input_target, event)
+        return where
+
+    def _send_click(self, where):
+        """Send a synthetic left click at a point of the page viewport."""
+        self._send_mouse_move(where)
+        buttons = Qt.MouseButtons(Qt.LeftButton)
+        for event_type in (QEvent.MouseButtonPress, QEvent.MouseButtonRelease):
+            event = QMouseEvent(event_type, where,
+                                Qt.LeftButton, buttons, Qt.NoModifier)
+            self.application.sendEvent(self._input_target, event)
 
     def getPosition(self, selector, offsetx=0, offsety=0):
         """Get the position QPoint(x,y) of a css selector.
         @param selector: The css Selector to query against
         """
         jscode = "off = %s('%s').offset(); off.left+','+off.top" % (self.jslib, selector)
-        self._replies = 0
         try:
             item = self.webframe.findFirstElement(selector)
             geo = item.geometry()
@@ -853,6 +1703,14 @@ class Browser(object):
         I{http://server.org/dir1/dir2/file.ext} will be saved to
         L{download_directory}/I{server.org/dir1/dir2/file.ext}.
         """
+        self._mark_replies()
+        self._wk_dispatch_click(element)
+        self.settle()
+        self.wait_requests(wait_requests, timeout=timeout)
+        if wait_load:
+            return self._wait_load(timeout)
+
+    def _wk_dispatch_click(self, element):
         #element.evaluateJavaScript("this.click()")
         jscode = (
             "var e = document.createEvent('MouseEvents');"
@@ -860,10 +1718,6 @@ class Browser(object):
             "this.dispatchEvent(e);"
         )
         element.evaluateJavaScript(jscode)
-        time.sleep(0.5)
-        self.wait_requests(wait_requests)
-        if wait_load:
-            return self._wait_load(timeout)
 
     def wk_click_element_link(self, element, timeout=None):
         """Click a link and wait for the page to load.
@@ -928,13 +1782,21 @@ class Browser(object):
 
         @param offsetx: offset to click on the widget to the top left of it on the X axis (left to right)
         @param offsety: offset to click on the widget to the top left of it on the Y axix (top to bottom)
+
+        With L{synthetic_input} (headless mode), the mouse events are
+        sent to the page instead of moving the system cursor.
         """
-        where = self.getPosition(selector)
         item = self.webframe.findFirstElement(selector)
         item.setFocus()
-        where = QPoint(where.x() + offsetx, where.y() + offsety)
-        self.nativeClickAt(where, timeout, real=real, pdb=pdb)
-        self.wait_requests(wait_requests)
+        self._mark_replies()
+        if self.synthetic_input:
+            self.nativeClickAt(self._viewport_position(item, offsetx, offsety),
+                               timeout, real=True)
+        else:
+            where = self.getPosition(selector)
+            where = QPoint(where.x() + offsetx, where.y() + offsety)
+            self.nativeClickAt(where, timeout, real=real, pdb=pdb)
+        self.wait_requests(wait_requests, timeout=timeout)
         if wait_load:
             return self._wait_load(timeout)
 
@@ -968,7 +1830,67 @@ class Browser(object):
         """
         return self._wait_load(timeout)
 
-    def wait_for_content(self, callback, tries=None, error_message=None, delay=5):
+    def _watch_dom(self):
+        """Install the DOM watcher in the current frame if not already done.
+
+        The watcher wakes up L{_wait_for} each time the DOM changes, using a
+        MutationObserver (or mutation events on older WebKit).
+        """
+        self.webframe.evaluateJavaScript(DOM_WATCH_JS)
+
+    def _is_visible(self, element):
+        if element.isNull():
+            return False
+        return toString(element.evaluateJavaScript(IS_VISIBLE_JS)) == 'visible'
+
+    def _check_selector_state(self, state):
+        if state not in ('attached', 'visible', 'hidden', 'detached'):
+            raise SpynnerError("Unknown selector state: %s" % state)
+
+    def _selector_in_state(self, element, state):
+        if state == 'attached':
+            return not element.isNull()
+        if state == 'detached':
+            return element.isNull()
+        visible = self._is_visible(element)
+        return visible if state == 'visible' else not visible
+
+    def wait_for_selector(self, selector, state='attached', timeout=None):
+        """
+        Wait until an element reaches a state, checking it each time the DOM
+        changes instead of polling.
+
+        @param selector: css selector.
+        @param state: one of:
+            - attached: the element is in the DOM
+            - visible: the element is in the DOM and visible
+            - hidden: the element is not in the DOM or not visible
+            - detached: the element is not in the DOM
+        @param timeout: seconds to wait, None to wait forever.
+        @return: the QWebElement (a null one for detached/hidden)
+        @raise SpynnerTimeout: If timeout is reached.
+
+        >>> br.wait_for_selector('#results li', timeout=10)
+        """
+        self._check_selector_state(state)
+        result = {}
+        def _matched():
+            self._watch_dom()
+            element = self.webframe.findFirstElement(selector)
+            result['element'] = element
+            return self._selector_in_state(element, state)
+        # visibility may change with layout only, check it from time to time
+        interval = None
+        if state in ('visible', 'hidden'):
+            interval = 0.25
+        if not self._wait_for(_matched, timeout=timeout, interval=interval):
+            raise SpynnerTimeout(
+                "Timeout reached: %s seconds waiting for %s to be %s" % (
+                    timeout, selector, state))
+        return result['element']
+
+    def wait_for_content(self, callback, tries=None, error_message=None, delay=5,
+                         watch_dom=False):
         """
         Wait until the page is loaded.
 
@@ -976,6 +1898,9 @@ class Browser(object):
         @param timeout: number of retries / True for no limit
         @param delay: delay between retries
         @param error_message: additional message to set in the error message
+        @param watch_dom: If True, call the callback each time the DOM changes
+                          (or a page loads) instead of every C{delay} seconds,
+                          waiting at most C{tries} * C{delay} seconds.
         @return: Boolean state
         @raise SpynnerTimeout: If timeout is reached.
 
@@ -985,6 +1910,9 @@ class Browser(object):
         ...     return False
         >>> br.wait_for_content(wait_toto)
         """
+        if watch_dom:
+            return self._wait_for_content_change(
+                callback, tries=tries, error_message=error_message, delay=delay)
         ref_tries = tries
         ret = None
         found = False
@@ -1022,11 +1950,13 @@ class Browser(object):
                     try:
                         loaded = self._wait_load(timeout=delay)
                         self._debug(DEBUG, loaded_msg)
+                    except SpynnerDeadlineExceeded:
+                        raise
                     except SpynnerTimeout as e:
                         self._debug(DEBUG, waiting_msg)
                 else:
                     self._debug(DEBUG, loaded_msg)
-                    time.sleep(delay)
+                    self.wait(delay)
         if not found:
             if not isinstance(ref_tries, int):
                 ref_tries = 'unlimited'
@@ -1040,6 +1970,24 @@ class Browser(object):
         self._load_status = None
         return load_status
 
+    def _wait_for_content_change(self, callback, tries=None, error_message=None, delay=5):
+        timeout = None
+        if isinstance(tries, int) and not isinstance(tries, bool) and tries > 0:
+            timeout = tries * delay
+        def _matched():
+            self._watch_dom()
+            return callback(self)
+        if not self._wait_for(_matched, timeout=timeout):
+            msg = "SPYNNER waitload: Timeout reached: %ss watching the DOM." % timeout
+            if error_message:
+                msg += u'\n%s' % error_message
+            raise SpynnerTimeout(msg)
+        self._debug(DEBUG, "SPYNNER waitload: The callback found what it "
+                    "was waiting for in its contents!")
+        load_status = self._load_status
+        self._load_status = None
+        return load_status
+
     def wait(self, waittime):
         """
         Wait some time.
@@ -1050,12 +1998,53 @@ class Browser(object):
         may be useful to wait for synchronous Javascript events that
         change the DOM.
         """
-        itime = time.time()
-        while time.time() - itime < waittime:
-            self._events_loop()
+        self._wait_for(lambda: False, timeout=waittime)
+
+    def new_tab(self, url=None, **kwargs):
+        """
+        Open a new L{BrowserTab}: another page sharing this browser's
+        network manager and cookies, loading concurrently with the others.
+
+        @param url: url to start loading (without waiting for it).
+        @param kwargs: arguments for L{BrowserTab.load}.
+
+        >>> tabs = [br.new_tab(url) for url in urls]
+        >>> for tab in br.wait_tabs(tabs, timeout=30):
+        ...     print tab.url, len(tab.html)
+        """
+        tab = BrowserTab(self)
+        self.tabs.append(tab)
+        if url is not None:
+            tab.load(url, **kwargs)
+        return tab
+
+    def wait_tabs(self, tabs=None, mode='all', timeout=None):
+        """
+        Wait for the tabs to be loaded.
+
+        @param tabs: list of L{BrowserTab}, all the open tabs by default.
+        @param mode: 'all' to wait for every tab, 'any' for the first one.
+        @param timeout: seconds to wait before raising an exception.
+        @return: the list of loaded tabs.
+        @raise SpynnerTimeout: If timeout is reached.
+        """
+        if tabs is None:
+            tabs = self.tabs
+        if mode not in ('all', 'any'):
+            raise SpynnerError("Unknown wait mode: %s" % mode)
+        check = all if mode == 'all' else any
+        if not self._wait_for(lambda: check([t.loaded for t in tabs]),
+                              timeout=timeout):
+            raise SpynnerTimeout("Timeout reached: %s seconds, %d/%d tabs loaded" % (
+                timeout, len([t for t in tabs if t.loaded]), len(tabs)))
+        return [t for t in tabs if t.loaded]
 
     def close(self):
         """Close Browser instance and release resources."""
+        for tab in self.tabs[:]:
+            tab.close()
+        self._clear_download_managers()
+        _browsers.discard(self)
         if self.manager:
             del self.manager
         if self.webpage:
@@ -1064,6 +2053,66 @@ class Browser(object):
             self.destroy_webview()
         self.application.exit()
 
+    def reset(self, timeout=10, clear_memory_caches=None):
+        """
+        Bring the browser back to a blank state to run a new job with it,
+        which is much cheaper than closing it and building a new one.
+
+        The requests and downloads in flight are aborted, the tabs closed,
+        and the cookies, history, downloads tracking, callbacks, url filter
+        and frame selection are cleared, as well as the local storage and
+        web databases of the origins loaded since the browser was built (or
+        last reset). The settings (headers, proxy, host limits, javascript
+        files, ...) are kept.
+
+        @param timeout: seconds to wait for the blank page to load.
+        @param clear_memory_caches: clear the WebKit memory caches, which
+                                    are shared by all the browsers of the
+                                    process. By default, only when this
+                                    browser is the only one.
+        """
+        self.abort()
+        for tab in self.tabs[:]:
+            tab.close()
+        frames = [self.webpage.mainFrame()]
+        while frames:
+            frame = frames.pop(0)
+            frame.evaluateJavaScript(
+                "try { localStorage.clear(); sessionStorage.clear(); }"
+                " catch (e) {}")
+            frames.extend(frame.childFrames())
+        self._url_filter = None
+        self._routes = []
+        self._javascript_confirm_callback = None
+        self._javascript_confirm_prompt = None
+        self._javascript_prompt_callback = None
+        self._http_authentication_callback = None
+        self._js_callbacks.clear()
+        self._webframe = None
+        self._start_load('about:blank')
+        self._wait_for(lambda: self._load_status is not None, timeout=timeout)
+        self.webpage.history().clear()
+        self._clear_origins()
+        if clear_memory_caches is None:
+            clear_memory_caches = len(_browsers) <= 1
+        if clear_memory_caches:
+            QWebSettings.clearMemoryCaches()
+        self.cookies = []
+        self.cookiesjar.setAllCookies([])
+        self.downloads.clear()
+        self._active_downloads.clear()
+        self._clear_download_managers()
+        self._headers = []
+        self._webframe = None
+        self._load_status = None
+        self._reply_url = None
+        self._reply_status = None
+        self.replies.clear()
+        self._replies_mark = self.replies.seq
+        self._js_events.clear()
+        self.settle_time = None
+        self.errorCode = self.errorMessage = None
+
     def search_element_text(self, search_text, element='a', case_sensitive=False, match_exactly=True):
         """
         Search all elements on a page for the specified text, returns a list of elements that contain it.
@@ -1090,6 +2139,8 @@ class Browser(object):
 
     def create_webview(self, show=False, force=False):
         """Create a QWebView object and insert current QWebPage."""
+        if self.headless:
+            raise SpynnerError("No webview in headless mode")
         if force and (self.webview is not None):
             self.destroy_webview()
         if self.webview is not None:
@@ -1099,14 +2150,15 @@ class Browser(object):
         window = self.webview.window()
         window.setAttribute(Qt.WA_DeleteOnClose)
         window.destroyed.connect(self._on_webview_destroyed)
-        self.application.syncX()
+        if hasattr(self.application, 'syncX'):
+            self.application.syncX()
 
     def destroy_webview(self):
         """Destroy current QWebView."""
         if not self.webview:
             return
         self.webview.close()
-        del self.webview
+        self.webview = None
 
     def show(self, maximized=True, force=False):
         """Show webview browser."""
@@ -1127,8 +2179,7 @@ class Browser(object):
         if self.webview is None:
             self.create_webview()
         self.show()
-        while self.webview:
-            self._events_loop()
+        self._wait_for(lambda: not self.webview)
 
     def set_webframe_to_default(self):
         self.setframe_obj()
@@ -1383,6 +2434,88 @@ class Browser(object):
         """Set cookies from a string with Mozilla-format cookies."""
         return self.cookiesjar.setMozillaCookies(string_cookies)
 
+    def set_host_limits(self, concurrency=None, rate=None, burst=1):
+        """
+        Limit the requests sent to each host, for page loads and downloads.
+        The requests over the limits are queued and sent when possible.
+
+        @param concurrency: maximum number of requests in flight per host.
+        @param rate: maximum number of requests per second per host.
+        @param burst: number of requests which may be sent at once before
+                      C{rate} applies.
+
+        >>> br.set_host_limits(concurrency=4, rate=2)
+        """
+        self.scheduler.configure(concurrency, rate, burst)
+
+    def set_cache(self, directory, max_size=None, mode='network'):
+        """
+        Use a persistent disk cache, shared by the browsers of the process
+        using the same directory (see L{spynner.cache}).
+
+        @param directory: cache directory, None to stop using the cache.
+        @param max_size: bytes the cache may use, the least recently used
+                         responses are evicted over it (default 50MB).
+        @param mode: "network" (HTTP caching, stale responses are
+                     revalidated), "prefer-cache" (cached responses even if
+                     stale) or "offline" (only cached responses).
+
+        >>> br.set_cache('/tmp/spynner-cache', max_size=200 * 1024 * 1024)
+        >>> br.cache.store.stats()['hits']
+        """
+        from spynner.cache import CACHE_MODES, DiskCacheStore, NetworkCache
+        if mode not in CACHE_MODES:
+            raise SpynnerError("Unknown cache mode: %s" % mode)
+        self.cache = None
+        self._cache_control = None
+        if directory is None:
+            self.manager.setCache(None)
+            return
+        self.cache = NetworkCache(DiskCacheStore.shared(directory, max_size))
+        self.manager.setCache(self.cache)
+        if mode != 'network':
+            self._cache_control = CACHE_MODES[mode]
+
+    def start_recording(self, path):
+        """
+        Record the requests and responses (headers, bodies and timings) of
+        the browser into a HAR archive, written by L{stop_recording}
+        (see L{spynner.har}).
+
+        @param path: archive file path.
+        """
+        from spynner.har import HarRecorder
+        self.recorder = HarRecorder(path)
+
+    def stop_recording(self):
+        """Stop recording, write and return the archive path (or None)."""
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return None
+        return recorder.save()
+
+    def replay(self, path, missing='404'):
+        """
+        Serve the responses of a HAR archive (see L{start_recording})
+        instead of using the network.
+
+        @param path: archive file path, None to stop replaying.
+        @param missing: answer to the requests not in the archive: "404",
+                        "error" (the request fails) or "network" (the
+                        request is sent).
+        """
+        self.archive = None
+        if path is None:
+            return
+        from spynner.har import HarArchive
+        try:
+            self.archive = HarArchive(path, missing)
+        except ValueError as e:
+            raise SpynnerError(str(e))
+
+    def stop_replay(self):
+        self.replay(None)
+
     def get_proxy(self):
         """Set NManager.get_proxy (wrapper)"""
         return self.manager.get_proxy()
@@ -1391,49 +2524,374 @@ class Browser(object):
         """Set NManager.set_proxy (wrapper)"""
         return self.manager.set_proxy(string_proxy)
 
-    def download(self, url, outfd=None, timeout=None, proxy_url=None):
+    def download(self, url, outfd=None, timeout=None, proxy_url=None,
+                 resume=False, progress=None, size=None, checksum=None):
         """
         Download a given URL using current cookies.
 
         @param url: URL or path to download
-        @param outfd: Output file-like stream. If None, return data string.
+        @param outfd: Output file-like stream or file path. If None, return data string.
         @param proxy_url: special proxy url (see NManager.set_proxy) to use (default to global networkmanager's proxy
         @param tiemout: int, seconds for timeout
-        @return: Bytes downloaded (None if something went wrong)
+        @param resume: with a file path, continue an interrupted download
+                       of the same URL (Range and If-Range requests, the
+                       validators are kept in a I{path.resume} file until
+                       the download is complete).
+        @param progress: callback called as C{progress(nbytes, total, rate,
+                         eta)} while downloading: bytes received (with the
+                         resumed ones), expected size (or None), bytes per
+                         second and seconds left (or None).
+        @param size: expected file size, checked at the end.
+        @param checksum: expected C{(algorithm, hexdigest)} of the file, as
+                         in C{('sha256', '9f86d0...')}, checked at the end.
+        @return: Bytes downloaded, the file size with a file path (None if
+                 something went wrong)
+        @raise SpynnerError: the size or the checksum of the file is wrong,
+                             the file is removed.
         @note: If url is a path, the current base URL will be pre-appended.
         """
-        def _on_reply(reply):
-            url = six.u(toString(reply.url()))
-            self._download_reply_status = not bool(reply.error())
-        self._download_reply_status = None
+        reply, outfd, outfd_set = self._begin_download(
+            url, outfd, proxy_url, resume=resume, progress=progress)
+        if not self._wait_for(lambda: reply.download_finished,
+                              timeout=timeout or None):
+            reply.abort()
+            self._download_result(reply, outfd, outfd_set)
+            raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
+        return self._download_result(reply, outfd, outfd_set, size, checksum)
+
+    def download_stream(self, url, chunk_size=64 * 1024, buffer_size=256 * 1024,
+                        timeout=None, proxy_url=None):
+        """
+        Download a given URL using current cookies, and yield its data in
+        chunks as it arrives. At most C{buffer_size} bytes are read from the
+        network ahead of the consumer: a slow consumer slows the transfer
+        down instead of filling the memory.
+
+        @param url: URL or path to download (see L{download}).
+        @param chunk_size: bytes of the yielded chunks at most.
+        @param buffer_size: read buffer of the reply.
+        @param timeout: seconds to wait for data before giving up.
+        @param proxy_url: proxy to use (see L{download}).
+        @raise SpynnerError: the download failed, or got an HTTP error
+                             status (before any chunk is yielded).
+        @raise SpynnerTimeout: no data arrived for C{timeout} seconds.
+
+        >>> with open('big.tar', 'wb') as fic:
+        ...     for chunk in br.download_stream(url):
+        ...         fic.write(chunk)
+        """
+        if not urlparse.urlsplit(url).scheme:
+            url = urlparse.urljoin(self.url, url)
+        request = self.apply_ssl(QNetworkRequest(QUrl(url)))
+        reply = self._download_manager(proxy_url).get(request)
+        reply.setReadBufferSize(buffer_size)
+        reply.finished.connect(self._notify)
+        reply.readyRead.connect(self._notify)
+        self._active_downloads.add(reply)
+        entry = self.downloads.add(url, reply=reply)
+        nbytes = 0
+        self._debug(INFO, "Start download stream: %s" % url)
+        try:
+            while True:
+                if not reply.bytesAvailable() and not reply.isFinished():
+                    if not self._wait_for(
+                            lambda: reply.bytesAvailable() or reply.isFinished(),
+                            timeout=timeout or None):
+                        raise SpynnerTimeout(
+                            "Timeout reached: %d seconds" % timeout)
+                if not nbytes:
+                    # not the body of an error page
+                    status = _http_status(reply)
+                    if reply.error():
+                        raise SpynnerError(
+                            "Download error: %s" % reply.errorString())
+                    if status is not None and status >= 400:
+                        raise SpynnerError(
+                            "Download error: HTTP status %s" % status)
+                if reply.bytesAvailable():
+                    data = reply.read(chunk_size)
+                    if hasattr(data, 'data'):
+                        data = data.data()
+                    nbytes += len(data)
+                    self.downloads.progress(entry, nbytes)
+                    yield data
+                elif reply.error():
+                    raise SpynnerError("Download error: %s" % reply.errorString())
+                else:
+                    self._debug(INFO, "Download stream finished: %s" % url)
+                    return
+        finally:
+            self._active_downloads.discard(reply)
+            if not reply.isFinished():
+                reply.abort()
+            # the reply is released when the entry is evicted
+            self.downloads.finish(entry, reply.error())
+
+    def download_spooled(self, url, max_memory=8 * 1024 * 1024, timeout=None,
+                         proxy_url=None):
+        """
+        Download a given URL using current cookies into a temporary file
+        kept in memory up to C{max_memory} bytes, on the disk above.
+
+        @return: the C{tempfile.SpooledTemporaryFile}, at its start.
+        @raise SpynnerError: the download failed.
+        """
+        outfd = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        try:
+            for chunk in self.download_stream(
+                    url, timeout=timeout, proxy_url=proxy_url):
+                outfd.write(chunk)
+        except:
+            outfd.close()
+            raise
+        outfd.seek(0)
+        return outfd
+
+    def download_many(self, urls, concurrency=4, dest=None, timeout=None,
+                      proxy_url=None):
+        """
+        Download URLs in parallel with the browser cookies, and yield a
+        L{DownloadResult} for each one as soon as it is finished.
+
+        @param urls: URLs or paths (see L{download}), any iterable.
+        @param concurrency: downloads in flight at most.
+        @param dest: where to write the data: None (kept in memory, see
+                     C{DownloadResult.data}), a directory (files named
+                     I{dest/server.org/dir/file.ext}) or a callable
+                     returning the path or file-like object of an URL.
+        @param timeout: seconds a download may take, it fails with
+                        C{OperationCanceledError} after it.
+        @param proxy_url: proxy to use (see L{download}).
+
+        The URLs which can not be downloaded (request or file error, or a
+        path outside of C{dest}) get a failed result, the others go on.
+        The URLs of a sequence (a list, ...) are in L{downloads} as queued
+        until they start, the ones of an iterator from when they start.
+
+        >>> for result in br.download_many(urls, concurrency=8, dest='/tmp/dl'):
+        ...     print(result.url, result.ok, result.nbytes, result.elapsed)
+        """
+        sized = hasattr(urls, '__len__')
+        if sized:
+            queued = [(url, self._queue_download(url)) for url in urls]
+        else:
+            queued = ((url, self._queue_download(url)) for url in urls)
+        queued = iter(queued)
+        running = []
+        try:
+            while True:
+                while len(running) < max(concurrency, 1):
+                    url, entry = next(queued, (None, None))
+                    if url is None:
+                        break
+                    try:
+                        running.append(
+                            self._start_many(url, dest, proxy_url, entry))
+                    except (SpynnerError, EnvironmentError) as e:
+                        self._debug(ERROR, "Download error: %s (%s)" % (url, e))
+                        self.downloads.finish(
+                            entry, QNetworkReply.UnknownNetworkError)
+                        yield DownloadResult(
+                            url, error=QNetworkReply.UnknownNetworkError,
+                            error_string=u"%s" % e)
+                if not running:
+                    return
+                wait = None
+                if timeout:
+                    started = min(reply.download_started for reply in running)
+                    wait = max(started + timeout - time.time(), 0)
+                self._wait_for(
+                    lambda: any(reply.download_finished for reply in running),
+                    timeout=wait)
+                for reply in running[:]:
+                    if (not reply.download_finished and timeout and
+                            time.time() - reply.download_started >= timeout):
+                        reply.abort()
+                    if reply.download_finished:
+                        running.remove(reply)
+                        yield self._many_result(reply)
+        finally:
+            # the generator was closed (or failed) before the end
+            for reply in running:
+                reply.abort()
+                self._active_downloads.discard(reply)
+                self._many_result(reply)
+            if sized:
+                for url, entry in queued:
+                    self.downloads.finish(
+                        entry, QNetworkReply.OperationCanceledError)
+
+    def _queue_download(self, url):
+        """Track a download of L{download_many} waiting to start."""
+        if not urlparse.urlsplit(url).scheme:
+            url = urlparse.urljoin(self.url, url)
+        return self.downloads.add(url)
+
+    def _start_many(self, url, dest, proxy_url, entry=None):
+        """Start a download of L{download_many}, return its reply."""
+        path = outfd = None
+        if callable(dest):
+            outfd = dest(url)
+            if isinstance(outfd, six.string_types):
+                path, outfd = outfd, None
+        elif dest is not None:
+            urlinfo = urlparse.urlsplit(urlparse.urljoin(self.url, url))
+            # no dot segments: the files stay under dest
+            names = [os.path.basename(name)
+                     for name in urlinfo.path.split('/')]
+            names = [name for name in names if name not in ('', '.', '..')]
+            if not names or urlinfo.path.endswith('/'):
+                names.append('index.html')
+            path = os.path.join(dest, urlinfo.netloc, *names)
+            root = os.path.join(os.path.realpath(dest), '')
+            if not os.path.realpath(path).startswith(root):
+                raise SpynnerError("Download path outside of %s: %s" % (
+                    dest, path))
+        started = time.time()
+        reply, outfd, outfd_set = self._begin_download(
+            url, path or outfd, proxy_url, entry=entry)
+        reply.download_started = started
+        reply.download_target = (url, path, outfd, outfd_set)
+        return reply
+
+    def _many_result(self, reply):
+        url, path, outfd, outfd_set = reply.download_target
+        if path is not None:
+            outfd.close()
+        result = DownloadResult(
+            url, path=path, nbytes=reply.downloaded_nbytes,
+            http_status=_http_status(reply),
+            elapsed=time.time() - reply.download_started)
+        if reply.error():
+            result.error = reply.error()
+            result.error_string = u"%s" % reply.errorString()
+        if not outfd_set:
+            result.data = outfd.getvalue()
+        return result
+
+    def _begin_download(self, url, outfd=None, proxy_url=None, resume=False,
+                        progress=None, entry=None):
+        """
+        Send a download request, return (reply, outfd, outfd_set).
+
+        @param entry: L{DownloadEntry} of the queued download, if any.
+        """
         if not urlparse.urlsplit(url).scheme:
             url = urlparse.urljoin(self.url, url)
         request = QNetworkRequest(QUrl(url))
         request = self.apply_ssl(request)
-        # Create a new manager to process this download
-        manager = NManager.new(self)
-        manager.set_proxy(proxy_url)
-        manager.sslErrors.connect(self._on_manager_ssl_errors)
-        reply = manager.get(request)
-        itime = time.time()
+        path = None
+        offset = 0
+        if isinstance(outfd, six.string_types):
+            path = outfd
+            if resume:
+                offset = self._resume_offset(path, url, request)
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            outfd = open(path, 'ab' if offset else 'wb')
+        reply = self._download_manager(proxy_url).get(request)
         if reply.error():
+            if path is not None:
+                outfd.close()
             raise SpynnerError("Download error: %s" % reply.errorString())
         reply.downloaded_nbytes = 0
-        manager.finished.connect(_on_reply)
+        reply.download_offset = offset
+        reply.download_path = path
+        reply.download_resume = _resume_path(path) if resume and path else None
+        self._active_downloads.add(reply)
         outfd_set = bool(outfd)
         if not outfd_set:
             outfd = StringIO()
-        self._start_download(reply, outfd)
-        while self._download_reply_status is None:
-            if timeout:
-                if time.time() - itime > timeout:
-                    raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
-            self._events_loop()
+        self._start_download(reply, outfd, progress=progress, entry=entry)
+        return reply, outfd, outfd_set
+
+    def _resume_offset(self, path, url, request):
+        """
+        Ask for the rest of a partially downloaded file, if its validators
+        are known, and return its size (0 to download it all).
+        """
+        state = _read_resume_state(_resume_path(path))
+        if not state or state.get('url') != url or not os.path.exists(path):
+            return 0
+        offset = os.path.getsize(path)
+        # weak entity tags may not be used for sub-ranges
+        validator = state.get('etag')
+        if not validator or validator.startswith('W/'):
+            validator = state.get('last_modified')
+        if not offset or not validator:
+            return 0
+        self._debug(INFO, "Resume download at %d bytes: %s" % (offset, url))
+        request.setRawHeader(b'Range', ('bytes=%d-' % offset).encode('ascii'))
+        request.setRawHeader(b'If-Range', validator.encode('latin-1'))
+        return offset
+
+    def _download_manager(self, proxy_url=None):
+        """
+        Return the network manager of the downloads through a proxy, kept
+        to reuse its connections, and sharing the cookies of the browser.
+        The managers are keyed by the effective proxy: the browser one
+        (see L{set_proxy}) when C{proxy_url} is None.
+        """
+        proxy_url = proxy_url or self.manager.proxy_url
+        manager = self._download_managers.pop(proxy_url, None)
+        if manager is None:
+            manager = NManager.new(self, cookiejar=self.manager.cookieJar())
+            manager.set_proxy(proxy_url)
+            manager.sslErrors.connect(self._on_manager_ssl_errors)
+        self._download_managers[proxy_url] = manager
+        busy = set(id(reply.manager()) for reply in self._active_downloads)
+        for key, old in list(self._download_managers.items()):
+            if len(self._download_managers) <= self.max_download_managers:
+                break
+            if old is not manager and id(old) not in busy:
+                del self._download_managers[key]
+                old.deleteLater()
+        return manager
+
+    def _clear_download_managers(self):
+        for manager in self._download_managers.values():
+            manager.deleteLater()
+        self._download_managers.clear()
+
+    def _download_result(self, reply, outfd, outfd_set, size=None,
+                         checksum=None):
+        path = getattr(reply, 'download_path', None)
+        if path is not None:
+            outfd.close()
+            return self._check_download(reply, path, size, checksum)
         if outfd_set:
             return (reply.downloaded_nbytes if not reply.error() else None)
         else:
             return outfd.getvalue()
 
+    def _check_download(self, reply, path, size=None, checksum=None):
+        """Return the size of a finished download file after checking it."""
+        if reply.error() and not _already_downloaded(reply):
+            # kept as is to be resumed
+            return None
+        nbytes = os.path.getsize(path)
+        problem = None
+        expected = size if size is not None else reply.download_total
+        if expected is not None and nbytes != expected:
+            problem = "%d bytes instead of %d" % (nbytes, expected)
+        elif checksum is not None:
+            algorithm, hexdigest = checksum
+            digest = hashlib.new(algorithm)
+            with open(path, 'rb') as fic:
+                for chunk in iter(lambda: fic.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            if digest.hexdigest().lower() != hexdigest.lower():
+                problem = "%s checksum mismatch" % algorithm
+        resume_path = getattr(reply, 'download_resume', None)
+        for filepath in ([path] if problem else []) + [resume_path]:
+            if filepath and os.path.exists(filepath):
+                os.remove(filepath)
+        if problem:
+            raise SpynnerError("Download error (%s): %s" % (
+                problem, six.u(toString(reply.url()))))
+        return nbytes
+
     def set_html_parser(self, parser):
         """
         Set HTML parser used to generate the HTML L{soup}.
@@ -1498,6 +2956,46 @@ class Browser(object):
         """Return the URL for a given path using the current URL as base."""
         return urlparse.urljoin(self.url, path)
 
+    def _request_frame(self, request):
+        """Return the QWebFrame making a request (None if unknown)."""
+        frame = None
+        if hasattr(request, 'originatingObject'):
+            frame = request.originatingObject()
+        if frame is not None and hasattr(frame, 'page'):
+            return frame
+        return None
+
+    def _request_tab(self, request):
+        """Return the L{BrowserTab} making a request (None if not a tab)."""
+        if not self.tabs:
+            return None
+        frame = self._request_frame(request)
+        if frame is None:
+            return None
+        page = frame.page()
+        for tab in self.tabs:
+            if tab.webpage is page:
+                return tab
+        return None
+
+    def _request_context(self, request, url):
+        """
+        Return the resource type (see L{spynner.blocking.guess_resource_type})
+        of a request and the url of the page making it.
+        """
+        frame = self._request_frame(request)
+        if frame is not None:
+            subdocument = frame.parentFrame() is not None
+            page = frame.page()
+        else:
+            subdocument, page = False, self.webpage
+        accept = request.rawHeader(b'Accept').data().decode('latin-1')
+        resource_type = guess_resource_type(url, accept, subdocument)
+        first_party = six.u(toString(page.mainFrame().url().toString()))
+        if resource_type == 'document' or not first_party.startswith('http'):
+            first_party = url
+        return resource_type, first_party
+
     def set_url_filter(self, url_filter):
         """
         Set function callback to filter URL.
@@ -1513,10 +3011,146 @@ class Browser(object):
                             C{post} or C{put}.
             - C{url}: requested item URL.
 
-        It should return C{True} (proceed) or C{False} (reject).
+        It should return C{True} (proceed) or C{False} (reject). The
+        rejected requests fail immediately (see also L{blocking} for faster
+        rules).
         """
         self._url_filter = url_filter
 
+    def route(self, pattern, handler):
+        """
+        Serve the requests matching a pattern from memory, without any
+        network access (mocks, stubs of slow third party services...).
+
+        The handler is called as C{handler(operation, url, body)}, with the
+        lowercase HTTP operation and the request body (bytes or None), and
+        returns:
+
+            - C{None}: the request is not routed and proceeds;
+            - C{(status, headers, body)}, headers being a dict or a list of
+              (name, value) tuples;
+            - a dict with a C{body} or a file C{path}, and optional
+              C{status}, C{headers} and C{content_type} keys;
+            - bytes or text: a 200 response body.
+
+        The last added routes are tried first. The cookies set by the
+        responses are stored, and a request whose handler raises an
+        exception fails (the traceback is logged).
+
+        @param pattern: regular expression (string or compiled) searched in
+                        the request URL.
+
+        >>> br.route(r'/api/items$', lambda op, url, body: (
+        ...     200, {'Content-Type': 'application/json'}, b'[]'))
+        >>> br.route(r'\.png$', lambda op, url, body: {'path': 'pixel.png'})
+        """
+        regex = re.compile(pattern) if isinstance(
+            pattern, six.string_types) else pattern
+        self._routes.insert(0, (pattern, regex, handler))
+
+    def unroute(self, pattern=None, handler=None):
+        """Remove the routes of a pattern and/or handler, all of them by default."""
+        self._routes = [
+            route for route in self._routes
+            if (pattern is not None and route[0] != pattern)
+            or (handler is not None and route[2] != handler)]
+
+    def _route_request(self, manager, operation, request, url, data):
+        """Return the reply of the matching route and the request data."""
+        body = None
+        for pattern, regex, handler in self._routes:
+            if not regex.search(url):
+                continue
+            if data is not None and body is None:
+                body, data = _buffer_device(manager, data)
+            try:
+                response = handler(self._operation_names[operation], url, body)
+                if response is None:
+                    continue
+                reply = StaticReply.routed(manager, request, operation, response)
+            except Exception:
+                # this runs in a Qt virtual method, which must return a reply
+                self._debug(ERROR, "Route %s failed on %s:\n%s" % (
+                    pattern, url, traceback.format_exc()))
+                return StaticReply(
+                    manager, request, operation, status=None,
+                    error=(QNetworkReply.UnknownContentError,
+                           "Route error: %s" % url)), data
+            self._debug(INFO, "URL routed by %s: %s" % (pattern, url))
+            return reply, data
+        return None, data
+
+
+def _http_status(reply):
+    """HTTP status code of a reply as an integer (None if unknown)."""
+    status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+    if hasattr(status, 'toPyObject'):
+        status = status.toPyObject()
+    return int(status) if status is not None else None
+
+
+def _text_header(reply, name):
+    """Value of a reply header as text (None if missing)."""
+    name = name.encode('ascii')
+    if not reply.hasRawHeader(name):
+        return None
+    value = reply.rawHeader(name)
+    if hasattr(value, 'data'):
+        value = value.data()
+    return value.decode('latin-1')
+
+
+def _already_downloaded(reply):
+    """True if a resumed download was complete (a 416 reply)."""
+    return bool(getattr(reply, 'download_discard', False) and
+                reply.download_total == reply.download_offset)
+
+
+def _resume_path(path):
+    """Path of the file keeping the validators of a partial download."""
+    return path + '.resume'
+
+
+def _read_resume_state(path):
+    try:
+        with open(path, 'rb') as fic:
+            return json.loads(fic.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_resume_state(path, state):
+    with open(path, 'wb') as fic:
+        fic.write(json.dumps(state).encode('utf-8'))
+
+
+# python 2 has no monotonic clock
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _read_js(path):
+    """Return the content of a javascript file, read once per process."""
+    code = _js_files.get(path)
+    if code is None:
+        with open(path) as fic:
+            code = _js_files[path] = fic.read()
+    return code
+
+
+def _new_application(argv, headless=False):
+    """Create the process QApplication."""
+    if headless:
+        # Qt platform plugins builds (QPA) render offscreen. QtWebKit needs
+        # a GUI application, which the X11 builds of Qt 4 can not create
+        # without a display: use a virtual one (Xvfb).
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        if (sys.platform not in ('win32', 'darwin')
+                and not os.environ.get('DISPLAY')):
+            raise SpynnerError(
+                "The headless mode needs a X display with Qt 4, "
+                "run it in a virtual one (xvfb-run)")
+    return QApplication(argv)
+
 
 def _first(iterable, pred=bool):
     """Return the first element in iterator that matches the predicate"""
@@ -1609,6 +3243,854 @@ class SpynnerTimeout(Exception):
 class SpynnerJavascriptError(Exception):
     """Error on the injected Javascript code."""
 
+class SpynnerDeadlineExceeded(SpynnerTimeout):
+    """A L{Deadline} expired or was cancelled."""
+
+
+class Deadline(object):
+    """
+    Time budget (and cancellation token) for a sequence of browser
+    operations, see L{Browser.deadline}. It is measured with a monotonic
+    clock when available: changes of the system time do not affect it.
+    """
+
+    def __init__(self, timeout=None):
+        """
+        @param timeout: seconds from now, None for a deadline which only
+                        expires when cancelled.
+        """
+        self.timeout = timeout
+        self.expires = None
+        if timeout is not None:
+            self.expires = _monotonic() + timeout
+        self.cancelled = False
+        self._browsers = []
+
+    def remaining(self):
+        """Seconds left, None if there is no time limit."""
+        if self.cancelled:
+            return 0
+        if self.expires is None:
+            return None
+        return max(0, self.expires - _monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() == 0
+
+    def cancel(self):
+        """Cancel the operations running under this deadline."""
+        self.cancelled = True
+        for browser in self._browsers:
+            browser._notify()
+
+class BrowserTab(object):
+    """
+    Additional page of a L{Browser} (see L{Browser.new_tab}).
+
+    Tabs share the browser network manager, thus its cookies, proxy,
+    default headers and url filters, and load concurrently on the same
+    QApplication. The headers given to L{load} and the javascript confirm
+    and prompt callbacks are the tab ones (the browser callbacks are used
+    if the tab has none).
+
+    Important vars:
+
+        - self.webpage: QWebPage object
+        - self.load_status: None while loading (or if nothing was loaded),
+          else the boolean status of the last load.
+    """
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.load_status = None
+        self.loading = False
+        self.javascript_confirm_callback = None
+        self.javascript_prompt_callback = None
+        # headers of the requests of the tab, see load
+        self._headers = browser.headers[:]
+        wp = self.webpage = QWebPage()
+        wp.setNetworkAccessManager(browser.manager)
+        wp.javaScriptAlert = self._javascript_alert
+        wp.javaScriptConsoleMessage = browser._javascript_console_message
+        wp.javaScriptConfirm = self._javascript_confirm
+        wp.javaScriptPrompt = self._javascript_prompt
+        wp.setForwardUnsupportedContent(True)
+        wp.unsupportedContent.connect(browser._on_unsupported_content)
+        wp.loadStarted.connect(self._on_load_started)
+        wp.loadFinished.connect(self._on_load_finished)
+        wp.frameCreated.connect(self._hook_frame)
+        self._hook_frame(wp.mainFrame())
+
+    def _hook_frame(self, frame):
+        frame.loadFinished.connect(
+            functools.partial(self.browser._remember_origin, frame))
+
+    def _on_load_started(self):
+        self.load_status = None
+        self.loading = True
+        self.browser._notify()
+
+    def _javascript_alert(self, webframe, message):
+        # tabs have no view to show it
+        self.browser._debug(INFO, "Tab javascript alert: %s" % message)
+
+    def _javascript_confirm(self, webframe, message):
+        return self.browser._confirm(
+            self.webpage,
+            self.javascript_confirm_callback or
+            self.browser._javascript_confirm_callback,
+            webframe, message)
+
+    def _javascript_prompt(self, webframe, message, defaultvalue, result):
+        return self.browser._prompt(
+            self.webpage,
+            self.javascript_prompt_callback or
+            self.browser._javascript_prompt_callback,
+            webframe, message, defaultvalue, result)
+
+    def _on_load_finished(self, successful):
+        self.load_status = successful
+        self.loading = False
+        status = {True: "successful", False: "error"}[successful]
+        self.browser._debug(INFO, "Tab load finished: %s (%s)" % (self.url, status))
+        self.browser._notify()
+
+    @property
+    def loaded(self):
+        """True when the last load is done (successful or not)."""
+        return not self.loading and self.load_status is not None
+
+    @property
+    def webframe(self):
+        return self.webpage.mainFrame()
+
+    @property
+    def url(self):
+        return six.u(toString(self.webframe.url()))
+
+    @property
+    def html(self):
+        return six.u(self.webframe.toHtml())
+
+    def load(self, url, wait=False, timeout=10,
+             operation=QNetworkAccessManager.GetOperation,
+             body=None, headers=None):
+        """
+        Start loading an url in this tab.
+
+        @param wait: if True, wait for the page to load and return its status.
+        @param timeout: seconds to wait when C{wait} is True.
+        """
+        br = self.browser
+        self._headers = br.headers[:]
+        self._headers.extend(headers or [])
+        req = br.make_request(url, headers=self._headers)
+        self.load_status = None
+        self.loading = True
+        self.webframe.load(req, operation, body or "")
+        if wait:
+            return self.wait_load(timeout)
+
+    def wait_load(self, timeout=None):
+        """Wait for the tab to load and return the load status."""
+        if not self.browser._wait_for(lambda: self.loaded, timeout=timeout):
+            raise SpynnerTimeout("Timeout reached: %s seconds" % timeout)
+        return self.load_status
+
+    def runjs(self, jscode):
+        """Run Javascript code in the tab main frame."""
+        return self.webframe.evaluateJavaScript(jscode)
+
+    def close(self):
+        """Stop the tab and release its page."""
+        self.webpage.triggerAction(QWebPage.Stop)
+        if self in self.browser.tabs:
+            self.browser.tabs.remove(self)
+        self.webpage.deleteLater()
+
+
+class JavascriptBridge(QObject):
+    """
+    Object exposed to the page scripts as C{spynner_bridge} to send events
+    to Python (see L{Browser.on_js_event}).
+    """
+
+    def __init__(self, browser):
+        QObject.__init__(self)
+        self.browser = browser
+
+    @Slot(str, str)
+    def post(self, name, data):
+        """Send the event C{name} with its JSON encoded C{data}."""
+        self.browser._on_js_event(u"%s" % name, u"%s" % data)
+
+
+class ReplyRecord(object):
+    """A finished reply, as stored in a L{ReplyRegistry}."""
+    __slots__ = ('seq', 'url', 'ok', 'http_status', 'error',
+                 'operation', 'started', 'finished')
+
+    def __init__(self, seq, url, ok, http_status=None, error=None,
+                 operation=None, started=None, finished=None):
+        self.seq = seq
+        self.url = url
+        self.ok = ok
+        self.http_status = http_status
+        self.error = error
+        self.operation = operation
+        self.started = started
+        self.finished = finished
+
+    @property
+    def elapsed(self):
+        """Seconds between the request and its reply (None if unknown)."""
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def __repr__(self):
+        return "<ReplyRecord #%s %s %s>" % (self.seq, self.http_status, self.url)
+
+
+class DownloadResult(object):
+    """A finished download of L{Browser.download_many}."""
+    __slots__ = ('url', 'path', 'nbytes', 'http_status', 'error',
+                 'error_string', 'elapsed', 'data')
+
+    def __init__(self, url, path=None, nbytes=0, http_status=None, error=None,
+                 error_string=None, elapsed=None, data=None):
+        self.url = url
+        self.path = path
+        self.nbytes = nbytes
+        self.http_status = http_status
+        self.error = error
+        self.error_string = error_string
+        self.elapsed = elapsed
+        self.data = data
+
+    @property
+    def ok(self):
+        return not self.error
+
+    def __repr__(self):
+        return "<DownloadResult %s %s %s bytes>" % (
+            self.http_status, self.url, self.nbytes)
+
+
+class ReplyWatch(object):
+    """Collect the replies matching an url or a regex after a sequence number."""
+
+    def __init__(self, count=1, url=None, url_regex=None, since=0):
+        self.count = count
+        self.url = url
+        if isinstance(url_regex, six.string_types):
+            url_regex = re.compile(url_regex)
+        self.url_regex = url_regex
+        self.since = since
+        self.records = []
+
+    @property
+    def done(self):
+        return len(self.records) >= self.count
+
+    def match(self, record):
+        if record.seq <= self.since:
+            return False
+        if self.url is not None and record.url != self.url:
+            return False
+        if self.url_regex is not None and not self.url_regex.search(record.url):
+            return False
+        return True
+
+    def feed(self, record):
+        if not self.done and self.match(record):
+            self.records.append(record)
+
+
+class IdleWatch(object):
+    """Track since when at most C{max_inflight} requests are in flight."""
+
+    def __init__(self, max_inflight=0, idle_time=0.5, inflight=0):
+        self.max_inflight = max_inflight
+        self.idle_time = idle_time
+        self.idle_since = None
+        self.update(inflight)
+
+    def update(self, inflight):
+        if inflight > self.max_inflight:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = time.time()
+
+    @property
+    def done(self):
+        return (self.idle_since is not None
+                and time.time() - self.idle_since >= self.idle_time)
+
+
+class ReplyRegistry(object):
+    """
+    Bounded registry of the finished replies of a browser.
+
+    Each finished reply gets a monotonic sequence number (L{seq} is the last
+    one). Note it before an action and you can then wait for the replies
+    which finished after it, even if several of them finished during the
+    same events loop iteration.
+    """
+
+    def __init__(self, maxlen=1000):
+        self.seq = 0
+        self.records = collections.deque(maxlen=maxlen)
+        self._started = {}
+        self._watches = []
+        self._idle_watches = []
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def inflight(self):
+        """Number of requests sent which did not finish yet."""
+        return len(self._started)
+
+    def _update_idle_watches(self):
+        for watch in self._idle_watches:
+            watch.update(self.inflight)
+
+    def start(self, reply):
+        """Record the time a request was sent."""
+        self._started[reply] = time.time()
+        self._update_idle_watches()
+
+    def finish(self, reply, url, ok, http_status=None, error=None, operation=None):
+        """Record a finished reply and feed the active watches."""
+        self.seq += 1
+        record = ReplyRecord(
+            self.seq, url, ok,
+            http_status=http_status, error=error, operation=operation,
+            started=self._started.pop(reply, None), finished=time.time())
+        self.records.append(record)
+        for watch in self._watches:
+            watch.feed(record)
+        self._update_idle_watches()
+        return record
+
+    def get(self, seq):
+        """Return the record with this sequence number if still stored."""
+        if not self.records:
+            return None
+        index = seq - self.records[0].seq
+        if 0 <= index < len(self.records):
+            return self.records[index]
+
+    def since(self, seq):
+        """Return the stored records newer than C{seq}."""
+        if not self.records:
+            return []
+        start = max(0, seq + 1 - self.records[0].seq)
+        return list(itertools.islice(self.records, start, None))
+
+    def watch(self, count=1, url=None, url_regex=None, since=None):
+        """
+        Return a L{ReplyWatch} fed with every reply finishing after C{since}
+        (default: now), already stored ones included.
+        Call L{unwatch} when you are done with it.
+        """
+        if since is None:
+            since = self.seq
+        watch = ReplyWatch(count, url=url, url_regex=url_regex, since=since)
+        for record in self.since(since):
+            watch.feed(record)
+        self._watches.append(watch)
+        return watch
+
+    def idle_watch(self, max_inflight=0, idle_time=0.5):
+        """
+        Return an L{IdleWatch} which is done when at most C{max_inflight}
+        requests were in flight for C{idle_time} seconds.
+        Call L{unwatch} when you are done with it.
+        """
+        watch = IdleWatch(max_inflight, idle_time, self.inflight)
+        self._idle_watches.append(watch)
+        return watch
+
+    def unwatch(self, watch):
+        for watches in (self._watches, self._idle_watches):
+            if watch in watches:
+                watches.remove(watch)
+
+    def clear(self):
+        """Forget the stored records, sequence numbers keep growing."""
+        self.records.clear()
+        self._started.clear()
+
+
+class DownloadEntry(object):
+    """A download, as tracked by a L{DownloadRegistry}."""
+    __slots__ = ('id', 'url', 'path', 'state', 'nbytes', 'total', 'reply',
+                 'started', 'finished', 'error')
+
+    # states
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+    def __init__(self, id, url, path=None, reply=None):
+        self.id = id
+        self.url = url
+        self.path = path
+        self.state = self.QUEUED
+        self.nbytes = 0
+        self.total = None
+        self.reply = reply
+        self.started = time.time()
+        self.finished = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.state in (self.DONE, self.FAILED)
+
+    def __repr__(self):
+        return "<DownloadEntry #%s %s %s>" % (self.id, self.state, self.url)
+
+
+def _delete_later(qobject):
+    try:
+        qobject.deleteLater()
+    except RuntimeError:
+        # already deleted with its parent
+        pass
+
+
+class DownloadRegistry(object):
+    """
+    Downloads of a browser by id, path and URL (the last download of a
+    path or URL), with their state (C{DownloadEntry.QUEUED}, C{RUNNING},
+    C{DONE} or C{FAILED}) and byte counters.
+
+    Only the C{maxlen} last finished downloads are kept: the older ones are
+    evicted and their replies released.
+    """
+
+    def __init__(self, maxlen=100):
+        self.maxlen = maxlen
+        self.seq = 0
+        self._entries = collections.OrderedDict()
+        self._by_path = {}
+        self._by_url = {}
+        self._finished = collections.deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def add(self, url, path=None, reply=None):
+        """Track a new download, return its L{DownloadEntry}."""
+        self.seq += 1
+        entry = DownloadEntry(self.seq, url, path=path, reply=reply)
+        self._entries[entry.id] = entry
+        self._by_url[url] = entry
+        if path is not None:
+            self._by_path[path] = entry
+        return entry
+
+    def attach(self, entry, url, path=None, reply=None):
+        """Set the request of a queued download when it starts."""
+        if self._by_url.get(entry.url) is entry:
+            del self._by_url[entry.url]
+        entry.url = url
+        entry.path = path
+        entry.reply = reply
+        entry.started = time.time()
+        self._by_url[url] = entry
+        if path is not None:
+            self._by_path[path] = entry
+
+    def get(self, id):
+        return self._entries.get(id)
+
+    def by_path(self, path):
+        return self._by_path.get(path)
+
+    def by_url(self, url):
+        return self._by_url.get(url)
+
+    def in_state(self, *states):
+        return [entry for entry in self._entries.values()
+                if entry.state in states]
+
+    def progress(self, entry, nbytes, total=None):
+        """Update the byte counters of a download, now running."""
+        entry.state = DownloadEntry.RUNNING
+        entry.nbytes = nbytes
+        if total is not None:
+            entry.total = total
+
+    def finish(self, entry, error=None):
+        """Mark a download as done (or failed) and evict the oldest ones."""
+        if entry.done:
+            return
+        entry.state = DownloadEntry.FAILED if error else DownloadEntry.DONE
+        entry.error = error or None
+        entry.finished = time.time()
+        self._finished.append(entry.id)
+        while len(self._finished) > self.maxlen:
+            self._evict(self._finished.popleft())
+
+    def _evict(self, id):
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            return
+        if self._by_url.get(entry.url) is entry:
+            del self._by_url[entry.url]
+        if entry.path is not None and self._by_path.get(entry.path) is entry:
+            del self._by_path[entry.path]
+        if entry.reply is not None:
+            _delete_later(entry.reply)
+            entry.reply = None
+
+    def clear(self):
+        """Forget the downloads, releasing the replies of the finished ones."""
+        for entry in list(self._entries.values()):
+            if entry.done:
+                self._evict(entry.id)
+            elif entry.reply is not None:
+                entry.reply = None
+        self._entries.clear()
+        self._by_path.clear()
+        self._by_url.clear()
+        self._finished.clear()
+
+
+def _read_all(device):
+    """Read all the available data of a QIODevice as a bytes string."""
+    data = device.readAll()
+    if hasattr(data, 'data'):
+        data = data.data()
+    return data
+
+
+def _buffer_device(parent, device):
+    """
+    Read all the data of a QIODevice, return it and a buffer device with
+    the same data to use instead.
+    """
+    data = _read_all(device)
+    buffer = QBuffer(parent)
+    buffer.setData(data)
+    buffer.open(QIODevice.ReadOnly)
+    return data, buffer
+
+
+class BufferedReply(QNetworkReply):
+    """Base of the replies built by spynner, serving a memory buffer."""
+
+    def __init__(self, parent, request, operation):
+        QNetworkReply.__init__(self, parent)
+        self._buffer = bytearray()
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+    def _append(self, data):
+        self._buffer.extend(data)
+
+    def bytesAvailable(self):
+        return len(self._buffer) + QNetworkReply.bytesAvailable(self)
+
+    def isSequential(self):
+        return True
+
+    def readData(self, maxlen):
+        data = bytes(self._buffer[:maxlen])
+        del self._buffer[:maxlen]
+        return data
+
+    def abort(self):
+        self._fail(QNetworkReply.OperationCanceledError, "Operation canceled")
+
+    def _fail(self, code, message):
+        if self.isFinished():
+            return
+        self.setError(code, message)
+        self.error.emit(code)
+        self._finish()
+
+    def _finish(self):
+        self.setFinished(True)
+        self.finished.emit()
+
+
+def _to_bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('latin-1')
+    return value
+
+
+class StaticReply(BufferedReply):
+    """
+    Reply served from memory without any network access: a status, headers
+    and a body, or an error.
+    """
+
+    def __init__(self, parent, request, operation, status=200, headers=None,
+                 body=b'', error=None):
+        """
+        @param headers: list of (name, value) tuples.
+        @param error: (QNetworkReply.NetworkError, message) to fail with.
+        """
+        BufferedReply.__init__(self, parent, request, operation)
+        if status is not None:
+            self.setAttribute(QNetworkRequest.HttpStatusCodeAttribute, status)
+        for name, value in headers or []:
+            self.setRawHeader(_to_bytes(name), _to_bytes(value))
+        self._body = _to_bytes(body) or b''
+        self._error = error
+        if error is None:
+            self.setHeader(QNetworkRequest.ContentLengthHeader, len(self._body))
+        # the signals must not be emitted before the reply is returned
+        QTimer.singleShot(0, self._serve)
+
+    @classmethod
+    def blocked(klass, parent, request, operation, message):
+        """Return an empty reply failing as denied."""
+        return klass(parent, request, operation, status=None, error=(
+            QNetworkReply.ContentAccessDenied, message))
+
+    @classmethod
+    def routed(klass, parent, request, operation, response):
+        """Return a reply serving a route handler response (see L{Browser.route})."""
+        if isinstance(response, (six.binary_type, six.text_type)):
+            response = {'body': response}
+        elif isinstance(response, tuple):
+            status, headers, body = response
+            response = {'status': status, 'headers': headers, 'body': body}
+        headers = response.get('headers') or []
+        if isinstance(headers, dict):
+            headers = list(headers.items())
+        body = response.get('body', b'')
+        content_type = response.get('content_type')
+        if 'path' in response:
+            with open(response['path'], 'rb') as fic:
+                body = fic.read()
+            if content_type is None:
+                content_type = mimetypes.guess_type(response['path'])[0]
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+            if content_type is not None and 'charset' not in content_type:
+                content_type += '; charset=utf-8'
+        if content_type is not None and not any(
+                name.lower() == 'content-type' for name, value in headers):
+            headers = headers + [('Content-Type', content_type)]
+        # custom replies are not seen by the cookie jar
+        jar = parent.cookieJar()
+        for name, value in headers:
+            if _to_bytes(name).lower() == b'set-cookie':
+                cookies = QNetworkCookie.parseCookies(_to_bytes(value))
+                jar.setCookiesFromUrl(cookies, request.url())
+        return klass(parent, request, operation,
+                     status=response.get('status', 200),
+                     headers=headers, body=body)
+
+    def _serve(self):
+        if self.isFinished():
+            return
+        if self._error is not None:
+            self._fail(*self._error)
+            return
+        self.metaDataChanged.emit()
+        if self._body:
+            self._append(self._body)
+            self.downloadProgress.emit(len(self._body), len(self._body))
+            self.readyRead.emit()
+        self._finish()
+
+
+class ProxyReply(BufferedReply):
+    """
+    Reply forwarding the headers, data and signals of another reply, which
+    may be attached later (see L{HostScheduler}).
+    """
+    _attributes = (
+        QNetworkRequest.HttpStatusCodeAttribute,
+        QNetworkRequest.HttpReasonPhraseAttribute,
+        QNetworkRequest.RedirectionTargetAttribute,
+        QNetworkRequest.ConnectionEncryptedAttribute,
+        QNetworkRequest.SourceIsFromCacheAttribute,
+    )
+
+    def __init__(self, parent, request, operation):
+        BufferedReply.__init__(self, parent, request, operation)
+        self.reply = None
+
+    def attach(self, reply):
+        self.reply = reply
+        reply.metaDataChanged.connect(self._on_meta_data_changed)
+        reply.readyRead.connect(self._on_ready_read)
+        reply.finished.connect(self._on_finished)
+        reply.downloadProgress.connect(self.downloadProgress)
+        reply.uploadProgress.connect(self.uploadProgress)
+        reply.sslErrors.connect(self.sslErrors)
+
+    def _copy_meta_data(self):
+        reply = self.reply
+        for header in reply.rawHeaderList():
+            self.setRawHeader(header, reply.rawHeader(header))
+        for attribute in self._attributes:
+            value = reply.attribute(attribute)
+            if value is None or (hasattr(value, 'isValid') and not value.isValid()):
+                continue
+            self.setAttribute(attribute, value)
+
+    def _on_meta_data_changed(self):
+        self._copy_meta_data()
+        self.metaDataChanged.emit()
+
+    def _on_ready_read(self):
+        self._append(_read_all(self.reply))
+        self.readyRead.emit()
+
+    def _on_finished(self):
+        reply = self.reply
+        self._copy_meta_data()
+        data = _read_all(reply)
+        if data:
+            self._append(data)
+            self.readyRead.emit()
+        if reply.error():
+            self._fail(reply.error(), reply.errorString())
+        else:
+            self._finish()
+        reply.deleteLater()
+
+    def ignoreSslErrors(self):
+        if self.reply is not None:
+            self.reply.ignoreSslErrors()
+
+    def abort(self):
+        if self.reply is not None:
+            self.reply.abort()
+        else:
+            BufferedReply.abort(self)
+
+
+class HostScheduler(object):
+    """
+    Per host limits of the requests in flight and of the requests rate
+    (token bucket). Requests over the limits get a L{ProxyReply} and are
+    sent when a reply for their host finishes or a token is available.
+    """
+
+    def __init__(self, concurrency=None, rate=None, burst=1):
+        self._active = {}
+        self._tokens = {}
+        self._queues = {}
+        self._timer = None
+        self.configure(concurrency, rate, burst)
+
+    def configure(self, concurrency=None, rate=None, burst=1):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = max(1, burst)
+
+    @property
+    def enabled(self):
+        return bool(self.concurrency or self.rate or self._queues)
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _refill(self, host, now):
+        tokens, last = self._tokens.get(host, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        self._tokens[host] = (tokens, now)
+        return tokens
+
+    def _admit(self, host, now):
+        if self.concurrency and self._active.get(host, 0) >= self.concurrency:
+            return False
+        if self.rate:
+            tokens = self._refill(host, now)
+            if tokens < 1:
+                return False
+            self._tokens[host] = (tokens - 1, now)
+        return True
+
+    def _track(self, host, reply):
+        self._active[host] = self._active.get(host, 0) + 1
+        reply.finished.connect(functools.partial(self._release, host))
+
+    def _release(self, host):
+        self._active[host] -= 1
+        if not self._active[host]:
+            del self._active[host]
+        self._process()
+
+    def request(self, manager, operation, request, data):
+        """Send the request now if the limits allow it, else queue it."""
+        host = u"%s" % toString(request.url().host())
+        if host not in self._queues and self._admit(host, time.time()):
+            reply = QNetworkAccessManager.createRequest(
+                manager, operation, request, data)
+            self._track(host, reply)
+            return reply
+        proxy = ProxyReply(manager, request, operation)
+        body = None
+        if data is not None:
+            # the outgoing data device may be gone when the request is sent
+            body = QBuffer(proxy)
+            body.setData(data.readAll())
+            body.open(QIODevice.ReadOnly)
+        def start():
+            if proxy.isFinished():
+                return None
+            reply = QNetworkAccessManager.createRequest(
+                manager, operation, request, body)
+            proxy.attach(reply)
+            return reply
+        self._queues.setdefault(host, collections.deque()).append(start)
+        self._schedule()
+        return proxy
+
+    def _process(self):
+        now = time.time()
+        for host, queue in list(self._queues.items()):
+            while queue and self._admit(host, now):
+                reply = queue.popleft()()
+                if reply is None:
+                    # aborted while queued, give the token back
+                    if self.rate:
+                        tokens, last = self._tokens[host]
+                        self._tokens[host] = (tokens + 1, last)
+                    continue
+                self._track(host, reply)
+            if not queue:
+                del self._queues[host]
+        self._schedule()
+
+    def _schedule(self):
+        """Wake up when the next token of a waiting host is available."""
+        if not self.rate:
+            return
+        now = time.time()
+        delays = [
+            (1 - self._refill(host, now)) / self.rate
+            for host in self._queues
+            if not (self.concurrency
+                    and self._active.get(host, 0) >= self.concurrency)]
+        if not delays:
+            return
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self._process)
+        self._timer.start(max(0, int(min(delays) * 1000)) + 1)
+
+
 class ExtendedNetworkCookieJar(QNetworkCookieJar):
     def mozillaCookies(self):
         """
@@ -1661,13 +4143,18 @@ class ExtendedNetworkCookieJar(QNetworkCookieJar):
 class NManager(QNetworkAccessManager):
     ob = None # Browser instance
     @classmethod
-    def new(klass, spynner, cookiejar_klass=None):
+    def new(klass, spynner, cookiejar_klass=None, cookiejar=None):
+        """
+        @param cookiejar: cookie jar to share with another manager, a new
+                          one of C{cookiejar_klass} is used by default.
+        """
         if not cookiejar_klass:
             cookiejar_klass = ExtendedNetworkCookieJar
         manager = klass()
         manager.ob = spynner
         manager.proxy_url = None
-        cookiejar = cookiejar_klass()
+        if cookiejar is None:
+            cookiejar = cookiejar_klass()
         manager.setCookieJar(cookiejar)
         manager.cookieJar().setParent(spynner.webpage)
         return manager
@@ -1683,18 +4170,50 @@ class NManager(QNetworkAccessManager):
         url = six.u(toString(request.url()))
         operation_name = self._operation_names.get(
             operation, str(operation)).upper()
-        req = self.make_request(request, operation_name)
+        tab = self._request_tab(request)
+        req = self.make_request(request, operation_name,
+                                headers=tab._headers if tab else None)
+        if self._cache_control is not None and manager is self.manager:
+            req.setAttribute(QNetworkRequest.CacheLoadControlAttribute,
+                             self._cache_control)
         self._debug(INFO, "Request: %s %s" % (operation_name, url))
         for h in req.rawHeaderList():
             self._debug(DEBUG, "  %s: %s" % (h, req.rawHeader(h)))
+        reply = None
         if self._url_filter:
             if self._url_filter(self._operation_names[operation], url) is False:
                 self._debug(INFO, "URL filtered: %s" % url)
-                req.setUrl(QUrl("about:blank"))
+                reply = StaticReply.blocked(
+                    manager, req, operation, "Filtered: %s" % url)
             else:
                 self._debug(DEBUG, "URL not filtered: %s" % url)
-        reply = QNetworkAccessManager.createRequest(
-            manager, operation, req, data)
+        if reply is None and self.blocking:
+            resource_type, first_party = self._request_context(request, url)
+            rule = self.blocking.match(url, resource_type, first_party)
+            if rule is not None:
+                self._debug(INFO, "URL blocked by %s: %s" % (rule.text, url))
+                reply = StaticReply.blocked(
+                    manager, req, operation, "Blocked: %s" % url)
+        if reply is None and self._routes:
+            reply, data = self._route_request(manager, operation, req, url, data)
+        if reply is None and self.archive is not None:
+            reply = self.archive.reply(
+                manager, operation, req, operation_name, url)
+        body = None
+        if reply is None and self.recorder is not None and data is not None:
+            body, data = _buffer_device(manager, data)
+        if reply is None:
+            if self.scheduler.enabled:
+                reply = self.scheduler.request(manager, operation, req, data)
+            else:
+                reply = QNetworkAccessManager.createRequest(
+                    manager, operation, req, data)
+            if self.recorder is not None:
+                reply = self.recorder.wrap(
+                    manager, operation, req, operation_name, body, reply)
+        if manager is self.manager:
+            self.replies.start(reply)
+            self._notify()
         return reply
 
     def get_proxy(self):
@@ -1753,4 +4272,11 @@ class NManager(QNetworkAccessManager):
         elif self is not self.ob.manager:
             if self.ob.manager.proxy_url:
                 self.set_proxy(self.ob.manager.proxy_url)
+        elif self.proxy_url:
+            self.ob._debug(WARNING, "Proxy: none")
+            self.proxy_url = None
+            self.setProxy(QNetworkProxy())
         return self.proxy()
+
+
+startup_times['import'] = time.time() - _IMPORT_START
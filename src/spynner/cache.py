@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Persistent HTTP disk cache for the browsers network managers.
+
+A L{DiskCacheStore} keeps the responses of a directory, each one in a meta
+data file (json) and a body file, evicts the least recently used ones when
+the size limit is reached and counts the hits and misses. There is one
+store per directory and process, shared by the browsers using it through
+their L{NetworkCache} (see L{spynner.Browser.set_cache})::
+
+    >>> br.set_cache('/tmp/spynner-cache', max_size=200 * 1024 * 1024)
+    >>> br.load(url)
+    >>> br.cache.store.stats()
+    {'hits': 42, 'misses': 12, ...}
+
+The revalidation of the stale responses (If-None-Match, If-Modified-Since
+and 304 replies) is done by Qt from the stored ETag and Last-Modified
+headers. Several processes may share a directory: the files are replaced
+atomically, but each process only accounts for the size of what it sees.
+"""
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import six
+
+from spynner.browser import (
+    QAbstractNetworkCache,
+    QNetworkCacheMetaData,
+    QNetworkRequest,
+    QBuffer,
+    QDateTime,
+    QIODevice,
+    QUrl,
+    toString,
+)
+
+# browser cache modes, see Browser.set_cache
+CACHE_MODES = {
+    # HTTP semantics: fresh responses from the cache, stale ones revalidated
+    'network': QNetworkRequest.PreferNetwork,
+    # cached responses even if stale, the network otherwise
+    'prefer-cache': QNetworkRequest.PreferCache,
+    # only the cache, the requests not in it fail
+    'offline': QNetworkRequest.AlwaysCache,
+}
+
+
+def _variant(value):
+    """Python value of a QVariant (PyQt4 API 1) or a value."""
+    if hasattr(value, 'toPyObject'):
+        value = value.toPyObject()
+    if value is not None and not isinstance(value, six.integer_types + (bool,)):
+        value = u"%s" % value
+    return value
+
+
+def _bytes(data):
+    if hasattr(data, 'data'):
+        data = data.data()
+    return data
+
+
+class DiskCacheStore(object):
+    """
+    Responses stored in a directory, evicted in least recently used order.
+
+    @param directory: cache directory, created if needed.
+    @param max_size: bytes the stored responses may use.
+    """
+    _stores = {}
+
+    @classmethod
+    def shared(klass, directory, max_size=None):
+        """Return the store of a directory for this process."""
+        directory = os.path.abspath(directory)
+        store = klass._stores.get(directory)
+        if store is None:
+            store = klass._stores[directory] = klass(directory, max_size)
+        elif max_size is not None:
+            store.max_size = max_size
+            store.evict()
+        return store
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size or 50 * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.bytes_from_cache = 0
+        self.evictions = 0
+        # key -> size, the least recently used first
+        self._index = collections.OrderedDict()
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.d'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name[:-2], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._index[key] = size
+            self.size += size
+
+    def key(self, url):
+        if isinstance(url, six.text_type):
+            url = url.encode('utf-8')
+        return hashlib.sha1(url).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fic:
+            fic.write(data)
+        getattr(os, 'replace', os.rename)(tmp, path)
+
+    def __contains__(self, url):
+        return self.key(url) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def meta(self, url):
+        """Return the meta data dict of a stored response, or None."""
+        key = self.key(url)
+        if key not in self._index:
+            return None
+        try:
+            with open(self._path(key, '.m'), 'rb') as fic:
+                return json.loads(fic.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            self._drop(key)
+            return None
+
+    def data(self, url):
+        """Return the body of a stored response and mark it as recently used."""
+        key = self.key(url)
+        if key not in self._index:
+            return None
+        path = self._path(key, '.d')
+        try:
+            with open(path, 'rb') as fic:
+                data = fic.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            self._drop(key)
+            return None
+        self._index[key] = self._index.pop(key)
+        return data
+
+    def put(self, url, meta, data):
+        """Store a response (meta data dict and body bytes)."""
+        key = self.key(url)
+        if len(data) > self.max_size:
+            self.remove(url)
+            return
+        self._write(self._path(key, '.d'), data)
+        self._write(self._path(key, '.m'), json.dumps(meta).encode('utf-8'))
+        self.size -= self._index.pop(key, 0)
+        self._index[key] = len(data)
+        self.size += len(data)
+        self.evict()
+
+    def update_meta(self, url, meta):
+        key = self.key(url)
+        if key in self._index:
+            self._write(self._path(key, '.m'), json.dumps(meta).encode('utf-8'))
+
+    def _drop(self, key):
+        self.size -= self._index.pop(key, 0)
+        for ext in ('.m', '.d'):
+            try:
+                os.remove(self._path(key, ext))
+            except OSError:
+                pass
+
+    def remove(self, url):
+        """Remove a stored response, return True if it was stored."""
+        key = self.key(url)
+        if key not in self._index:
+            return False
+        self._drop(key)
+        return True
+
+    def evict(self):
+        """Remove the least recently used responses over the size limit."""
+        while self.size > self.max_size and self._index:
+            key = next(iter(self._index))
+            self._drop(key)
+            self.evictions += 1
+
+    def clear(self):
+        for key in list(self._index):
+            self._drop(key)
+
+    def record(self, from_cache, nbytes=0):
+        """Count a finished reply (see L{stats})."""
+        if from_cache:
+            self.hits += 1
+            self.bytes_from_cache += nbytes
+        else:
+            self.misses += 1
+
+    def stats(self):
+        """Return the hits, misses, bytes served from the cache and the store size."""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / total if total else 0.,
+            'bytes_from_cache': self.bytes_from_cache,
+            'evictions': self.evictions,
+            'entries': len(self._index),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+
+def meta_to_dict(meta):
+    """Serializable form of a QNetworkCacheMetaData."""
+    attributes = meta.attributes()
+    last_modified = meta.lastModified()
+    expiration = meta.expirationDate()
+    return {
+        'url': u"%s" % toString(meta.url().toString()),
+        'headers': [
+            [_bytes(name).decode('latin-1'), _bytes(value).decode('latin-1')]
+            for name, value in meta.rawHeaders()],
+        'last_modified': (last_modified.toTime_t()
+                          if last_modified.isValid() else None),
+        'expiration': expiration.toTime_t() if expiration.isValid() else None,
+        'status': _variant(attributes.get(
+            QNetworkRequest.HttpStatusCodeAttribute)),
+        'reason': _variant(attributes.get(
+            QNetworkRequest.HttpReasonPhraseAttribute)),
+        'stored': time.time(),
+    }
+
+
+def dict_to_meta(data):
+    meta = QNetworkCacheMetaData()
+    meta.setUrl(QUrl(data['url']))
+    meta.setRawHeaders([(name.encode('latin-1'), value.encode('latin-1'))
+                        for name, value in data['headers']])
+    if data['last_modified'] is not None:
+        meta.setLastModified(QDateTime.fromTime_t(data['last_modified']))
+    if data['expiration'] is not None:
+        meta.setExpirationDate(QDateTime.fromTime_t(data['expiration']))
+    meta.setSaveToDisk(True)
+    attributes = {}
+    if data['status'] is not None:
+        attributes[QNetworkRequest.HttpStatusCodeAttribute] = data['status']
+    if data['reason'] is not None:
+        attributes[QNetworkRequest.HttpReasonPhraseAttribute] = data['reason']
+    meta.setAttributes(attributes)
+    return meta
+
+
+class NetworkCache(QAbstractNetworkCache):
+    """Network manager cache reading and writing a L{DiskCacheStore}."""
+
+    def __init__(self, store, parent=None):
+        QAbstractNetworkCache.__init__(self, parent)
+        self.store = store
+        # device being written by Qt -> meta data
+        self._inserting = {}
+
+    def _url(self, url):
+        return u"%s" % toString(url.toString(QUrl.RemoveFragment))
+
+    def metaData(self, url):
+        data = self.store.meta(self._url(url))
+        if data is None:
+            return QNetworkCacheMetaData()
+        return dict_to_meta(data)
+
+    def data(self, url):
+        body = self.store.data(self._url(url))
+        if body is None:
+            return None
+        device = QBuffer(self)
+        device.setData(body)
+        device.open(QIODevice.ReadOnly)
+        return device
+
+    def prepare(self, meta):
+        if not meta.saveToDisk():
+            return None
+        device = QBuffer(self)
+        device.open(QIODevice.ReadWrite)
+        self._inserting[device] = meta
+        return device
+
+    def insert(self, device):
+        meta = self._inserting.pop(device, None)
+        if meta is not None:
+            self.store.put(self._url(meta.url()), meta_to_dict(meta),
+                           _bytes(device.data()))
+        device.deleteLater()
+
+    def remove(self, url):
+        url = self._url(url)
+        for device, meta in list(self._inserting.items()):
+            if self._url(meta.url()) == url:
+                del self._inserting[device]
+                device.deleteLater()
+        return self.store.remove(url)
+
+    def updateMetaData(self, meta):
+        self.store.update_meta(self._url(meta.url()), meta_to_dict(meta))
+
+    def cacheSize(self):
+        return self.store.size
+
+    def clear(self):
+        self.store.clear()
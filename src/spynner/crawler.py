@@ -0,0 +1,458 @@
+#!/usr/bin/python
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Crawler built on L{spynner.Browser.load}.
+
+The urls to visit are kept in a prioritized L{Frontier}, the urls already
+queued in a L{SeenSet} (exact, 16 to 32 bytes per url) or a L{BloomFilter}
+(a few bits per url, for tens of millions of urls), and the links are
+extracted from the loaded frames and normalized with L{normalize_url}::
+
+    >>> from spynner.crawler import Crawler, BloomFilter
+    >>> crawler = Crawler(['http://www.example.com/'], max_depth=2,
+    ...                   seen=BloomFilter(10 ** 7),
+    ...                   checkpoint='crawl.state')
+    >>> for page in crawler.crawl():
+    ...     print page.url, page.status, len(page.links)
+
+With C{checkpoint}, the crawl state is saved every C{checkpoint_interval}
+pages and a new crawler given the same file resumes where the last one
+stopped.
+"""
+import hashlib
+import heapq
+import itertools
+import math
+import os
+import pickle
+import posixpath
+import struct
+import time
+import traceback
+
+import six
+from six.moves.urllib import parse as urlparse
+
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+
+def normalize_url(url, base=None, keep_fragment=False, sort_query=True):
+    """
+    Return the canonical form of an url, or None if it is not a valid
+    http(s) url.
+
+    The url is resolved against C{base}, the scheme and host are lowercased,
+    the default port, the dot segments and the fragment are removed and the
+    query arguments are sorted (as they are, without decoding them).
+    """
+    url = url.strip()
+    try:
+        if base:
+            url = urlparse.urljoin(base, url)
+        parts = urlparse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        # bad port or ipv6 literal
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+        return None
+    host = (parts.hostname or '').rstrip('.')
+    if not host:
+        return None
+    if ':' in host:
+        # ipv6 literal
+        host = '[%s]' % host
+    netloc = host
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = '%s:%s' % (host, port)
+    if parts.username:
+        userinfo = parts.username
+        if parts.password:
+            userinfo += ':' + parts.password
+        netloc = '%s@%s' % (userinfo, netloc)
+    path = parts.path or '/'
+    if '.' in path:
+        trailing = path.endswith(('/', '/.', '/..'))
+        path = posixpath.normpath(path)
+        # normpath keeps a leading '//'
+        path = '/' + path.lstrip('/')
+        if trailing and not path.endswith('/'):
+            path += '/'
+    query = parts.query
+    if sort_query and query:
+        query = '&'.join(sorted(query.split('&')))
+    fragment = parts.fragment if keep_fragment else ''
+    return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def url_host(url):
+    return (urlparse.urlsplit(url).hostname or '').lower()
+
+
+def _digest(url):
+    if isinstance(url, six.text_type):
+        url = url.encode('utf-8')
+    return hashlib.md5(url).digest()
+
+
+class SeenSet(object):
+    """
+    Exact set of urls, storing a 8 bytes digest per url instead of the url,
+    in an open addressing table kept between a quarter and half full: 16 to
+    32 bytes per url, eg: 32MB at most for 1 million urls.
+    """
+
+    _EMPTY = b'\0' * 8
+
+    def __init__(self, capacity=1024):
+        size = 16
+        while size < capacity * 2:
+            size *= 2
+        self._table = bytearray(size * 8)
+        self._size = size
+        self._count = 0
+
+    def _key(self, url):
+        digest = _digest(url)[:8]
+        if digest == self._EMPTY:
+            digest = b'\0' * 7 + b'\1'
+        return digest
+
+    def _slot(self, digest):
+        """Offset of the digest in the table, or of the empty slot for it."""
+        table, mask = self._table, self._size - 1
+        index = struct.unpack('<Q', digest)[0] & mask
+        while True:
+            offset = index * 8
+            stored = bytes(table[offset:offset + 8])
+            if stored == digest or stored == self._EMPTY:
+                return offset, stored == digest
+            index = (index + 1) & mask
+
+    def _grow(self):
+        table = self._table
+        self._size *= 2
+        self._table = bytearray(self._size * 8)
+        for offset in range(0, len(table), 8):
+            digest = bytes(table[offset:offset + 8])
+            if digest != self._EMPTY:
+                self._put(digest)
+
+    def _put(self, digest):
+        offset, found = self._slot(digest)
+        if not found:
+            self._table[offset:offset + 8] = digest
+        return not found
+
+    def add(self, url):
+        """Add an url, return True if it was not in the set."""
+        if not self._put(self._key(url)):
+            return False
+        self._count += 1
+        if self._count * 2 > self._size:
+            self._grow()
+        return True
+
+    def __contains__(self, url):
+        return self._slot(self._key(url))[1]
+
+    def __len__(self):
+        return self._count
+
+    def __setstate__(self, state):
+        if '_digests' in state:
+            # checkpoint of the set based implementation
+            digests = state['_digests']
+            self.__init__(len(digests))
+            for digest in digests:
+                if digest == self._EMPTY:
+                    digest = b'\0' * 7 + b'\1'
+                self._put(digest)
+            self._count = len(digests)
+        else:
+            self.__dict__.update(state)
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set of urls: urls are never reported as unseen once
+    added, but an unseen url may be reported as seen with a probability of
+    C{error_rate} once C{capacity} urls have been added.
+
+    The bit array takes about C{1.44 * log2(1 / error_rate)} bits per
+    url, eg: 1.2MB for 1 million urls at 1%.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        ln2 = 0.6931471805599453
+        nbits = int(-capacity * math.log(error_rate) / (ln2 * ln2)) or 1
+        self.nhashes = max(1, int(round(nbits / float(capacity) * ln2)))
+        self.nbits = nbits
+        self.bits = bytearray((nbits + 7) // 8)
+        self.count = 0
+
+    def _offsets(self, url):
+        # double hashing: h1 + i * h2 gives the k hash functions
+        h1, h2 = struct.unpack('<QQ', _digest(url))
+        h2 |= 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, url):
+        """Add an url, return True if it was (probably) not in the filter."""
+        new = False
+        bits = self.bits
+        for offset in self._offsets(url):
+            byte, mask = offset >> 3, 1 << (offset & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, url):
+        bits = self.bits
+        return all(bits[offset >> 3] & (1 << (offset & 7))
+                   for offset in self._offsets(url))
+
+    def __len__(self):
+        return self.count
+
+
+class Frontier(object):
+    """
+    Urls to visit: the highest priority first, then in insertion order.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def push(self, url, depth=0, priority=0):
+        heapq.heappush(self._heap, (-priority, next(self._counter), depth, url))
+
+    def pop(self):
+        """Return the next (url, depth) to visit."""
+        priority, count, depth, url = heapq.heappop(self._heap)
+        return url, depth
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __getstate__(self):
+        return {'heap': self._heap,
+                'counter': next(self._counter)}
+
+    def __setstate__(self, state):
+        self._heap = state['heap']
+        self._counter = itertools.count(state['counter'])
+
+
+class CrawlResult(object):
+    """A visited page; C{error} is a traceback string if the load failed."""
+
+    def __init__(self, url, depth, status=None, links=None, value=None,
+                 error=None):
+        self.url = url
+        self.depth = depth
+        self.status = status
+        self.links = links or []
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<CrawlResult %s depth=%s %s>" % (
+            self.url, self.depth, 'ok' if self.ok else 'error')
+
+
+def extract_links(browser, selector='a[href]', attribute='href'):
+    """
+    Return the normalized links of the loaded page, child frames included,
+    in document order and without duplicates.
+    """
+    from spynner.browser import toString
+    links, seen = [], set()
+    frames = [browser.webframe]
+    while frames:
+        frame = frames.pop(0)
+        base = toString(frame.baseUrl().toString()) or browser.url
+        for element in frame.findAllElements(selector).toList():
+            value = toString(element.attribute(attribute))
+            if not value:
+                continue
+            url = normalize_url(value, base=base)
+            if url is not None and url not in seen:
+                seen.add(url)
+                links.append(url)
+        frames.extend(frame.childFrames())
+    return links
+
+
+class Crawler(object):
+    """
+    Crawl from C{seeds} following the links of the loaded pages.
+
+    @param seeds: urls to start from.
+    @param browser: L{spynner.Browser} to use, created if None.
+    @param max_depth: links of pages at this depth are not followed,
+                      None for no limit.
+    @param max_pages: stop after that many pages, None for no limit.
+    @param allowed_domains: hosts (and their subdomains) which may be
+                            crawled, default to the hosts of the seeds
+                            if C{same_domain}, else any host.
+    @param same_domain: see C{allowed_domains}.
+    @param url_filter: callable taking an url and its depth, returning
+                       False to skip it.
+    @param priority: callable taking an url and its depth and returning its
+                     priority (higher first), the default gives the
+                     shallower pages first.
+    @param extract: callable taking the browser, its result is stored in
+                    the L{CrawlResult} C{value}.
+    @param seen: L{SeenSet} (default) or L{BloomFilter} of the queued urls.
+    @param checkpoint: file where the crawl state is saved.
+    @param checkpoint_interval: pages between two checkpoints.
+    @param resume: if the C{checkpoint} file exists, resume from it.
+    @param delay: seconds to wait between two pages.
+    @param load_kwargs: arguments for L{spynner.Browser.load}.
+    """
+
+    def __init__(self, seeds=(), browser=None, max_depth=None,
+                 max_pages=None, allowed_domains=None, same_domain=True,
+                 url_filter=None, priority=None, extract=None, seen=None,
+                 checkpoint=None, checkpoint_interval=100, resume=True,
+                 delay=0, load_kwargs=None):
+        self.browser = browser
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.url_filter = url_filter
+        self.priority = priority or (lambda url, depth: -depth)
+        self.extract = extract
+        self.checkpoint_path = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.delay = delay
+        self.load_kwargs = load_kwargs or {}
+        self.pages = 0
+        self.errors = 0
+        self.frontier = Frontier()
+        self.seen = seen if seen is not None else SeenSet()
+        seeds = [u for u in (normalize_url(s) for s in seeds) if u]
+        if allowed_domains is None and same_domain:
+            allowed_domains = [url_host(u) for u in seeds]
+        self.allowed_domains = allowed_domains and [
+            d.lower().lstrip('.') for d in allowed_domains]
+        if checkpoint and resume and os.path.exists(checkpoint):
+            self.restore()
+        else:
+            for url in seeds:
+                self.add(url)
+
+    def allowed(self, url):
+        """Return True if the url host is in the allowed domains."""
+        if not self.allowed_domains:
+            return True
+        host = url_host(url)
+        return any(host == d or host.endswith('.' + d)
+                   for d in self.allowed_domains)
+
+    def add(self, url, depth=0):
+        """Queue an url if it is in scope and not seen yet, return True if queued."""
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        if not self.allowed(url):
+            return False
+        if self.url_filter is not None and not self.url_filter(url, depth):
+            return False
+        if not self.seen.add(url):
+            return False
+        self.frontier.push(url, depth, self.priority(url, depth))
+        return True
+
+    def visit(self, url, depth):
+        """Load an url and return its L{CrawlResult}."""
+        if self.browser is None:
+            from spynner.browser import Browser
+            self.browser = Browser()
+        try:
+            status = self.browser.load(url, **self.load_kwargs)
+            links = extract_links(self.browser)
+            value = None
+            if self.extract is not None:
+                value = self.extract(self.browser)
+        except Exception:
+            return CrawlResult(url, depth, error=traceback.format_exc())
+        return CrawlResult(url, depth, status=status, links=links, value=value)
+
+    def crawl(self):
+        """Visit the queued urls and yield their L{CrawlResult}."""
+        try:
+            while len(self.frontier):
+                if self.max_pages is not None and self.pages >= self.max_pages:
+                    break
+                url, depth = self.frontier.pop()
+                result = self.visit(url, depth)
+                self.pages += 1
+                if not result.ok:
+                    self.errors += 1
+                if self.max_depth is None or depth < self.max_depth:
+                    for link in result.links:
+                        self.add(link, depth + 1)
+                if (self.checkpoint_path and self.checkpoint_interval
+                    and self.pages % self.checkpoint_interval == 0):
+                    self.save()
+                yield result
+                if self.delay:
+                    self.browser.wait(self.delay)
+        finally:
+            if self.checkpoint_path:
+                self.save()
+
+    def save(self, path=None):
+        """Save the crawl state, atomically replacing the previous one."""
+        path = path or self.checkpoint_path
+        state = {
+            'frontier': self.frontier,
+            'seen': self.seen,
+            'pages': self.pages,
+            'errors': self.errors,
+            'allowed_domains': self.allowed_domains,
+            'time': time.time(),
+        }
+        tmp = '%s.tmp' % path
+        with open(tmp, 'wb') as fic:
+            pickle.dump(state, fic, pickle.HIGHEST_PROTOCOL)
+            fic.flush()
+            os.fsync(fic.fileno())
+        getattr(os, 'replace', os.rename)(tmp, path)
+
+    def restore(self, path=None):
+        """Load the crawl state saved by L{save}."""
+        path = path or self.checkpoint_path
+        with open(path, 'rb') as fic:
+            state = pickle.load(fic)
+        self.frontier = state['frontier']
+        self.seen = state['seen']
+        self.pages = state['pages']
+        self.errors = state['errors']
+        self.allowed_domains = state['allowed_domains']
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Record the network traffic of a browser into a HAR (HTTP archive) file
+and replay it without network access (see L{spynner.Browser.start_recording}
+and L{spynner.Browser.replay})::
+
+    >>> br.start_recording('site.har')
+    >>> br.load('http://www.example.com/')
+    >>> br.stop_recording()
+    >>> br2 = spynner.Browser()
+    >>> br2.replay('site.har')
+    >>> br2.load('http://www.example.com/')  # served from the archive
+
+The bodies are stored decoded (Qt handles the content encodings), as text
+when possible, base64 encoded otherwise.
+"""
+import base64
+import collections
+import datetime
+import json
+import time
+
+from spynner.browser import (
+    ProxyReply,
+    StaticReply,
+    QNetworkReply,
+    QNetworkRequest,
+    QNetworkCookie,
+    QUrl,
+    toString,
+)
+
+# replayed responses headers which do not apply to the stored body
+_SKIPPED_HEADERS = ('content-length', 'content-encoding', 'transfer-encoding')
+
+
+def _text(data):
+    if hasattr(data, 'data'):
+        data = data.data()
+    if isinstance(data, bytes):
+        data = data.decode('latin-1')
+    return u"%s" % data
+
+
+def _variant(value):
+    if hasattr(value, 'toPyObject'):
+        value = value.toPyObject()
+    return value
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+
+def _content(body, mime_type):
+    """HAR content of a body: text if it decodes, else base64."""
+    content = {'size': len(body), 'mimeType': mime_type}
+    try:
+        content['text'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        content['text'] = base64.b64encode(body).decode('ascii')
+        content['encoding'] = 'base64'
+    return content
+
+
+def _body(content):
+    text = content.get('text', u'')
+    if content.get('encoding') == 'base64':
+        return base64.b64decode(text)
+    return text.encode('utf-8')
+
+
+def _key(method, url):
+    return method.upper(), url.split('#', 1)[0]
+
+
+class RecordingReply(ProxyReply):
+    """Proxy reply copying a request and its response into a L{HarRecorder}."""
+
+    def __init__(self, parent, request, operation, method, body, recorder):
+        ProxyReply.__init__(self, parent, request, operation)
+        self._method = method
+        self._request_body = body or b''
+        self._recorder = recorder
+        self._data = bytearray()
+        self._started = time.time()
+        self._first_byte = None
+
+    def _on_meta_data_changed(self):
+        if self._first_byte is None:
+            self._first_byte = time.time()
+        ProxyReply._on_meta_data_changed(self)
+
+    def _append(self, data):
+        self._data.extend(data)
+        ProxyReply._append(self, data)
+
+    def _on_finished(self):
+        ProxyReply._on_finished(self)
+        self._recorder.add(self._entry())
+
+    def _entry(self):
+        finished = time.time()
+        first_byte = self._first_byte or finished
+        request = self.request()
+        status = _variant(self.attribute(QNetworkRequest.HttpStatusCodeAttribute))
+        reason = _variant(self.attribute(QNetworkRequest.HttpReasonPhraseAttribute))
+        redirect = _variant(self.attribute(QNetworkRequest.RedirectionTargetAttribute))
+        if redirect is not None and hasattr(redirect, 'toString'):
+            redirect = toString(self.url().resolved(redirect).toString())
+        headers = [{'name': _text(name), 'value': _text(self.rawHeader(name))}
+                   for name in self.rawHeaderList()]
+        mime_type = _text(self.rawHeader(b'Content-Type'))
+        entry = {
+            'startedDateTime': _isoformat(self._started),
+            'time': int((finished - self._started) * 1000),
+            'request': {
+                'method': self._method,
+                'url': _text(toString(request.url().toString())),
+                'httpVersion': 'HTTP/1.1',
+                'headers': [
+                    {'name': _text(name), 'value': _text(request.rawHeader(name))}
+                    for name in request.rawHeaderList()],
+                'queryString': [],
+                'cookies': [],
+                'headersSize': -1,
+                'bodySize': len(self._request_body),
+            },
+            'response': {
+                'status': int(status or 0),
+                'statusText': _text(reason or u''),
+                'httpVersion': 'HTTP/1.1',
+                'headers': headers,
+                'cookies': [],
+                'content': _content(bytes(self._data), mime_type),
+                'redirectURL': _text(redirect or u''),
+                'headersSize': -1,
+                'bodySize': len(self._data),
+            },
+            'cache': {},
+            'timings': {
+                'send': 0,
+                'wait': int((first_byte - self._started) * 1000),
+                'receive': int((finished - first_byte) * 1000),
+            },
+        }
+        if self._request_body:
+            entry['request']['postData'] = _content(
+                bytes(self._request_body),
+                _text(request.rawHeader(b'Content-Type')))
+            entry['request']['postData'].pop('size')
+        if self.error():
+            entry['_error'] = int(self.error())
+            entry['_errorString'] = _text(self.errorString())
+        return entry
+
+
+class HarRecorder(object):
+    """Entries recorded from a browser, saved as a HAR file by L{save}."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+
+    def add(self, entry):
+        self.entries.append(entry)
+
+    def wrap(self, manager, operation, request, method, body, reply):
+        """Return a reply recording C{reply} (see L{RecordingReply})."""
+        recording = RecordingReply(manager, request, operation, method, body, self)
+        recording.attach(reply)
+        return recording
+
+    def save(self, path=None):
+        path = path or self.path
+        import spynner
+        archive = {'log': {
+            'version': '1.2',
+            'creator': {'name': 'spynner', 'version': getattr(spynner, '__version__', '')},
+            'pages': [],
+            'entries': self.entries,
+        }}
+        with open(path, 'wb') as fic:
+            fic.write(json.dumps(archive, indent=1).encode('utf-8'))
+        return path
+
+
+class HarArchive(object):
+    """
+    Responses of a HAR file by method and url. The same request made
+    several times gets the recorded responses in order, then the last one.
+
+    @param missing: response to the requests not in the archive: "404"
+                    (an empty 404 response), "error" (a failing reply)
+                    or "network" (sent to the network).
+    """
+
+    def __init__(self, path, missing='404'):
+        if missing not in ('404', 'error', 'network'):
+            raise ValueError("Unknown missing mode: %s" % missing)
+        self.path = path
+        self.missing = missing
+        with open(path, 'rb') as fic:
+            archive = json.loads(fic.read().decode('utf-8'))
+        self.entries = archive['log']['entries']
+        self._index = collections.defaultdict(list)
+        for entry in self.entries:
+            request = entry['request']
+            self._index[_key(request['method'], request['url'])].append(entry)
+        self._served = collections.defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, method, url):
+        """Return the recorded entry to serve, or None."""
+        key = _key(method, url)
+        entries = self._index.get(key)
+        if not entries:
+            self.misses += 1
+            return None
+        index = min(self._served[key], len(entries) - 1)
+        self._served[key] += 1
+        self.hits += 1
+        return entries[index]
+
+    def reply(self, manager, operation, request, method, url):
+        """
+        Return a reply serving the recorded response, or None if the request
+        is not in the archive and may go to the network.
+        """
+        entry = self.match(method, url)
+        if entry is None:
+            if self.missing == 'network':
+                return None
+            if self.missing == 'error':
+                return StaticReply(
+                    manager, request, operation, status=None,
+                    error=(QNetworkReply.ContentNotFoundError,
+                           "Not in the archive: %s" % url))
+            return StaticReply(manager, request, operation, status=404)
+        response = entry['response']
+        if '_error' in entry:
+            return StaticReply(
+                manager, request, operation, status=None,
+                error=(entry['_error'], entry.get('_errorString', '')))
+        headers = [(h['name'], h['value']) for h in response['headers']
+                   if h['name'].lower() not in _SKIPPED_HEADERS]
+        reply = StaticReply(manager, request, operation,
+                            status=response['status'] or None,
+                            headers=headers, body=_body(response['content']))
+        if response['statusText']:
+            reply.setAttribute(QNetworkRequest.HttpReasonPhraseAttribute,
+                               response['statusText'])
+        if response.get('redirectURL'):
+            reply.setAttribute(QNetworkRequest.RedirectionTargetAttribute,
+                               QUrl(response['redirectURL']))
+        # custom replies are not seen by the cookie jar
+        jar = manager.cookieJar()
+        for name, value in headers:
+            if name.lower() == 'set-cookie':
+                cookies = QNetworkCookie.parseCookies(value.encode('latin-1'))
+                jar.setCookiesFromUrl(cookies, QUrl(url))
+        return reply
@@ -0,0 +1,372 @@
+#!/usr/bin/python
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Pool of worker processes running browser jobs.
+
+The QApplication is a process wide singleton bound to the main thread, so
+to use several cores, each worker process owns its QApplication and a warm
+L{spynner.Browser} which is reused from one job to the next.
+
+A job is an url plus what to extract from the loaded page: a picklable
+callable taking the browser (a module level function), a Javascript
+string whose result is returned as a string, or None for the html::
+
+    >>> from spynner.pool import BrowserPool
+    >>> def links(browser):
+    ...     return [e.attribute('href') for e in
+    ...             browser.webframe.findAllElements('a').toList()]
+    >>> pool = BrowserPool(processes=8, job_timeout=60)
+    >>> for result in pool.imap_unordered([(url, links) for url in urls]):
+    ...     if result.ok:
+    ...         print result.url, result.value
+    >>> pool.close()
+
+Workers which crash or exceed C{job_timeout} are killed and restarted.
+Each worker sends its results through its own pipe, so that killing it
+cannot corrupt what the other workers send.
+"""
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import time
+import traceback
+import collections
+
+
+class PoolJob(object):
+    """A job: load C{url}, then run C{extract} (see module documentation)."""
+
+    def __init__(self, url, extract=None, load_kwargs=None, id=None):
+        self.url = url
+        self.extract = extract
+        self.load_kwargs = load_kwargs or {}
+        self.id = id
+        self.tries = 0
+
+    def __repr__(self):
+        return "<PoolJob #%s %s>" % (self.id, self.url)
+
+
+class PoolResult(object):
+    """Result of a L{PoolJob}; C{error} is a traceback string on failure."""
+
+    def __init__(self, job, value=None, status=None, error=None,
+                 worker=None, elapsed=None):
+        self.job = job
+        self.job_id = job.id
+        self.url = job.url
+        self.value = value
+        self.status = status
+        self.error = error
+        self.worker = worker
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<PoolResult #%s %s %s>" % (
+            self.job_id, self.url, 'ok' if self.ok else 'error')
+
+
+def _run_job(browser, job):
+    from spynner.browser import toString
+    status = browser.load(job.url, **job.load_kwargs)
+    if job.extract is None:
+        value = browser.html
+    elif callable(job.extract):
+        value = job.extract(browser)
+    else:
+        value = toString(browser.runjs(job.extract))
+    return status, value
+
+
+def _worker_main(worker_id, jobs, results, browser_kwargs):
+    """Worker process loop: build a browser and run the jobs sent to it."""
+    from spynner.browser import Browser
+    try:
+        browser = Browser(**browser_kwargs)
+    except Exception:
+        results.send(('crash', worker_id, None, traceback.format_exc()))
+        return
+    results.send(('ready', worker_id, None, None))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        itime = time.time()
+        try:
+            status, value = _run_job(browser, job)
+            # fail with a traceback if the value cannot be sent
+            pickle.dumps(value)
+            results.send(('done', worker_id, job.id,
+                          (status, value, time.time() - itime)))
+        except Exception:
+            results.send(('error', worker_id, job.id,
+                          (traceback.format_exc(), time.time() - itime)))
+    browser.close()
+
+
+def _wait(connections, timeout):
+    """Return the connections ready to be read within C{timeout} seconds."""
+    if hasattr(multiprocessing.connection, 'wait'):
+        return multiprocessing.connection.wait(connections, timeout)
+    # python 2
+    end = time.time() + timeout
+    while True:
+        ready = [c for c in connections if c.poll()]
+        if ready or time.time() >= end:
+            return ready
+        time.sleep(0.01)
+
+
+class _Worker(object):
+
+    def __init__(self, id, process, jobs, results):
+        self.id = id
+        self.process = process
+        self.jobs = jobs
+        self.results = results
+        self.ready = False
+        self.job = None
+        self.started = None
+
+
+class BrowserPool(object):
+    """
+    Run browser jobs in C{processes} worker processes.
+
+    @param processes: number of workers (default: number of cpus).
+    @param browser_kwargs: picklable arguments for the workers' L{spynner.Browser}.
+    @param job_timeout: seconds after which a worker running a job is
+                        considered wedged, killed and restarted.
+    @param retries: how many times a job is retried when its worker crashed
+                    or was wedged.
+    @param poll: seconds between two checks of the workers health.
+    @param context: multiprocessing context, the 'spawn' one by default as a
+                    forked Qt application is not safe.
+    @param max_restarts: workers failing to start (browser construction)
+                         this many times in a row without any worker ready
+                         make the pending jobs fail instead of restarting
+                         the workers forever.
+    """
+
+    def __init__(self, processes=None, browser_kwargs=None, job_timeout=None,
+                 retries=0, poll=0.5, context=None, max_restarts=3):
+        if context is None:
+            context = multiprocessing
+            if hasattr(multiprocessing, 'get_context'):
+                context = multiprocessing.get_context('spawn')
+        self.context = context
+        self.processes = processes or multiprocessing.cpu_count()
+        self.browser_kwargs = browser_kwargs or {}
+        self.job_timeout = job_timeout
+        self.retries = retries
+        self.poll = poll
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        # workers which failed to start since the last ready one
+        self._start_failures = 0
+        self._start_error = None
+        self._ids = itertools.count()
+        self._job_ids = itertools.count()
+        self._workers = {}
+        for i in range(self.processes):
+            self._start_worker()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start_worker(self):
+        worker_id = next(self._ids)
+        jobs = self.context.Queue()
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=_worker_main,
+            args=(worker_id, jobs, writer, self.browser_kwargs))
+        process.daemon = True
+        process.start()
+        # only the worker writes, the end of the pipe is seen when it dies
+        writer.close()
+        self._workers[worker_id] = _Worker(worker_id, process, jobs, reader)
+
+    def _stop_worker(self, worker):
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join(1)
+        worker.results.close()
+        del self._workers[worker.id]
+
+    def _restart_worker(self, worker, error=None):
+        if not worker.ready:
+            self._start_failures += 1
+            self._start_error = error or "Worker died while starting (exit code %s)" % (
+                worker.process.exitcode,)
+        self._stop_worker(worker)
+        self.restarts += 1
+        self._start_worker()
+
+    def _receive(self):
+        """Return the messages the workers sent within C{poll} seconds."""
+        readers = dict((worker.results, worker)
+                       for worker in self._workers.values())
+        messages = []
+        for reader in _wait(list(readers), self.poll):
+            try:
+                messages.append(reader.recv())
+            except (EOFError, IOError, OSError):
+                # the worker died, its restart is left to the health check
+                pass
+        return messages
+
+    def _make_job(self, job):
+        if isinstance(job, PoolJob):
+            pass
+        elif isinstance(job, (tuple, list)):
+            job = PoolJob(*job)
+        else:
+            job = PoolJob(job)
+        if job.id is None:
+            job.id = next(self._job_ids)
+        return job
+
+    def _failed(self, worker, message, todo):
+        """Handle a job lost with its worker, return its result if final."""
+        job = worker.job
+        elapsed = time.time() - worker.started
+        self._restart_worker(worker)
+        if job.tries < self.retries:
+            job.tries += 1
+            todo.appendleft(job)
+            return None
+        return PoolResult(job, error=message, worker=worker.id, elapsed=elapsed)
+
+    def imap_unordered(self, jobs):
+        """
+        Run the jobs and yield their L{PoolResult} as they complete.
+
+        If the iteration is stopped early, the workers still running a job
+        are restarted.
+
+        @param jobs: iterable of L{PoolJob}, urls, or (url, extract) tuples.
+        """
+        jobs = iter(jobs)
+        todo = collections.deque()
+        try:
+            for result in self._imap_unordered(jobs, todo):
+                yield result
+        finally:
+            for worker in list(self._workers.values()):
+                if worker.job is not None:
+                    self._restart_worker(worker)
+
+    def _imap_unordered(self, jobs, todo):
+        running = {}
+        exhausted = False
+        while True:
+            if (self._start_failures >= self.max_restarts and
+                    not any(w.ready for w in self._workers.values())):
+                # the workers cannot start, fail the jobs instead of
+                # restarting them forever
+                for job in itertools.chain(todo, (self._make_job(j) for j in jobs)):
+                    yield PoolResult(job, error=self._start_error)
+                todo.clear()
+                return
+            for worker in list(self._workers.values()):
+                if not worker.ready or worker.job is not None:
+                    continue
+                if not todo and not exhausted:
+                    try:
+                        todo.append(self._make_job(next(jobs)))
+                    except StopIteration:
+                        exhausted = True
+                if not todo:
+                    break
+                worker.job = todo.popleft()
+                worker.started = time.time()
+                running[worker.job.id] = worker.job
+                worker.jobs.put(worker.job)
+            if exhausted and not todo and not running:
+                return
+            for kind, worker_id, job_id, payload in self._receive():
+                worker = self._workers.get(worker_id)
+                if worker is None:
+                    continue
+                if kind == 'ready':
+                    worker.ready = True
+                    self._start_failures = 0
+                elif kind == 'crash':
+                    self._restart_worker(worker, error=payload)
+                elif worker.job is not None and worker.job.id == job_id:
+                    job = running.pop(job_id, worker.job)
+                    worker.job = None
+                    if kind == 'done':
+                        status, value, elapsed = payload
+                        yield PoolResult(job, value=value, status=status,
+                                         worker=worker_id, elapsed=elapsed)
+                    else:
+                        error, elapsed = payload
+                        yield PoolResult(job, error=error,
+                                         worker=worker_id, elapsed=elapsed)
+            now = time.time()
+            for worker in list(self._workers.values()):
+                message = None
+                if not worker.process.is_alive():
+                    message = "Worker died (exit code %s)" % worker.process.exitcode
+                elif (worker.job is not None and self.job_timeout is not None
+                      and now - worker.started > self.job_timeout):
+                    message = "Job timeout reached: %s seconds" % self.job_timeout
+                if message is None:
+                    continue
+                if worker.job is None:
+                    self._restart_worker(worker)
+                    continue
+                running.pop(worker.job.id, None)
+                result = self._failed(worker, message, todo)
+                if result is not None:
+                    yield result
+
+    def map(self, jobs):
+        """Run the jobs and return their L{PoolResult} in the jobs order."""
+        jobs = [self._make_job(job) for job in jobs]
+        results = dict((r.job_id, r) for r in self.imap_unordered(jobs))
+        return [results[job.id] for job in jobs]
+
+    def close(self, timeout=None):
+        """
+        Stop the workers once they are done with their current job.
+
+        @param timeout: seconds to wait for them (default: C{job_timeout},
+                        or 30), the ones still running after it are wedged
+                        and killed.
+        """
+        if timeout is None:
+            timeout = self.job_timeout or 30
+        for worker in self._workers.values():
+            worker.jobs.put(None)
+        end = time.time() + timeout
+        for worker in list(self._workers.values()):
+            worker.process.join(max(end - time.time(), 0))
+            self._stop_worker(worker)
+
+    def terminate(self):
+        """Kill the workers now."""
+        for worker in list(self._workers.values()):
+            self._stop_worker(worker)
@@ -16,18 +16,35 @@
 # along with this software.  If not, see <http://www.gnu.org/licenses/>
 
 import os
+import json
+import hashlib
 import sys
+import time
 import signal
 import unittest
+import subprocess
+import tempfile
+import shutil
 import threading
-from StringIO import StringIO
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 import spynner
+import spynner.pool
+import spynner.crawler
+import spynner.blocking
 import webserver
 from PyQt4.QtGui import QImage
+from PyQt4.QtCore import QTimer
              
 TESTDIR = os.path.dirname(__file__)
 TESTING_SERVER_PORT = 9876 
+# seconds, best 'import spynner' time in a fresh process (raise it on slow
+# machines with SPYNNER_IMPORT_TIME_BUDGET)
+IMPORT_TIME_BUDGET = float(os.environ.get("SPYNNER_IMPORT_TIME_BUDGET", 1.5))
+IMPORT_TIME_RUNS = 3
            
 def get_url(path):
     return "http://localhost:%s" % TESTING_SERVER_PORT + path
@@ -82,6 +99,19 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.browser.runjs("window.location = '/test2.html'")
         self.browser.wait_load(1000)
 
+    def test_wait_load_wakes_up_on_load_finished(self):
+        self.browser.runjs(
+            "setTimeout(function() {window.location = '/test2.html';}, 10)")
+        itime = time.time()
+        self.browser.wait_load(10)
+        self.assertTrue(time.time() - itime < 1)
+        self.assertEqual(get_url("/test2.html"), self.browser.url)
+
+    def test_wait(self):
+        itime = time.time()
+        self.browser.wait(0.2)
+        self.assertTrue(time.time() - itime >= 0.2)
+
     def test_wait_load_raises_exception_on_timeout(self):
         self.assertRaises(spynner.SpynnerTimeout, 
             self.browser.wait_load, 0.1)
@@ -90,11 +120,503 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.browser.click("#link", wait_requests=1)
         self.assertEqual(get_url("/test3.html"), self.browser.url)
         
+    def test_wait_requests_url_with_several_replies(self):
+        seq = self.browser.replies.seq
+        self.browser.runjs(
+            "for (var i=1; i<=3; i++) {"
+            "  var x = new XMLHttpRequest();"
+            "  x.open('GET', '/test' + i + '.html', true); x.send();"
+            "}")
+        records = self.browser.wait_requests(
+            url=get_url("/test2.html"), since=seq)
+        self.assertEqual(get_url("/test2.html"), records[0].url)
+        self.assertTrue(records[0].seq > seq)
+
+    def test_load_wait_until_networkidle(self):
+        self.assertTrue(self.browser.load(
+            get_url("/test2.html"), wait_until="networkidle", idle_time=0.1))
+        self.assertEqual(0, self.browser.replies.inflight)
+        self.assertRaises(spynner.SpynnerError, self.browser.load,
+                          get_url("/test2.html"), wait_until="whatever")
+
+    def test_wait_for_selector(self):
+        self.browser.runjs(
+            "setTimeout(function() {"
+            "  var e = document.createElement('div');"
+            "  e.id = 'late'; document.body.appendChild(e);"
+            "}, 50)")
+        element = self.browser.wait_for_selector("#late", timeout=5)
+        self.assertFalse(element.isNull())
+        self.browser.runjs(
+            "setTimeout(function() {"
+            "  document.body.removeChild(document.getElementById('late'));"
+            "}, 50)")
+        self.browser.wait_for_selector("#late", state="detached", timeout=5)
+        self.assertRaises(spynner.SpynnerTimeout,
+            self.browser.wait_for_selector, "#never", timeout=0.1)
+
+    def test_wait_for_content_watch_dom(self):
+        self.browser.runjs(
+            "setTimeout(function() {"
+            "  document.getElementById('link').innerHTML = 'changed';"
+            "}, 50)")
+        def changed(browser):
+            return 'changed' in browser.html
+        itime = time.time()
+        self.browser.wait_for_content(changed, tries=1, delay=5, watch_dom=True)
+        self.assertTrue(time.time() - itime < 1)
+
+    def test_deadline(self):
+        itime = time.time()
+        with self.browser.deadline(0.1):
+            self.assertRaises(spynner.SpynnerDeadlineExceeded,
+                              self.browser.wait, 5)
+        self.assertTrue(time.time() - itime < 1)
+        with self.browser.deadline() as deadline:
+            QTimer.singleShot(50, deadline.cancel)
+            self.assertRaises(spynner.SpynnerDeadlineExceeded,
+                              self.browser.wait_requests, url="/never")
+        self.assertTrue(deadline.expired)
+        # the timeouts swallowed by wait_a_little are not the deadline ones
+        with self.browser.deadline(0.1):
+            self.assertRaises(spynner.SpynnerDeadlineExceeded,
+                              self.browser.wait_a_little, 5)
+        # nor the ones of the clicks settling
+        self.browser.synthetic_input = True
+        self.browser.settle_quiet = 1
+        with self.browser.deadline(0.1):
+            self.assertRaises(spynner.SpynnerDeadlineExceeded,
+                              self.browser.native_click, "#check")
+
+    def test_wait_requests_timeout(self):
+        self.assertRaises(spynner.SpynnerTimeout,
+            self.browser.wait_requests, url="/never", timeout=0.1)
+
+    def test_tabs(self):
+        tab2 = self.browser.new_tab(get_url("/test2.html"))
+        tab3 = self.browser.new_tab(get_url("/test3.html"))
+        loaded = self.browser.wait_tabs(timeout=5)
+        self.assertEqual([tab2, tab3], loaded)
+        self.assertTrue(tab2.load_status)
+        self.assertEqual(get_url("/test3.html"), tab3.url)
+        # the main page is left untouched
+        self.assertEqual(get_url("/test1.html"), self.browser.url)
+        tab2.close()
+        self.assertEqual([tab3], self.browser.tabs)
+
+    def test_tabs_isolation(self):
+        tab = self.browser.new_tab(
+            get_url("/test2.html"), headers=[("X-Tab", "1")], wait=True)
+        self.assertTrue("X-Tab: 1" in tab.html)
+        self.browser.load(get_url("/test2.html"))
+        self.assertFalse("X-Tab" in self.browser.html)
+        messages = []
+        self.browser.set_javascript_confirm_callback(
+            lambda url, message: messages.append(("browser", message)))
+        tab.javascript_confirm_callback = (
+            lambda url, message: messages.append(("tab", message)) or True)
+        tab.runjs("confirm('from the tab')")
+        self.assertEqual([("tab", "from the tab")], messages)
+
+    def test_pool(self):
+        pool = spynner.pool.BrowserPool(processes=2, job_timeout=30)
+        try:
+            results = pool.map([
+                (get_url("/test1.html"), "document.title"),
+                get_url("/test2.html"),
+            ])
+        finally:
+            pool.close()
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual("Test1 HTML", results[0].value)
+        self.assertTrue(results[1].status)
+
+    def test_pool_broken_workers(self):
+        # the browsers cannot be built: the jobs fail instead of restarting
+        # the workers forever
+        pool = spynner.pool.BrowserPool(
+            processes=2, browser_kwargs={"no_such_argument": 1}, max_restarts=2)
+        try:
+            results = list(pool.imap_unordered([get_url("/test1.html")] * 3))
+        finally:
+            pool.terminate()
+        self.assertEqual(3, len(results))
+        self.assertFalse(any(r.ok for r in results))
+        self.assertTrue("no_such_argument" in results[0].error)
+
+    def test_host_limits(self):
+        self.browser.set_host_limits(concurrency=1)
+        self.assertTrue(self.browser.load(get_url("/test2.html")))
+        self.browser.set_host_limits(rate=10)
+        seq = self.browser.replies.seq
+        itime = time.time()
+        self.browser.runjs(
+            "for (var i=1; i<=3; i++) {"
+            "  var x = new XMLHttpRequest();"
+            "  x.open('GET', '/test' + i + '.html', true); x.send();"
+            "}")
+        records = self.browser.wait_requests(3, since=seq, timeout=5)
+        self.assertTrue(time.time() - itime >= 0.2)
+        self.assertTrue(all(r.ok for r in records))
+        self.browser.set_host_limits()
+
+    def test_crawler(self):
+        checkpoint = os.path.join(TESTDIR, "crawl.state")
+        crawler = spynner.crawler.Crawler(
+            [get_url("/test1.html")], browser=self.browser, max_depth=1,
+            url_filter=lambda url, depth: "protected" not in url,
+            checkpoint=checkpoint, checkpoint_interval=1)
+        try:
+            pages = list(crawler.crawl())
+            self.assertEqual([get_url("/test1.html"), get_url("/test3.html")],
+                             [page.url for page in pages])
+            self.assertEqual([0, 1], [page.depth for page in pages])
+            resumed = spynner.crawler.Crawler(
+                [get_url("/test1.html")], browser=self.browser,
+                checkpoint=checkpoint)
+            self.assertEqual(2, resumed.pages)
+            self.assertEqual([], list(resumed.crawl()))
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+    def test_crawler_urls(self):
+        normalize_url = spynner.crawler.normalize_url
+        self.assertEqual("http://[::1]:8080/a",
+                         normalize_url("http://[::1]:8080/b/../a"))
+        self.assertEqual("http://[fe80::1]/", normalize_url("http://[FE80::1]:80"))
+        # malformed urls are skipped
+        self.assertEqual(None, normalize_url("http://x.com:abc/"))
+        self.assertEqual(None, normalize_url("http://[::1/x"))
+        # the query arguments are sorted as they are
+        self.assertEqual("http://localhost/?a&b=%20&c=1+2",
+                         normalize_url("http://localhost/?c=1+2&b=%20&a"))
+        self.browser.route(r"/links\.html$", lambda op, url, body: (
+            200, {"Content-Type": "text/html"},
+            b'<a href="http://x.com:abc/">bad</a><a href="/test1.html">ok</a>'))
+        self.assertTrue(self.browser.load(get_url("/links.html")))
+        self.assertEqual([get_url("/test1.html")],
+                         spynner.crawler.extract_links(self.browser))
+        seen = spynner.crawler.SeenSet(capacity=4)
+        urls = ["http://localhost/%s" % i for i in range(100)]
+        self.assertTrue(all(seen.add(url) for url in urls))
+        self.assertFalse(any(seen.add(url) for url in urls))
+        self.assertEqual(100, len(seen))
+        self.assertFalse("http://localhost/" in seen)
+
+    def test_reset(self):
+        self.browser.set_javascript_confirm_callback(lambda url, message: True)
+        self.browser.runjs("localStorage.setItem('key', 'value');")
+        self.assertTrue(self.browser.get_cookies().count("mycookie"))
+        self.browser.reset()
+        self.assertEqual("about:blank", self.browser.url)
+        self.assertFalse("mycookie" in self.browser.get_cookies())
+        self.assertEqual(None, self.browser._javascript_confirm_callback)
+        self.assertEqual(0, len(self.browser.replies))
+        self.assertEqual([], self.browser.files)
+        self.assertFalse(self.browser.webpage.history().canGoBack())
+        self.browser.load(get_url("/test1.html"))
+        self.assertTrue(self.browser.runjs(
+            "localStorage.getItem('key') === null").toPyObject())
+
+    def test_reset_visited_origins(self):
+        self.browser.runjs("localStorage.setItem('key', 'value');")
+        # the page of the origin is not loaded anymore at reset time
+        self.browser.load(get_url("/test1.html").replace("localhost", "127.0.0.1"))
+        self.browser.reset()
+        self.browser.load(get_url("/test1.html"))
+        self.assertTrue(self.browser.runjs(
+            "localStorage.getItem('key') === null").toPyObject())
+
+    def test_synthetic_click(self):
+        self.assertFalse(self.browser.synthetic_input)
+        self.browser.synthetic_input = True
+        self.browser.runjs(
+            "document.getElementById('check').checked = false;")
+        self.browser.native_click("#check", offsetx=2, offsety=2)
+        self.assertTrue(self.browser.runjs(
+            "document.getElementById('check').checked").toPyObject())
+
+    def test_headless(self):
+        code = (
+            "import spynner\n"
+            "br = spynner.Browser(headless=True)\n"
+            "br.load(%r)\n"
+            "print('%%s %%s' %% (br.synthetic_input, br.webview))\n"
+            "br.close()\n" % get_url("/test1.html"))
+        output = subprocess.check_output([sys.executable, "-c", code])
+        self.assertEqual(b"True None", output.strip().splitlines()[-1])
+
+    @unittest.skipIf(sys.platform in ("win32", "darwin"), "X11 only")
+    def test_headless_no_display(self):
+        code = (
+            "import spynner\n"
+            "try:\n"
+            "    spynner.Browser(headless=True)\n"
+            "except spynner.SpynnerError:\n"
+            "    print('no display')\n")
+        env = dict(os.environ)
+        env.pop("DISPLAY", None)
+        output = subprocess.check_output([sys.executable, "-c", code], env=env)
+        self.assertEqual(b"no display", output.strip())
+
+    def test_lazy_imports(self):
+        code = (
+            "import sys\n"
+            "import spynner\n"
+            "print(' '.join(m for m in ('pkg_resources', 'autopy',"
+            " 'PyQt4.QtWebKit', 'PySide.QtWebKit') if m in sys.modules))\n")
+        output = subprocess.check_output([sys.executable, "-c", code])
+        self.assertEqual(b"", output.strip())
+        self.assertTrue(spynner.startup_times['import'] > 0)
+        self.assertTrue(spynner.startup_times['first_load'] >
+                        spynner.startup_times['browser'])
+        QWebPage = spynner.browser.QWebPage
+        self.assertTrue(isinstance(self.browser.webpage, QWebPage))
+        class Page(QWebPage):
+            pass
+        self.assertTrue(issubclass(Page, QWebPage))
+        self.assertTrue(isinstance(Page(), QWebPage))
+
+    def test_import_time(self):
+        code = (
+            "import time\n"
+            "itime = time.time()\n"
+            "import spynner\n"
+            "print(time.time() - itime)\n")
+        # the best run, not the ones slowed down by the machine load
+        elapsed = min(
+            float(subprocess.check_output([sys.executable, "-c", code]))
+            for i in range(IMPORT_TIME_RUNS))
+        self.assertTrue(elapsed < IMPORT_TIME_BUDGET,
+                        "import spynner took %ss (budget: %ss)" % (
+                            elapsed, IMPORT_TIME_BUDGET))
+
+    def test_js_bundle(self):
+        browser = spynner.Browser(embed_jquery=True)
+        try:
+            browser.load(get_url("/test1.html"))
+            frame = browser.webpage.mainFrame()
+            bundle, guard = browser._js_bundle()
+            self.assertEqual(guard, browser._js_frames[frame])
+            self.assertTrue(browser.is_jquery_loaded())
+            self.assertTrue(browser._js_bundle()[0] is bundle)
+            browser.runjs("window.%s = 2;" % guard)
+            browser.set_webframe_to_default()
+            self.assertEqual(2, browser.runjs(guard).toInt()[0])
+            browser.load(get_url("/test2.html"))
+            self.assertEqual(1, browser.runjs(guard).toInt()[0])
+            self.assertTrue(browser.is_jquery_loaded())
+        finally:
+            browser.close()
+
+    def test_js_events(self):
+        self.assertEqual("undefined",
+                         self.browser.runjs("typeof spynner_bridge").toString())
+        self.browser.load(get_url("/test1.html"))
+        self.assertEqual("undefined",
+                         self.browser.runjs("typeof spynner_emit").toString())
+        events = []
+        self.browser.on_js_event("item", events.append)
+        self.browser.runjs("spynner_emit('item', {'id': 1});")
+        self.assertEqual([{'id': 1}], events)
+        since = self.browser.js_events_seq
+        self.browser.runjs(
+            "setTimeout(function() { spynner_emit('done', [1, 2]); }, 100);")
+        self.assertEqual([1, 2], self.browser.wait_for_js_event("done", timeout=5))
+        self.assertEqual([1, 2], self.browser.wait_for_js_event("done", since=since))
+        self.assertRaises(spynner.SpynnerTimeout,
+                          self.browser.wait_for_js_event, "done", timeout=0.1)
+
+    def test_inject_early(self):
+        browser = spynner.Browser(embed_jquery=True, inject_early=True,
+                                  js_bridge=True)
+        try:
+            seq = browser.js_events_seq
+            browser.load(get_url("/early.html"))
+            self.assertEqual("function", browser.runjs("early").toString())
+            self.assertEqual("function",
+                             browser.wait_for_js_event("early", since=seq))
+        finally:
+            browser.close()
+        self.browser.load(get_url("/early.html"))
+        self.assertEqual("undefined", self.browser.runjs("early").toString())
+
+    def test_blocking(self):
+        rule = self.browser.blocking.add_filter("/test.css|")
+        self.browser.blocking.add_domain("localhost", resource_types=["image"])
+        self.assertTrue(self.browser.load(get_url("/test2.html")))
+        self.assertEqual(1, rule.hits)
+        self.assertEqual([rule], self.browser.blocking.stats())
+        records = [r for r in self.browser.replies.records
+                   if r.url == get_url("/test.css")]
+        self.assertEqual([False], [r.ok for r in records])
+
+    def test_blocking_case(self):
+        rules = spynner.blocking.RuleSet()
+        rules.add_filter("/ads/")
+        rules.add_filter("/Banner/*$image")
+        rules.add_filter("/Track/$match-case")
+        self.assertTrue(rules.match("http://localhost/ADS/x.js"))
+        self.assertTrue(rules.match("http://localhost/banner/x.png", "image"))
+        self.assertTrue(rules.match("http://localhost/Track/x.gif"))
+        self.assertEqual(None, rules.match("http://localhost/track/x.gif"))
+
+    def test_blocking_uncombinable(self):
+        rules = spynner.blocking.RuleSet()
+        # rules which can not be part of the combined patterns
+        self.assertEqual(3, rules.load_adblock(
+            ["/(?i)tracker/", "/ads/", "/(a)\\1x/"]))
+        self.assertTrue(rules.match("http://localhost/TRACKER.js"))
+        self.assertTrue(rules.match("http://localhost/aax.js"))
+        self.assertTrue(rules.match("http://localhost/ads/x.js"))
+        self.assertEqual(None, rules.match("http://localhost/test1.html"))
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.browser.set_cache(directory, mode="prefer-cache")
+            store = self.browser.cache.store
+            self.assertTrue(self.browser.load(get_url("/test2.html")))
+            self.assertEqual(0, store.hits)
+            self.assertTrue(get_url("/test.css") in store)
+            self.assertTrue(self.browser.load(get_url("/test2.html")))
+            self.assertTrue(store.hits >= 2)
+            # the replies served from memory are not counted
+            counts = store.hits, store.misses
+            self.browser.route(r"/mocked\.html$", lambda op, url, body: b"<html></html>")
+            self.assertTrue(self.browser.load(get_url("/mocked.html")))
+            self.assertEqual(counts, (store.hits, store.misses))
+            self.browser.unroute()
+            self.browser.set_cache(directory, mode="offline")
+            self.assertFalse(self.browser.load(get_url("/test3.html")))
+            self.browser.set_cache(None)
+            self.assertEqual(None, self.browser.manager.cache())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_har(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "test.har")
+        try:
+            self.browser.start_recording(path)
+            self.assertTrue(self.browser.load(get_url("/test2.html")))
+            html = self.browser.html
+            self.assertEqual(path, self.browser.stop_recording())
+            with open(path) as fic:
+                entries = json.load(fic)['log']['entries']
+            urls = [e['request']['url'] for e in entries]
+            self.assertTrue(get_url("/test.css") in urls)
+            self.browser.replay(path, missing="error")
+            self.assertTrue(self.browser.load(get_url("/test2.html")))
+            self.assertEqual(html, self.browser.html)
+            self.assertTrue(self.browser.archive.hits >= 2)
+            self.assertFalse(self.browser.load(get_url("/test3.html")))
+            self.browser.stop_replay()
+            self.assertTrue(self.browser.load(get_url("/test3.html")))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_route(self):
+        calls = []
+        def handler(operation, url, body):
+            calls.append((operation, url))
+            return 200, {"Content-Type": "text/html"}, b"<html>Mocked</html>"
+        self.browser.route(r"/mocked\.html$", handler)
+        self.browser.route(r"\.css$", lambda op, url, body: {
+            "path": get_file_path("test.css")})
+        self.assertTrue(self.browser.load(get_url("/mocked.html")))
+        self.assertTrue("Mocked" in self.browser.html)
+        self.assertEqual([("get", get_url("/mocked.html"))], calls)
+        self.assertTrue(self.browser.load(get_url("/test2.html")))
+        self.browser.route(r"/test3\.html$", lambda op, url, body: None)
+        self.assertTrue(self.browser.load(get_url("/test3.html")))
+        self.browser.unroute(r"/mocked\.html$")
+        self.assertFalse(self.browser.load(get_url("/mocked.html")))
+
+    def test_route_errors_cookies(self):
+        def broken(operation, url, body):
+            raise ValueError("broken route")
+        self.browser.route(r"/broken\.html$", broken)
+        self.assertFalse(self.browser.load(get_url("/broken.html")))
+        self.assertTrue("broken route" in self.debugoutput.getvalue())
+        self.browser.route(r"/cookie\.html$", lambda op, url, body: (
+            200, [("Set-Cookie", "routed=1; path=/")], b"<html></html>"))
+        self.assertTrue(self.browser.load(get_url("/cookie.html")))
+        self.assertTrue("routed" in self.browser.get_cookies())
+
+    def _run_async(self, coroutine):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio is python 3 only")
+    def test_aio_load(self):
+        from spynner.aio import AsyncBrowser
+        abr = AsyncBrowser(self.browser)
+        self.assertTrue(self._run_async(abr.load(get_url("/test2.html"))))
+        self.assertEqual(get_url("/test2.html"), abr.url)
+        self.assertFalse(self._run_async(abr.load("wrong://this-cannot-work")))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio is python 3 only")
+    def test_aio_click_wait_for_content(self):
+        from spynner.aio import AsyncBrowser
+        abr = AsyncBrowser(self.browser)
+        self._run_async(abr.click("#link", wait_load=True))
+        self.assertEqual(get_url("/test3.html"), abr.url)
+        self._run_async(abr.runjs(
+            "setTimeout(function() {"
+            "  document.body.innerHTML += 'changed';"
+            "}, 50)"))
+        self._run_async(abr.wait_for_content(
+            lambda browser: 'changed' in browser.html, timeout=5))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio is python 3 only")
+    def test_aio_download(self):
+        from spynner.aio import AsyncBrowser
+        abr = AsyncBrowser(self.browser)
+        data = self._run_async(abr.download(get_url('/test3.html')))
+        with open(get_file_path('test3.html'), 'rb') as fic:
+            self.assertEqual(fic.read(), data)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio is python 3 only")
+    def test_aio_timeout(self):
+        import asyncio
+        from spynner.aio import AsyncBrowser
+        abr = AsyncBrowser(self.browser)
+        self.assertRaises(spynner.SpynnerTimeout, self._run_async,
+                          abr.wait_for_content(lambda browser: False, timeout=0.1))
+        # cancelled by asyncio: nothing is left pending
+        self.assertRaises(asyncio.TimeoutError, self._run_async, asyncio.wait_for(
+            abr.wait_for_content(lambda browser: False), 0.1))
+        self.assertEqual(0, abr._pending)
+        self.assertEqual([], abr._waiters)
+
+    def test_reply_registry(self):
+        registry = spynner.ReplyRegistry(maxlen=2)
+        for i in range(3):
+            registry.finish(object(), "http://foo/%d" % i, True)
+        self.assertEqual(3, registry.seq)
+        self.assertEqual(2, len(registry))
+        self.assertEqual(None, registry.get(1))
+        self.assertEqual("http://foo/2", registry.get(3).url)
+        watch = registry.watch(2, url_regex="foo/[23]", since=1)
+        self.assertFalse(watch.done)
+        registry.finish(object(), "http://foo/3", True)
+        self.assertTrue(watch.done)
+        self.assertEqual([3, 4], [r.seq for r in watch.records])
+
     def test_click(self):
         self.browser.click("#link")
         self.browser.wait_load(timeout=1.0)
         self.assertEqual(get_url('/test3.html'), self.browser.url)            
 
+    def test_wk_click_settles(self):
+        self.browser.wk_click("#check")
+        self.assertTrue(self.browser.settle_time < self.browser.settle_timeout)
+        self.browser.wk_click("#link")
+        self.browser.wait_load(timeout=1.0)
+        self.assertEqual(get_url('/test3.html'), self.browser.url)
+
     def test_check(self):
         self.browser.check("#check")
         jscode = "jQuery('#check').attr('checked')"
@@ -167,6 +689,147 @@ class SpynnerBrowserTest(unittest.TestCase):
         downloaded_bytes = self.browser.download(get_url('/nonexisting.out'), outfd)
         self.assertEqual(None, downloaded_bytes)
 
+    def test_download_managers_pool(self):
+        for i in range(3):
+            self.assertTrue(self.browser.download(get_url('/test3.html')))
+        managers = list(self.browser._download_managers.values())
+        self.assertEqual(1, len(managers))
+        self.assertTrue(
+            managers[0].cookieJar() is self.browser.manager.cookieJar())
+        self.browser.reset()
+        self.assertEqual(0, len(self.browser._download_managers))
+
+    def test_download_proxy(self):
+        self.assertTrue(self.browser.download(get_url('/test3.html'), StringIO()))
+        # the pooled download manager follows the browser proxy
+        self.browser.set_proxy("localhost:1")
+        self.assertEqual(None, self.browser.download(
+            get_url('/test3.html'), StringIO()))
+        self.browser.set_proxy(None)
+        self.assertTrue(self.browser.download(get_url('/test3.html'), StringIO()))
+
+    def test_download_resume(self):
+        from email.utils import formatdate
+        expected_data = open(get_file_path('test3.html'), 'rb').read()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "test3.html")
+        try:
+            nbytes = self.browser.download(
+                get_url('/test3.html'), path, resume=True,
+                checksum=('md5', hashlib.md5(expected_data).hexdigest()))
+            self.assertEqual(len(expected_data), nbytes)
+            self.assertFalse(os.path.exists(path + ".resume"))
+            # an interrupted download
+            with open(path, 'wb') as fic:
+                fic.write(expected_data[:10])
+            mtime = os.path.getmtime(get_file_path('test3.html'))
+            with open(path + ".resume", 'w') as fic:
+                json.dump({'url': get_url('/test3.html'), 'etag': None,
+                           'last_modified': formatdate(mtime, usegmt=True),
+                           'total': len(expected_data)}, fic)
+            progress = []
+            nbytes = self.browser.download(
+                get_url('/test3.html'), path, resume=True, size=len(expected_data),
+                progress=lambda *args: progress.append(args))
+            self.assertEqual(len(expected_data), nbytes)
+            self.assertTrue("Resume download at 10 bytes" in self.get_debug())
+            self.assertEqual(len(expected_data), progress[-1][0])
+            self.assertEqual(len(expected_data), progress[-1][1])
+            self.assertEqual(expected_data, open(path, 'rb').read())
+            self.assertRaises(spynner.SpynnerError, self.browser.download,
+                              get_url('/test3.html'), path, size=1)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_download_registry(self):
+        downloads = self.browser.downloads
+        downloads.maxlen = 2
+        self.browser.download(get_url('/test3.html'))
+        entry = downloads.by_url(get_url('/test3.html'))
+        self.assertEqual(spynner.DownloadEntry.DONE, entry.state)
+        self.assertEqual(len(open(get_file_path('test3.html')).read()),
+                         entry.nbytes)
+        self.assertTrue(downloads.get(entry.id) is entry)
+        self.browser.download(get_url('/nonexisting.out'))
+        self.assertEqual(spynner.DownloadEntry.FAILED,
+                         downloads.by_url(get_url('/nonexisting.out')).state)
+        self.browser.download(get_url('/test2.html'))
+        # the oldest finished download was evicted with its reply
+        self.assertEqual(2, len(downloads))
+        self.assertEqual(None, downloads.get(entry.id))
+        self.assertEqual(None, entry.reply)
+        # the urls held back by download_many are queued
+        downloads.maxlen = 100
+        urls = [get_url('/test%d.html' % i) for i in (1, 2, 3)]
+        results = self.browser.download_many(urls, concurrency=1)
+        next(results)
+        queued = downloads.by_url(urls[2])
+        self.assertEqual(spynner.DownloadEntry.QUEUED, queued.state)
+        self.assertEqual(None, queued.reply)
+        self.assertEqual(2, len(list(results)))
+        self.assertEqual(spynner.DownloadEntry.DONE, queued.state)
+        self.browser.files = []
+        self.assertEqual(0, len(downloads))
+
+    def test_download_stream(self):
+        expected_data = open(get_file_path('test3.html'), 'rb').read()
+        chunks = list(self.browser.download_stream(
+            get_url('/test3.html'), chunk_size=10, buffer_size=16))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) <= 10 for chunk in chunks))
+        self.assertEqual(expected_data, b"".join(chunks))
+        chunks = []
+        def consume():
+            for chunk in self.browser.download_stream(get_url('/nonexisting.out')):
+                chunks.append(chunk)
+        self.assertRaises(spynner.SpynnerError, consume)
+        # the error page is not yielded
+        self.assertEqual([], chunks)
+        outfd = self.browser.download_spooled(get_url('/test3.html'), max_memory=16)
+        self.assertEqual(expected_data, outfd.read())
+        outfd.close()
+
+    def test_download_many(self):
+        urls = [get_url('/test%d.html' % i) for i in (1, 2, 3)]
+        urls.append(get_url('/nonexisting.out'))
+        results = list(self.browser.download_many(urls, concurrency=2))
+        self.assertEqual(sorted(urls), sorted(r.url for r in results))
+        by_url = dict((r.url, r) for r in results)
+        expected_data = open(get_file_path('test3.html')).read()
+        self.assertEqual(expected_data, by_url[urls[2]].data)
+        self.assertEqual(200, by_url[urls[2]].http_status)
+        self.assertFalse(by_url[urls[3]].ok)
+        directory = tempfile.mkdtemp()
+        try:
+            results = list(self.browser.download_many(urls[:3], dest=directory))
+            self.assertTrue(all(r.ok for r in results))
+            path = os.path.join(directory, "localhost:%s" % TESTING_SERVER_PORT,
+                                "test3.html")
+            self.assertTrue(path in [r.path for r in results])
+            with open(path) as fic:
+                self.assertEqual(expected_data, fic.read())
+            # dot segments do not escape dest
+            results = list(self.browser.download_many(
+                [get_url('/../../test3.html')], dest=directory))
+            self.assertTrue(results[0].path.startswith(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_download_many_errors(self):
+        urls = [get_url('/test%d.html' % i) for i in (1, 2, 3)]
+        def dest(url):
+            if url == urls[0]:
+                # under a file: the directory can not be created
+                return os.path.join(get_file_path('test1.html'), 'test1.html')
+            return None
+        results = list(self.browser.download_many(urls, dest=dest))
+        self.assertEqual(sorted(urls), sorted(r.url for r in results))
+        by_url = dict((r.url, r) for r in results)
+        self.assertFalse(by_url[urls[0]].ok)
+        self.assertTrue(by_url[urls[1]].ok and by_url[urls[2]].ok)
+        self.assertEqual(0, len(self.browser._active_downloads))
+
     def test_get_url_from_path(self):
         self.assertEqual(get_url("/test2.html"), 
             self.browser.get_url_from_path('/test2.html'))
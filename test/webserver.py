@@ -16,10 +16,12 @@
 from __future__ import print_function
 import os
 import re
-import cgi
 import base64
 
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 
 class Handler(BaseHTTPRequestHandler):
 
@@ -31,11 +33,18 @@ class Handler(BaseHTTPRequestHandler):
 
     def _debug_headers(self, headers):
         if self.verbose:
-            for header in headers.headers:
+            for header in headers:
                 print(header,)
 
+    def _header(self, name):
+        return self.headers.get(name)
+
     def do_GET(self):
-        request_headers = self.headers.headers[:]
+        if hasattr(self.headers, 'headers'):
+            # python 2: the raw header lines
+            request_headers = self.headers.headers[:]
+        else:
+            request_headers = ["%s: %s" % item for item in self.headers.items()]
         self._debug_headers(request_headers)
         path = re.sub("\?.*$", "", self.path.strip("/"))
         filepath = os.path.join(self.basedir, path)
@@ -43,28 +52,43 @@ class Handler(BaseHTTPRequestHandler):
             self.send_error(404, 'File Not Found: %s' % path)
             return
         if self.protected and self.path in self.protected:
-            correct = base64.b64encode('myuser:mypassword')
-            authorization = self.headers.getheader('authorization')
+            correct = base64.b64encode(b'myuser:mypassword').decode('ascii')
+            authorization = self._header('authorization')
             if not authorization or not authorization.split()[1] == correct:
                 self.send_response(401)
                 self.send_header('WWW-Authenticate', 'Basic realm="webserver"')
                 self.end_headers()
                 return
-        self.send_response(200)
+        sheaders = "<br />".join(request_headers)
+        with open(filepath, 'rb') as fic:
+            html = fic.read().replace(b"$headers", sheaders.encode('latin-1'))
+        last_modified = self.date_time_string(int(os.path.getmtime(filepath)))
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self._header('range') or '')
+        if match and self._header('if-range') in (None, last_modified):
+            start = int(match.group(1))
+        if start >= len(html) > 0:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(html))
+            self.end_headers()
+            return
+        self.send_response(206 if start else 200)
         extension = os.path.splitext(filepath)
         if extension in ("html", "htm"):
             self.send_header('Content-type', 'text/html')
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(html) - 1, len(html)))
+        self.send_header('Content-Length', str(len(html) - start))
+        self.send_header('Last-Modified', last_modified)
         self.end_headers()
-        sheaders = "<br />".join(request_headers)
-        html = open(filepath).read().replace("$headers", sheaders)
-        self.wfile.write(html)
+        self.wfile.write(html[start:])
 
     def do_POST(self):
-        ctype, pdict = cgi.parse_header(self.headers.getheader('content-type'))
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
         self.end_headers()
-        self.wfile.write("<html></html>");
+        self.wfile.write(b"<html></html>")
 
     def log_message(self, *args):
         if self.verbose: